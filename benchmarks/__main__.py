@@ -0,0 +1,137 @@
+"""
+Run the offline benchmark suites, writing their results as JSON so that
+runs of different commits can be compared
+
+python -m benchmarks [--quick] [--latency S] [--bandwidth B]
+    [--suite NAME ...] [--output results.json]
+python -m benchmarks --compare baseline.json [results.json]
+    [--threshold 0.1]
+
+Results record the commit, python and platform they were measured on
+Comparing reports each shared metric as new/old; timings (names ending
+'_s') that grew, or rates ('_per_s', '_speedup') that fell, by more than
+threshold are regressions, and make the exit status 1
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import platform
+import subprocess
+import sys
+
+from benchmarks import bench_database, bench_job_codec, bench_transfer
+
+SUITES = {
+    'job_codec': lambda args: bench_job_codec.run(
+        2000 if args.quick else 20000),
+    'database': lambda args: bench_database.run(
+        1000 if args.quick else 5000, args.latency),
+    'transfer': lambda args: bench_transfer.run(
+        8 if args.quick else 32, latency=args.latency,
+        bandwidth=args.bandwidth),
+}
+
+
+def commit() -> str:
+    """Checked out commit (with '-dirty' if modified), None outside git"""
+    try:
+        head = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              check=True).stdout.decode().strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain',
+                                '--untracked-files=no'],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL,
+                               check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return head + ('-dirty' if dirty else '')
+
+
+def run(args) -> dict:
+    return {
+        'commit': commit(),
+        'time': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {'quick': args.quick, 'latency': args.latency,
+                       'bandwidth': args.bandwidth},
+        'results': {name: SUITES[name](args) for name in args.suite},
+    }
+
+
+def _lower_is_better(metric: str) -> bool:
+    return metric.endswith('_s') and not metric.endswith('_per_s')
+
+
+def _higher_is_better(metric: str) -> bool:
+    return metric.endswith('_per_s') or metric.endswith('speedup')
+
+
+def compare(old: dict, new: dict, threshold: float = 0.1) -> list:
+    """
+    (suite, metric, old, new, regressed) of the metrics of both results
+    """
+    rows = []
+    for suite, metrics in new['results'].items():
+        previous = old['results'].get(suite, {})
+        for metric, value in metrics.items():
+            before = previous.get(metric)
+            if not isinstance(value, (int, float)) or not before:
+                continue
+            ratio = value / before
+            regressed = ((_lower_is_better(metric) and
+                          ratio > 1 + threshold) or
+                         (_higher_is_better(metric) and
+                          ratio < 1 - threshold))
+            rows.append((suite, metric, before, value, regressed))
+    return rows
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('--suite', nargs='+', choices=sorted(SUITES),
+                        default=sorted(SUITES))
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller workloads')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds per simulated request')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='bytes per second per storage request')
+    parser.add_argument('--output', help='write results to this file')
+    parser.add_argument('--compare', nargs='+', metavar='RESULTS',
+                        help='baseline results [new results, else run]')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    if args.compare and len(args.compare) > 1:
+        with open(args.compare[1]) as file:
+            results = json.load(file)
+    else:
+        results = run(args)
+        if args.output:
+            with open(args.output, 'w') as file:
+                json.dump(results, file, indent=2)
+        else:
+            json.dump(results, sys.stdout, indent=2)
+            print()
+    if not args.compare:
+        return 0
+
+    with open(args.compare[0]) as file:
+        baseline = json.load(file)
+    print(f'{baseline["commit"]} -> {results["commit"]}')
+    if baseline['parameters'] != results['parameters']:
+        print(f'parameters differ: {baseline["parameters"]} -> '
+              f'{results["parameters"]}')
+    rows = compare(baseline, results, args.threshold)
+    for suite, metric, before, value, regressed in rows:
+        print(f'{suite:>10} {metric:>32}: {before:>12.4g} -> '
+              f'{value:>12.4g} ({value / before:6.2f}x)'
+              f'{"  REGRESSION" if regressed else ""}')
+    return int(any(row[-1] for row in rows))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
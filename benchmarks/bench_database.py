@@ -0,0 +1,95 @@
+"""
+Benchmark: GCPDatabase and GCPJob against the in-memory firestore with
+injected latency
+Listing a large collection (user_jobs, whole and paged), batched saves
+(save_jobs) and update_in_db rates, sequential and from many threads,
+and the cost of collecting their instrumentation
+
+python -m benchmarks.bench_database [n_jobs] [latency_s]
+"""
+from concurrent.futures import ThreadPoolExecutor
+import sys
+
+from benchmarks.offline import best, fake_clients, timed
+from impression_web import instrumentation
+from impression_web.database.gcp_database import GCPDatabase
+from impression_web.job.gcp_job import GCPJob
+
+USER = 'bench-user'
+
+
+def run(n_jobs: int = 5000, latency: float = 0.0, page_size: int = 500,
+        n_updates: int = 200, max_workers: int = 16) -> dict:
+    with fake_clients(latency) as (db, _):
+        database = GCPDatabase(db=db)
+        jobs = [GCPJob(USER, {u'input_name': f'input-{i}.sdf',
+                              u'upload_name': f'upload-{i}.sdf'}, 'fchl')
+                for i in range(n_jobs)]
+        _, save_s = timed(lambda: database.save_jobs(jobs))
+
+        def list_all():
+            return list(database.user_jobs(USER))
+
+        def list_paged():
+            listed, token = [], None
+            while True:
+                page = database.user_jobs(USER, limit=page_size,
+                                          order_by=u'submission_time',
+                                          start_after=token)
+                listed.extend(page)
+                token = page.next_token
+                if token is None:
+                    return listed
+
+        assert len(list_all()) == len(list_paged()) == n_jobs
+        round_trips = db.round_trips
+        list_paged()
+        page_round_trips = db.round_trips - round_trips
+
+        updated = list_all()[:n_updates]
+        counter = iter(range(sys.maxsize))
+
+        def update(job):
+            job.info = f'update {next(counter)}'
+            job.update_in_db()
+
+        def update_sequential():
+            for job in updated:
+                update(job)
+
+        def update_concurrent():
+            with ThreadPoolExecutor(max_workers) as executor:
+                list(executor.map(update, updated))
+
+        repeat = 1 if latency else 5
+        results = {
+            'n_jobs': n_jobs,
+            'latency': latency,
+            'save_jobs_s': save_s,
+            'saved_jobs_per_s': n_jobs / save_s,
+            'user_jobs_s': best(list_all, repeat),
+            'user_jobs_paged_s': best(list_paged, repeat),
+            'paged_round_trips': page_round_trips,
+            'update_in_db_s': best(update_sequential, repeat),
+            'concurrent_update_in_db_s': best(update_concurrent, repeat),
+        }
+        with instrumentation.instrumenting(instrumentation.Collector()):
+            results['collected_update_in_db_s'] = best(update_sequential,
+                                                       repeat)
+    results['listed_jobs_per_s'] = n_jobs / results['user_jobs_s']
+    results['updates_per_s'] = n_updates / results['update_in_db_s']
+    results['concurrent_updates_per_s'] = (
+        n_updates / results['concurrent_update_in_db_s'])
+    return results
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    kwargs = {}
+    if args:
+        kwargs['n_jobs'] = int(args[0])
+    if len(args) > 1:
+        kwargs['latency'] = float(args[1])
+    for name, value in run(**kwargs).items():
+        print(f'{name:>26}: {value:.4g}' if isinstance(value, float)
+              else f'{name:>26}: {value}')
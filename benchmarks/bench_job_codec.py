@@ -0,0 +1,174 @@
+"""
+Micro-benchmark: schema codec (Job.to_dict/GCPJob.from_dict/from_dicts)
+against the original dict based Job with its per-key from_dict loop
+The codec reads native timestamps, from_legacy_dicts_s times it on the
+original string times
+
+python -m benchmarks.bench_job_codec [n_jobs]
+"""
+from datetime import datetime
+import sys
+import timeit
+import tracemalloc
+
+from impression_web.job.gcp_job import GCPJob
+from impression_web.job.job import JobStatus
+
+
+class LegacyJob:
+    """The original Job representation: __dict__, strptime/strftime"""
+    _datetime_format = '%y-%m-%d::%H:%M'
+
+    def __init__(self, user=None, file=None, model=None, job_id=None):
+        self.user = user
+        self.file = file
+        self.model = model
+        self.job_id = job_id
+        self._submission_time = None
+        self._start_time = None
+        self._completion_time = None
+        self.status = JobStatus.NONE
+        self._info = ""
+        self._err = ""
+        self._output_file_url = None
+        self.worker_id = None
+        self.lease_expiry = None
+        self._db = None
+        self._bucket = None
+        self.input_name = None
+        self._upload_name = None
+        self._output_name = None
+
+    def _time_property(attr):
+        def get(self):
+            try:
+                return getattr(self, attr).strftime(
+                    LegacyJob._datetime_format)
+            except AttributeError:
+                return None
+
+        def set_(self, value):
+            setattr(self, attr, value)
+        return property(get, set_)
+
+    def _property(attr):
+        def set_(self, value):
+            setattr(self, attr, value)
+        return property(lambda self: getattr(self, attr), set_)
+
+    submission_time = _time_property('_submission_time')
+    start_time = _time_property('_start_time')
+    completion_time = _time_property('_completion_time')
+    output_file_url = _property('_output_file_url')
+    upload_name = _property('_upload_name')
+    output_name = _property('_output_name')
+    info = _property('_info')
+    err = _property('_err')
+
+    def to_dict(self):
+        return {u'job_id': self.job_id,
+                u'user': self.user,
+                u'status': self.status.value,
+                u'input_name': self.input_name,
+                u'upload_name': self._upload_name,
+                u'output_name': self._output_name,
+                u'model': self.model,
+                u'submission_time': self.submission_time,
+                u'start_time': self.start_time,
+                u'completion_time': self.completion_time,
+                u'info': self._info,
+                u'err': self._err,
+                u'output_file_url': self._output_file_url,
+                u'worker_id': self.worker_id,
+                u'lease_expiry': self.lease_expiry}
+
+    @staticmethod
+    def _datetimefromstr(string):
+        try:
+            return datetime.strptime(string, LegacyJob._datetime_format)
+        except TypeError:
+            return None
+
+    @staticmethod
+    def from_dict(src):
+        job = LegacyJob()
+        for k, v in src.items():
+            try:
+                if 'time' in k:
+                    setattr(job, k, LegacyJob._datetimefromstr(v))
+                elif k == 'status':
+                    setattr(job, k, JobStatus(v))
+                else:
+                    setattr(job, k, v)
+            except AttributeError:
+                pass
+        return job
+
+
+def documents(n: int) -> [dict]:
+    return [{u'job_id': f'job-{i}', u'user': f'user-{i % 50}',
+             u'status': i % 6, u'input_name': f'input-{i}.sdf',
+             u'upload_name': f'upload-{i}.sdf',
+             u'output_name': f'output-{i}.sdf', u'model': 'fchl',
+             u'submission_time': f'21-03-{1 + i // 1440 % 28:02d}'
+                                 f'::{i // 60 % 24:02d}:{i % 60:02d}',
+             u'start_time': f'21-03-{1 + i // 1440 % 28:02d}'
+                            f'::{i // 60 % 24:02d}:{(i + 1) % 60:02d}',
+             u'completion_time': None,
+             u'info': 'info', u'err': '', u'output_file_url': None,
+             u'worker_id': None, u'lease_expiry': None}
+            for i in range(n)]
+
+
+def best(stmt, repeat: int = 5) -> float:
+    return min(timeit.repeat(stmt, number=1, repeat=repeat))
+
+
+def allocated(build) -> int:
+    """Bytes held by the objects build() returns"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del objects
+    return after - before
+
+
+def run(n: int = 20000) -> dict:
+    legacy_srcs = documents(n)
+    legacy_jobs = [LegacyJob.from_dict(src) for src in legacy_srcs]
+    # as stored now: native timestamps
+    srcs = [job.to_dict() for job in GCPJob.from_dicts(legacy_srcs)]
+    jobs = GCPJob.from_dicts(srcs)
+
+    def strings(job):
+        return (job.job_id, job.status, job.submission_time, job.start_time,
+                job.completion_time, job.output_name)
+    assert list(map(strings, jobs)) == list(map(strings, legacy_jobs))
+
+    results = {
+        'n_jobs': n,
+        'legacy_from_dict_s': best(
+            lambda: [LegacyJob.from_dict(src) for src in legacy_srcs]),
+        'from_dict_s': best(lambda: [GCPJob.from_dict(src) for src in srcs]),
+        'from_dicts_s': best(lambda: GCPJob.from_dicts(srcs)),
+        'from_legacy_dicts_s': best(lambda: GCPJob.from_dicts(legacy_srcs)),
+        'legacy_to_dict_s': best(lambda: [j.to_dict() for j in legacy_jobs]),
+        'to_dict_s': best(lambda: [j.to_dict() for j in jobs]),
+        'legacy_bytes': allocated(
+            lambda: [LegacyJob.from_dict(src) for src in legacy_srcs]),
+        'bytes': allocated(lambda: GCPJob.from_dicts(srcs)),
+    }
+    results['decode_speedup'] = (results['legacy_from_dict_s'] /
+                                 results['from_dicts_s'])
+    results['encode_speedup'] = (results['legacy_to_dict_s'] /
+                                 results['to_dict_s'])
+    results['memory_ratio'] = results['legacy_bytes'] / results['bytes']
+    return results
+
+
+if __name__ == '__main__':
+    for name, value in run(*map(int, sys.argv[1:])).items():
+        print(f'{name:>20}: {value:.4g}' if isinstance(value, float)
+              else f'{name:>20}: {value}')
@@ -0,0 +1,84 @@
+"""
+Benchmark: GCPStorage transfer throughput against the in-memory storage
+with injected latency (and optionally bandwidth)
+upload_many/download_many one file at a time and in parallel, and
+compressed uploads
+
+python -m benchmarks.bench_transfer [n_files] [latency_s]
+"""
+import pathlib
+import sys
+import tempfile
+
+from benchmarks.offline import fake_clients, timed
+from impression_web.storage import compression
+from impression_web.storage.file_storage import OUTPUT
+from impression_web.storage.gcp_storage import GCPStorage
+
+RECORD = (b'molecule\n  impression\n\n  3  2  0  0  0  0  0  0  0  0999 '
+          b'V2000\n    0.0000    0.0000    0.0000 C   0  0\nM  END\n'
+          b'> <NMREDATA_ASSIGNMENT>\n1, 128.5000, 6, 0.0000\n\n$$$$\n')
+
+
+def run(n_files: int = 32, file_size: int = 1024 * 1024,
+        latency: float = 0.0, bandwidth: float = None,
+        max_workers: int = 8) -> dict:
+    with tempfile.TemporaryDirectory() as root, \
+            fake_clients(latency, bandwidth) as (_, client):
+        root = pathlib.Path(root)
+        content = RECORD * (file_size // len(RECORD) + 1)
+        files = []
+        for i in range(n_files):
+            path = root / f'input-{i}.sdf'
+            path.write_bytes(content[:file_size])
+            files.append(path)
+        downloads = root / 'downloads'
+        downloads.mkdir()
+
+        def storage(method=None):
+            return GCPStorage('bench-input', 'bench-output', client=client,
+                              chunk_size=GCPStorage.CHUNK_MULTIPLE,
+                              compression=method)
+
+        def upload(workers, method=None):
+            report, seconds = timed(lambda: storage(method).upload_many(
+                files, OUTPUT, max_workers=workers))
+            report.raise_for_errors()
+            return seconds
+
+        def download(workers):
+            report, seconds = timed(lambda: storage().download_many(
+                [(downloads / path.name, path.name) for path in files],
+                max_workers=workers))
+            report.raise_for_errors()
+            return seconds
+
+        round_trips = client.round_trips
+        results = {
+            'n_files': n_files,
+            'file_size': file_size,
+            'latency': latency,
+            'upload_serial_s': upload(1),
+            'upload_round_trips': client.round_trips - round_trips,
+            'upload_parallel_s': upload(max_workers),
+            'download_serial_s': download(1),
+            'download_parallel_s': download(max_workers),
+            'upload_gzip_s': upload(max_workers, compression.GZIP),
+        }
+    total = n_files * file_size
+    for name in ('upload_serial', 'upload_parallel', 'download_serial',
+                 'download_parallel', 'upload_gzip'):
+        results[f'{name}_bytes_per_s'] = total / results[f'{name}_s']
+    return results
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    kwargs = {}
+    if args:
+        kwargs['n_files'] = int(args[0])
+    if len(args) > 1:
+        kwargs['latency'] = float(args[1])
+    for name, value in run(**kwargs).items():
+        print(f'{name:>30}: {value:.4g}' if isinstance(value, float)
+              else f'{name:>30}: {value}')
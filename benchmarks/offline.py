@@ -0,0 +1,40 @@
+"""
+Shared helpers of the offline benchmarks: timing, and the in-memory
+firestore and storage stand-ins registered as the shared clients
+"""
+import contextlib
+import time
+import timeit
+
+from impression_web import clients
+from impression_web.database.fake_firestore import FakeFirestoreClient
+from impression_web.storage.fake_storage import FakeStorageClient
+
+
+def best(stmt, repeat: int = 5) -> float:
+    """Fastest of repeat timings of stmt() (seconds)"""
+    return min(timeit.repeat(stmt, number=1, repeat=repeat))
+
+
+def timed(fn):
+    """(result of fn(), seconds it took)"""
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def fake_clients(latency: float = 0.0, bandwidth: float = None):
+    """
+    Fake firestore and storage clients, registered as the shared clients
+    for the duration, each request waiting latency seconds (and storage
+    transfers size / bandwidth more)
+    """
+    db = FakeFirestoreClient(latency=latency)
+    storage = FakeStorageClient(latency=latency, bandwidth=bandwidth)
+    clients.registry.register(clients.FIRESTORE, db)
+    clients.registry.register(clients.STORAGE, storage)
+    try:
+        yield db, storage
+    finally:
+        clients.registry.clear()
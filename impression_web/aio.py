@@ -0,0 +1,125 @@
+"""
+Asyncio support for the blocking platform clients
+Platform calls (firestore, cloud storage) run on a process wide thread
+pool reserved for them, sized for many concurrent requests and separate
+from the event loop's default executor, so awaiting them never blocks
+the loop nor starves the application's own executor work
+
+Callbacks from client threads (snapshot listeners) are handed back to
+the loop with loop_callback()
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
+import threading
+from typing import Callable
+
+SYNC = 'sync'
+ASYNC = 'async'
+MODES = (SYNC, ASYNC)
+
+# Platform calls are I/O bound (the GIL is released while waiting), so
+# the pool is much larger than the cpu count
+DEFAULT_MAX_WORKERS = 64
+
+
+def check_mode(mode: str) -> str:
+    """Return mode, raise NotImplementedError if it is not in MODES"""
+    if mode not in MODES:
+        raise NotImplementedError(f'Invalid mode: {mode}, use one of '
+                                  f'{MODES}')
+    return mode
+
+
+class IOExecutor:
+    """
+    Thread safe, fork safe pool running blocking platform calls
+    run(): awaitable result of fn(*args, **kwargs) run on the pool
+    configure(): resize the pool (calls already running complete)
+    The pool is created on first use
+    """
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        """Discard a pool (and a possibly held lock) inherited via fork"""
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._executor = None
+            self._pid = os.getpid()
+
+    def executor(self) -> ThreadPoolExecutor:
+        self._check_fork()
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='impression-io')
+            return self._executor
+
+    def configure(self, max_workers: int):
+        if max_workers < 1:
+            raise ValueError(f'max_workers must be positive: {max_workers}')
+        self._check_fork()
+        with self._lock:
+            self.max_workers = max_workers
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+    def run(self, fn: Callable, *args, **kwargs) -> asyncio.Future:
+        """Must be called from a coroutine (or with the loop running)"""
+        return asyncio.get_event_loop().run_in_executor(
+            self.executor(), functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+
+executor = IOExecutor()
+
+
+def run(fn: Callable, *args, **kwargs) -> asyncio.Future:
+    """Await fn(*args, **kwargs) run on the shared IOExecutor"""
+    return executor.run(fn, *args, **kwargs)
+
+
+class Counterpart:
+    """Base of asyncio counterparts, sync: the blocking object wrapped"""
+    __slots__ = ('sync',)
+
+    def __init__(self, sync):
+        object.__setattr__(self, 'sync', sync)
+
+
+def unwrap(obj):
+    """The blocking object of a Counterpart, other objects as they are"""
+    return obj.sync if isinstance(obj, Counterpart) else obj
+
+
+def loop_callback(callback: Callable, loop=None) -> Callable:
+    """
+    Function calling callback(*args) on loop (the current loop if None)
+    from any thread; coroutine functions are scheduled as tasks
+    """
+    loop = asyncio.get_event_loop() if loop is None else loop
+
+    if asyncio.iscoroutinefunction(callback):
+        def call(*args):
+            loop.call_soon_threadsafe(
+                lambda: loop.create_task(callback(*args)))
+    else:
+        def call(*args):
+            loop.call_soon_threadsafe(callback, *args)
+    return call
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=executor._check_fork)
@@ -0,0 +1,174 @@
+"""
+Read-through cache of job documents
+Bounded LRU with a time to live depending on job status: FINISHED and
+ERROR jobs do not change so are kept long, active jobs only briefly
+
+Writes made through GCPJob/GCPDatabase in this process invalidate the
+affected entries of every JobCache (invalidate())
+"""
+from collections import OrderedDict
+import threading
+import time
+import weakref
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from impression_web.job.job import JobStatus
+
+# Caches to invalidate on writes within this process
+_caches = weakref.WeakSet()
+
+
+def active() -> bool:
+    """Is there any JobCache in this process"""
+    return len(_caches) > 0
+
+
+def invalidate(job_id: str = None, user: str = None):
+    """Drop job_id and listings of user's jobs from every JobCache"""
+    for job_cache in list(_caches):
+        job_cache.invalidate(job_id, user)
+
+
+class JobCache:
+    """
+    Thread safe LRU of job documents (dicts as stored in the database)
+    get()/put() single jobs by job_id, get_synced() with the update time
+    of the database entry they were read at
+    get_listing()/put_listing() query results of a user's jobs
+
+    max_entries: bound on cached jobs and listings
+    ttl: seconds to keep jobs by JobStatus, default_ttl for other states
+    """
+    DEFAULT_TTL = {JobStatus.FINISHED: 3600.0, JobStatus.ERROR: 3600.0}
+
+    def __init__(self, max_entries: int = 1024,
+                 ttl: Dict[JobStatus, float] = None,
+                 default_ttl: float = 5.0,
+                 clock: Callable[[], float] = time.monotonic):
+        if max_entries < 1:
+            raise ValueError(f'max_entries must be positive: {max_entries}')
+
+        self.max_entries = max_entries
+        self.ttl = dict(JobCache.DEFAULT_TTL if ttl is None else ttl)
+        self.default_ttl = default_ttl
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        # key -> (expiry, value, user)
+        self._entries = OrderedDict()
+        self._user_keys = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+        _caches.add(self)
+
+    def _ttl(self, document: dict) -> float:
+        try:
+            status = JobStatus(document.get(u'status'))
+        except ValueError:
+            return self.default_ttl
+        return self.ttl.get(status, self.default_ttl)
+
+    def _get(self, key: Hashable):
+        with self._lock:
+            try:
+                expiry, value, user = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+
+            if expiry <= self._clock():
+                self._remove(key)
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _put(self, key: Hashable, value, ttl: float, user: Optional[str]):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (self._clock() + ttl, value, user)
+            if user is not None:
+                self._user_keys.setdefault(user, set()).add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: Hashable):
+        """Helper: remove key, lock must be held"""
+        try:
+            _, _, user = self._entries.pop(key)
+        except KeyError:
+            return
+        keys = self._user_keys.get(user)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[user]
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """Cached document of job_id, None if absent or expired"""
+        entry = self.get_synced(job_id)
+        return None if entry is None else entry[0]
+
+    def get_synced(self, job_id: str) -> Optional[Tuple[dict, Any]]:
+        """
+        (cached document, update time of its database entry) of job_id,
+        None if absent or expired
+        """
+        return self._get((u'job', job_id))
+
+    def put(self, document: dict, job_id: str = None, update_time=None):
+        """
+        Cache a job document (under its job_id unless given), read from
+        the database entry as of update_time
+        """
+        job_id = document.get(u'job_id') if job_id is None else job_id
+        if job_id is not None:
+            self._put((u'job', job_id), (document, update_time),
+                      self._ttl(document), document.get(u'user'))
+
+    def get_listing(self, user: str, query: Hashable):
+        """Cached listing value for user's query"""
+        return self._get((u'listing', user, query))
+
+    def put_listing(self, user: str, query: Hashable, value):
+        """
+        Cache value for user's query
+        Kept for default_ttl whatever its jobs: jobs the user submits
+        elsewhere would be missing from it
+        """
+        self._put((u'listing', user, query), value, self.default_ttl, user)
+
+    def invalidate(self, job_id: str = None, user: str = None):
+        """Drop job_id and all cached listings of user"""
+        with self._lock:
+            keys = set(self._user_keys.get(user, ())) if user else set()
+            keys = {k for k in keys if k[0] == u'listing'}
+            if job_id is not None:
+                keys.add((u'job', job_id))
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._user_keys.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {u'hits': self.hits,
+                    u'misses': self.misses,
+                    u'evictions': self.evictions,
+                    u'invalidations': self.invalidations,
+                    u'entries': len(self._entries)}
@@ -0,0 +1,88 @@
+"""
+Process wide registry of shared platform clients
+Client construction (auth session, gRPC channel) is expensive, so jobs,
+databases and file storages share one client per (kind, project,
+credentials) instead of building their own
+
+Clients are dropped after a fork so that worker processes never share a
+channel with their parent
+Tests inject stand-in clients via register() and clear() them afterwards
+"""
+import os
+import threading
+
+
+class ClientRegistry:
+    """
+    Thread safe, fork safe cache of clients
+    get(): return the cached client for the key, constructing it once
+    register(): inject a client (e.g. a test fake) for the key
+    clear(): drop all cached clients
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        """Discard clients (and a possibly held lock) inherited via fork"""
+        if self._pid != os.getpid():
+            self._lock = threading.Lock()
+            self._clients = {}
+            self._pid = os.getpid()
+
+    def get(self, kind: str, factory, project: str = None,
+            credentials=None):
+        """
+        Return the client for (kind, project, credentials)
+        factory(project=, credentials=) is called at most once per key
+        """
+        self._check_fork()
+        key = (kind, project, credentials)
+        try:
+            return self._clients[key]
+        except KeyError:
+            pass
+
+        with self._lock:
+            if key not in self._clients:
+                kwargs = {}
+                if project is not None:
+                    kwargs['project'] = project
+                if credentials is not None:
+                    kwargs['credentials'] = credentials
+                self._clients[key] = factory(**kwargs)
+            return self._clients[key]
+
+    def register(self, kind: str, client, project: str = None,
+                 credentials=None):
+        """Use client for (kind, project, credentials) from now on"""
+        self._check_fork()
+        with self._lock:
+            self._clients[(kind, project, credentials)] = client
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+
+
+registry = ClientRegistry()
+
+FIRESTORE = 'firestore'
+STORAGE = 'storage'
+
+
+def firestore_client(project: str = None, credentials=None):
+    """Shared google firestore client"""
+    from google.cloud import firestore
+    return registry.get(FIRESTORE, firestore.Client, project, credentials)
+
+
+def storage_client(project: str = None, credentials=None):
+    """Shared google cloud storage client"""
+    from google.cloud import storage
+    return registry.get(STORAGE, storage.Client, project, credentials)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry._check_fork)
@@ -0,0 +1,127 @@
+"""
+Asyncio counterpart of Database
+AsyncJobPage: JobPage consumed with async for
+"""
+import itertools
+from typing import Callable, List, Optional
+
+from impression_web import aio, watch
+from impression_web.database.database import Database, JobPage
+from impression_web.job.async_job import AsyncJob
+
+
+class AsyncJobPage:
+    """
+    JobPage of AsyncJobs iterated with async for, documents are fetched
+    batch_size at a time off the event loop
+    next_token as for JobPage, once the page is exhausted
+    """
+    def __init__(self, page: JobPage, batch_size: int = 100):
+        self.page = page
+        self.batch_size = batch_size
+
+    @property
+    def next_token(self) -> Optional[str]:
+        return self.page.next_token
+
+    async def __aiter__(self):
+        jobs = iter(self.page)
+        while True:
+            batch = await aio.run(list,
+                                  itertools.islice(jobs, self.batch_size))
+            for job in batch:
+                yield AsyncJob(job)
+            if len(batch) < self.batch_size:
+                return
+
+
+class AsyncDatabase(aio.Counterpart):
+    """
+    Database (sync) whose methods are coroutines with the same arguments
+    and results, jobs returned are AsyncJobs and jobs or storages passed
+    in may be AsyncJobs/AsyncFileStorages
+    Listings (user_jobs, jobs_between) are AsyncJobPages
+
+    Platform calls run on the shared aio executor, see impression_web.aio
+    Created by ImpressionDatabaseFactory(platform, mode='async')
+    """
+    __slots__ = ()
+
+    def __init__(self, database: Database):
+        super().__init__(database)
+
+    async def _run(self, method: str, *args, **kwargs):
+        """Helper: await the database's method"""
+        if 'storage' in kwargs:
+            kwargs['storage'] = aio.unwrap(kwargs['storage'])
+        return await aio.run(getattr(self.sync, method), *args, **kwargs)
+
+    @staticmethod
+    def _job(job) -> Optional[AsyncJob]:
+        return None if job is None else AsyncJob(job)
+
+    async def user_job_ids(self, username: str) -> List[str]:
+        return await aio.run(
+            lambda: list(self.sync.user_job_ids(username)))
+
+    async def user_jobs(self, *args, **kwargs) -> AsyncJobPage:
+        return AsyncJobPage(await self._run('user_jobs', *args, **kwargs))
+
+    async def jobs_between(self, *args, **kwargs) -> AsyncJobPage:
+        return AsyncJobPage(await self._run('jobs_between', *args, **kwargs))
+
+    async def user_job_summaries(self, *args, **kwargs) -> List[dict]:
+        return await aio.run(
+            lambda: list(self.sync.user_job_summaries(*args, **kwargs)))
+
+    async def save_jobs(self, jobs, *args, **kwargs) -> List[str]:
+        return await self._run('save_jobs', [aio.unwrap(j) for j in jobs],
+                               *args, **kwargs)
+
+    async def delete_jobs(self, job_ids, storage=None,
+                          **kwargs) -> List[str]:
+        return await self._run('delete_jobs', job_ids, storage=storage,
+                               **kwargs)
+
+    async def delete_user_jobs(self, username: str, storage=None,
+                               **kwargs) -> List[str]:
+        return await self._run('delete_user_jobs', username,
+                               storage=storage, **kwargs)
+
+    async def shard_job(self, job, input_path, storage,
+                        **kwargs) -> List[AsyncJob]:
+        children = await self._run('shard_job', aio.unwrap(job), input_path,
+                                   storage=storage, **kwargs)
+        return [AsyncJob(child) for child in children]
+
+    async def merge_shards(self, job_id: str, storage,
+                           **kwargs) -> str:
+        return await self._run('merge_shards', job_id, storage=storage,
+                               **kwargs)
+
+    async def watch_user_jobs(self, username: str,
+                              callback: Callable) -> watch.Subscription:
+        """
+        See Database.watch_user_jobs: callback(job, previous_status) is
+        called with AsyncJobs on the current event loop and may be a
+        coroutine function
+        """
+        notify = aio.loop_callback(callback)
+        return await self._run(
+            'watch_user_jobs', username,
+            lambda job, previous: notify(AsyncJob(job), previous))
+
+    async def claim_next(self, *args, **kwargs) -> Optional[AsyncJob]:
+        return self._job(await self._run('claim_next', *args, **kwargs))
+
+    async def renew_lease(self, job, *args, **kwargs) -> AsyncJob:
+        return self._job(await self._run('renew_lease', aio.unwrap(job),
+                                         *args, **kwargs))
+
+    async def complete(self, job, storage=None, **kwargs) -> AsyncJob:
+        return self._job(await self._run('complete', aio.unwrap(job),
+                                         storage=storage, **kwargs))
+
+    async def fail(self, job, *args, **kwargs) -> AsyncJob:
+        return self._job(await self._run('fail', aio.unwrap(job),
+                                         *args, **kwargs))
@@ -1,7 +1,13 @@
 """
 Base class for database tooling
+JobPage: lazily streamed page of jobs with a continuation token
 """
 import abc
+import base64
+import calendar
+from datetime import datetime, timezone
+import json
+from typing import Callable, Iterable, Optional
 
 
 class Database(abc.ABC):
@@ -9,11 +15,177 @@ class Database(abc.ABC):
     Platform agnostic database tooling
     """
     @abc.abstractmethod
-    def user_job_ids(self, username) -> [int]:
+    def user_job_ids(self, username) -> [str]:
         """Return list of id belonging to the username"""
         pass
 
     @abc.abstractmethod
-    def user_jobs(self, username) -> [dict]:
-        """Return list of Job objects belonging to the username"""
+    def user_jobs(self, username, limit: int = None, order_by: str = None,
+                  start_after: str = None, status=None) -> 'JobPage':
+        """
+        Return JobPage of Job objects belonging to the username
+        limit: page size (all jobs when None)
+        order_by: field to order by (document id when None)
+        start_after: next_token of the previous page
+        status: only jobs with this JobStatus
+        """
         pass
+
+    @abc.abstractmethod
+    def jobs_between(self, start, end, username=None,
+                     field='submission_time', limit: int = None,
+                     start_after: str = None) -> 'JobPage':
+        """
+        Return JobPage of Job objects whose time field is in [start, end),
+        ordered by that field
+        """
+        pass
+
+    @abc.abstractmethod
+    def user_job_summaries(self, username, fields) -> [dict]:
+        """Return dicts of only the requested fields of username's jobs"""
+        pass
+
+    @abc.abstractmethod
+    def save_jobs(self, jobs) -> [str]:
+        """Create/update many jobs, return their job ids in order"""
+        pass
+
+    @abc.abstractmethod
+    def delete_jobs(self, job_ids, storage=None) -> [str]:
+        """Delete many jobs (and their files from storage if given)"""
+        pass
+
+    @abc.abstractmethod
+    def delete_user_jobs(self, username, storage=None) -> [str]:
+        """Delete all jobs of username (and their files if storage given)"""
+        pass
+
+    @abc.abstractmethod
+    def shard_job(self, job, input_path, storage, shards=None,
+                  max_records=None) -> list:
+        """
+        Split job's SDF input into child jobs at record boundaries,
+        completing job once all children are, return the children
+        """
+        pass
+
+    @abc.abstractmethod
+    def merge_shards(self, job_id, storage, url_lifetime=None,
+                     merged_name=None) -> str:
+        """
+        Concatenate the outputs of the shards of job_id, in order, into
+        its output file, return its name
+        """
+        pass
+
+    @abc.abstractmethod
+    def watch_user_jobs(self, username, callback):
+        """
+        Call callback(job, previous_status) on status changes of any job
+        belonging to username, return a subscription with unsubscribe()
+        """
+        pass
+
+    @abc.abstractmethod
+    def claim_next(self, worker_id, model=None, lease_seconds=None):
+        """Atomically lease the next QUEUED job to worker_id (or None)"""
+        pass
+
+    @abc.abstractmethod
+    def renew_lease(self, job, lease_seconds=None):
+        """Extend the lease held on job by job.worker_id"""
+        pass
+
+    @abc.abstractmethod
+    def complete(self, job):
+        """Mark a leased job FINISHED and release the lease"""
+        pass
+
+    @abc.abstractmethod
+    def fail(self, job, err=None):
+        """Mark a leased job ERROR and release the lease"""
+        pass
+
+
+class JobPage:
+    """
+    A page of jobs, streamed lazily from the database
+    Iterating yields jobs; once exhausted next_token holds an opaque
+    continuation token for the following page (None on the last page)
+
+    The page is fed at most limit + 1 documents: the extra document only
+    signals that another page exists
+    on_complete(page) is called once the page has been fully consumed
+    """
+    def __init__(self, documents: Iterable, decode: Callable,
+                 limit: int = None, cursor: Callable = None,
+                 next_token: str = None, on_complete: Callable = None):
+        self._documents = documents
+        self._decode = decode
+        self._limit = limit
+        self._cursor = cursor
+        self._on_complete = on_complete
+        self._consumed = False
+        self.next_token: Optional[str] = next_token
+
+    def __iter__(self):
+        if self._consumed:
+            raise RuntimeError('JobPage can only be iterated once')
+        self._consumed = True
+
+        last = None
+        for count, document in enumerate(self._documents):
+            if self._limit is not None and count == self._limit:
+                self.next_token = self._cursor(last)
+                break
+            last = document
+            yield self._decode(document)
+
+        if self._on_complete is not None:
+            self._on_complete(self)
+
+
+# json key of datetime cursor values: [epoch seconds, microseconds]
+_DATETIME_KEY = '$t'
+
+
+def _encode_datetime(value):
+    """json default: datetimes as exact UTC epoch seconds"""
+    if isinstance(value, datetime):
+        value = value.astimezone(timezone.utc)
+        return {_DATETIME_KEY: [calendar.timegm(value.utctimetuple()),
+                                value.microsecond]}
+    raise TypeError(f'Not json serializable: {value!r}')
+
+
+def _decode_datetime(obj: dict):
+    """json object_hook inverting _encode_datetime"""
+    if len(obj) == 1 and _DATETIME_KEY in obj:
+        seconds, microsecond = obj[_DATETIME_KEY]
+        return datetime.fromtimestamp(seconds, timezone.utc).replace(
+            microsecond=microsecond)
+    return obj
+
+
+def encode_token(values: list) -> str:
+    """
+    Opaque, url safe continuation token from json-able (or datetime)
+    cursor values
+    """
+    raw = json.dumps(values, separators=(',', ':'),
+                     default=_encode_datetime).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_token(token: str) -> list:
+    """Cursor values from encode_token, raise ValueError if malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token.encode()),
+                            object_hook=_decode_datetime)
+    except (TypeError, ValueError, UnicodeDecodeError, OverflowError,
+            OSError) as e:
+        raise ValueError(f'Invalid continuation token: {token}') from e
+    if not isinstance(values, list):
+        raise ValueError(f'Invalid continuation token: {token}')
+    return values
@@ -1,17 +1,21 @@
 """
 Factory of platform specific database objects
 """
+from impression_web import aio
+from impression_web.database.async_database import AsyncDatabase
 from impression_web.database.gcp_database import GCPDatabase
 
 
 class ImpressionDatabaseFactory:
     """
     Platform specific Database objects
-    database() creates instances for the chosen platform
+    database() creates instances for the chosen platform, AsyncDatabases
+    with mode='async'
     """
-    def __init__(self, platform):
+    def __init__(self, platform, mode: str = aio.SYNC):
         self.platform = platform
         self.cls_ = ImpressionDatabaseFactory._select(platform)
+        self.mode = aio.check_mode(mode)
 
     @staticmethod
     def _select(platform):
@@ -22,4 +26,7 @@ class ImpressionDatabaseFactory:
                 f'Invalid platform: {platform}')
 
     def database(self, *args, **kwargs):
-        return self.cls_(*args, **kwargs)
+        database = self.cls_(*args, **kwargs)
+        if self.mode == aio.ASYNC:
+            return AsyncDatabase(database)
+        return database
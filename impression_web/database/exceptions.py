@@ -0,0 +1,8 @@
+"""
+Exceptions relating to the database work queue
+"""
+
+
+class LeaseError(Exception):
+    """Job is not (or no longer) leased by the worker"""
+    pass
@@ -0,0 +1,554 @@
+"""
+In-process stand-in for the google firestore client
+Implements the subset of the client API used by GCPJob and GCPDatabase
+so that job and database code can be exercised (and benchmarked) offline
+"""
+import copy
+import datetime
+import enum
+import threading
+import time
+import uuid
+
+import google.api_core.exceptions
+
+
+# firestore.FieldPath.document_id()
+FIELD_PATH_DOCUMENT_ID = '__name__'
+
+
+def _now() -> datetime.datetime:
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _type_order(value) -> int:
+    """Rank of the type of value in firestore's cross-type value order"""
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, datetime.datetime):
+        return 3
+    if isinstance(value, str):
+        return 4
+    if isinstance(value, bytes):
+        return 5
+    return 6
+
+
+def _sort_key(value):
+    """Key ordering values as firestore does (by type first)"""
+    return _type_order(value), value
+
+
+def _comparable(a, b) -> bool:
+    """Range filters only match values of the operand's type"""
+    return a is not None and _type_order(a) == _type_order(b)
+
+
+class FakeWriteResult:
+    """Result of a single document write"""
+    def __init__(self, update_time: datetime.datetime):
+        self.update_time = update_time
+
+
+class FakeWriteOption:
+    """Write precondition on the last update time of a document"""
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+
+class FakeDocumentSnapshot:
+    """Point in time copy of a document"""
+    def __init__(self, reference, data: dict = None,
+                 update_time: datetime.datetime = None):
+        self.reference = reference
+        self._data = data
+        self.update_time = update_time
+        self.read_time = _now()
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def get(self, field_path: str):
+        return self._data[field_path]
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+class FakeDocumentReference:
+    """Reference to a single document path"""
+    def __init__(self, client, path: str):
+        self._client = client
+        self.path = path
+
+    @property
+    def id(self) -> str:
+        return self.path.rsplit('/', 1)[-1]
+
+    def __eq__(self, other):
+        return (isinstance(other, FakeDocumentReference) and
+                other._client is self._client and other.path == self.path)
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def get(self, field_paths=None, transaction=None) -> FakeDocumentSnapshot:
+        self._client._round_trip()
+        snapshot = self._client._snapshot(self, field_paths)
+        if transaction is not None:
+            transaction._record_read(snapshot)
+        return snapshot
+
+    def set(self, document_data: dict, merge=False) -> FakeWriteResult:
+        self._client._round_trip()
+        return self._client._commit([(self, 'set', document_data)])[0]
+
+    def update(self, field_updates: dict, option=None) -> FakeWriteResult:
+        self._client._round_trip()
+        preconditions = None
+        if option is not None:
+            preconditions = {self.path: option.last_update_time}
+        return self._client._commit([(self, 'update', field_updates)],
+                                    preconditions=preconditions)[0]
+
+    def delete(self) -> FakeWriteResult:
+        self._client._round_trip()
+        return self._client._commit([(self, 'delete', None)])[0]
+
+    def on_snapshot(self, callback) -> 'FakeWatch':
+        """Listen for changes to this document"""
+        return self._client._listen(
+            lambda: [s for s in [self._client._snapshot(self)] if s.exists],
+            callback)
+
+
+class FakeQuery:
+    """Filtered, ordered and paginated view over a collection"""
+    ASCENDING = 'ASCENDING'
+    DESCENDING = 'DESCENDING'
+
+    _OPERATORS = {
+        '==': lambda a, b: a == b,
+        '!=': lambda a, b: a != b,
+        '<': lambda a, b: _comparable(a, b) and a < b,
+        '<=': lambda a, b: _comparable(a, b) and a <= b,
+        '>': lambda a, b: _comparable(a, b) and a > b,
+        '>=': lambda a, b: _comparable(a, b) and a >= b,
+        'in': lambda a, b: a in b,
+    }
+
+    def __init__(self, client, collection_path: str):
+        self._client = client
+        self._collection_path = collection_path
+        self._filters = ()
+        self._orders = ()
+        self._limit = None
+        self._start_after = None
+        self._projection = None
+
+    def _copy(self, **kwargs):
+        query = copy.copy(self)
+        query.__dict__.update(kwargs)
+        return query
+
+    def where(self, field_path: str, op_string: str, value):
+        if op_string not in FakeQuery._OPERATORS:
+            raise ValueError(f'Unsupported operator: {op_string}')
+        return self._copy(
+            _filters=self._filters + ((field_path, op_string, value),))
+
+    def select(self, field_paths):
+        # as firestore, an empty projection returns whole documents
+        return self._copy(_projection=tuple(field_paths) or None)
+
+    def order_by(self, field_path: str, direction: str = ASCENDING):
+        return self._copy(
+            _orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int):
+        return self._copy(_limit=count)
+
+    def start_after(self, document_fields):
+        if isinstance(document_fields, FakeDocumentSnapshot):
+            snapshot = document_fields
+            document_fields = snapshot.to_dict()
+            document_fields[FIELD_PATH_DOCUMENT_ID] = snapshot.id
+        return self._copy(_start_after=dict(document_fields))
+
+    def _matches(self, data: dict) -> bool:
+        return all(FakeQuery._OPERATORS[op](data.get(field), value)
+                   for field, op, value in self._filters)
+
+    def _normalized_orders(self):
+        """Orders with the implicit trailing document id order"""
+        orders = list(self._orders)
+        if FIELD_PATH_DOCUMENT_ID not in (field for field, _ in orders):
+            direction = orders[-1][1] if orders else FakeQuery.ASCENDING
+            orders.append((FIELD_PATH_DOCUMENT_ID, direction))
+        return orders
+
+    @staticmethod
+    def _value(ref, data: dict, field: str):
+        if field == FIELD_PATH_DOCUMENT_ID:
+            return ref.id
+        return data.get(field)
+
+    @staticmethod
+    def _compare(a, b) -> int:
+        """Order values as firestore does: by type, null first"""
+        a, b = _sort_key(a), _sort_key(b)
+        return (a > b) - (a < b)
+
+    def _after_cursor(self, ref, data, orders) -> bool:
+        for field, direction in orders:
+            if field not in self._start_after:
+                break
+            order = self._compare(self._value(ref, data, field),
+                                  self._start_after[field])
+            if direction == FakeQuery.DESCENDING:
+                order = -order
+            if order:
+                return order > 0
+        return False
+
+    def stream(self, transaction=None):
+        self._client._round_trip()
+        for snapshot in self._results():
+            if transaction is not None:
+                transaction._record_read(snapshot)
+            yield snapshot
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction))
+
+    def on_snapshot(self, callback) -> 'FakeWatch':
+        """Listen for changes to the query results"""
+        return self._client._listen(self._results, callback)
+
+    def _results(self) -> [FakeDocumentSnapshot]:
+        """Helper: evaluate the query"""
+        items = [(ref, data, update_time) for ref, data, update_time in
+                 self._client._collection_items(self._collection_path)
+                 if self._matches(data)]
+
+        orders = self._normalized_orders()
+        # firestore excludes documents missing an ordered field
+        items = [item for item in items
+                 if all(field == FIELD_PATH_DOCUMENT_ID or field in item[1]
+                        for field, _ in orders)]
+        for field, direction in reversed(orders):
+            items.sort(key=lambda item: _sort_key(
+                self._value(item[0], item[1], field)),
+                reverse=direction == FakeQuery.DESCENDING)
+
+        if self._start_after is not None:
+            items = [item for item in items
+                     if self._after_cursor(item[0], item[1], orders)]
+        if self._limit is not None:
+            items = items[:self._limit]
+
+        if self._projection is not None:
+            items = [(ref, {field: data[field] for field in self._projection
+                            if field in data}, update_time)
+                     for ref, data, update_time in items]
+        return [FakeDocumentSnapshot(ref, data, update_time)
+                for ref, data, update_time in items]
+
+
+class FakeCollectionReference(FakeQuery):
+    """Reference to a collection of documents"""
+    def __init__(self, client, path: str):
+        super().__init__(client, path)
+
+    @property
+    def id(self) -> str:
+        return self._collection_path.rsplit('/', 1)[-1]
+
+    def document(self, document_id: str = None) -> FakeDocumentReference:
+        if document_id is None:
+            document_id = uuid.uuid4().hex[:20]
+        return FakeDocumentReference(
+            self._client, f'{self._collection_path}/{document_id}')
+
+    def list_documents(self, page_size=None):
+        return [ref for ref, _, _ in
+                self._client._collection_items(self._collection_path)]
+
+
+class FakeWriteBatch:
+    """Accumulate writes and apply them in a single round trip"""
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def set(self, reference, document_data: dict, merge=False):
+        self._writes.append((reference, 'set', document_data))
+
+    def update(self, reference, field_updates: dict):
+        self._writes.append((reference, 'update', field_updates))
+
+    def delete(self, reference):
+        self._writes.append((reference, 'delete', None))
+
+    def commit(self) -> [FakeWriteResult]:
+        if len(self._writes) > FakeFirestoreClient.MAX_BATCH_WRITES:
+            raise ValueError(
+                f'Batch exceeds {FakeFirestoreClient.MAX_BATCH_WRITES} writes')
+        self._client._round_trip()
+        writes, self._writes = self._writes, []
+        return self._client._commit(writes)
+
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    Optimistic transaction compatible with firestore.transactional
+    Commit aborts (and is retried by firestore.transactional) if any
+    document read within the transaction changed before the commit
+    """
+    def __init__(self, client, max_attempts: int = 5, read_only=False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+        self._reads = {}
+
+    @property
+    def in_progress(self) -> bool:
+        return self._id is not None
+
+    @property
+    def id(self):
+        return self._id
+
+    def _record_read(self, snapshot: FakeDocumentSnapshot):
+        self._reads.setdefault(snapshot.reference.path, snapshot.update_time)
+
+    def _clean_up(self):
+        self._writes = []
+        self._reads = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        if self.in_progress:
+            raise ValueError('Transaction already in progress')
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self):
+        self._clean_up()
+
+    def _commit(self) -> [FakeWriteResult]:
+        if not self.in_progress:
+            raise ValueError('Transaction not in progress')
+        self._client._round_trip()
+        writes, reads = self._writes, self._reads
+        self._clean_up()
+        return self._client._commit(writes, reads)
+
+
+class ChangeType(enum.Enum):
+    ADDED = 1
+    REMOVED = 2
+    MODIFIED = 3
+
+
+class FakeDocumentChange:
+    def __init__(self, type: ChangeType, document: FakeDocumentSnapshot):
+        self.type = type
+        self.document = document
+
+
+class FakeWatch:
+    """
+    Snapshot listener, called synchronously after every commit
+    callback(docs, changes, read_time) as for firestore listeners
+    """
+    def __init__(self, client, evaluate, callback):
+        self._client = client
+        self._evaluate = evaluate
+        self._callback = callback
+        # re-entrant: callbacks may unsubscribe
+        self._lock = threading.RLock()
+        self._state = None
+
+    def _push(self):
+        with self._lock:
+            if self._callback is None:
+                return
+            with self._client._lock:
+                docs = self._evaluate()
+            state = {doc.reference.path: doc for doc in docs}
+            previous = self._state or {}
+
+            changes = [FakeDocumentChange(ChangeType.REMOVED, doc)
+                       for path, doc in previous.items() if path not in state]
+            for path, doc in state.items():
+                if path not in previous:
+                    changes.append(FakeDocumentChange(ChangeType.ADDED, doc))
+                elif previous[path].update_time != doc.update_time:
+                    changes.append(
+                        FakeDocumentChange(ChangeType.MODIFIED, doc))
+
+            initial = self._state is None
+            self._state = state
+            if changes or initial:
+                self._callback(docs, changes, _now())
+
+    def unsubscribe(self):
+        with self._lock:
+            self._callback = None
+        with self._client._lock:
+            self._client._watches.remove(self)
+
+
+class FakeFirestoreClient:
+    """
+    Thread safe, in-memory replacement for firestore.Client
+    round_trips counts the number of simulated requests to the server
+
+    latency: seconds each request waits, outside the client's lock so
+        that concurrent requests overlap as they would over the network
+    """
+    MAX_BATCH_WRITES = 500
+
+    def __init__(self, project: str = 'fake-project', latency: float = 0.0):
+        self.project = project
+        self.latency = latency
+        self.round_trips = 0
+        self._documents = {}
+        self._lock = threading.RLock()
+        self._last_update_time = None
+        self._watches = []
+
+    def collection(self, collection_path: str) -> FakeCollectionReference:
+        return FakeCollectionReference(self, collection_path)
+
+    def document(self, document_path: str) -> FakeDocumentReference:
+        return FakeDocumentReference(self, document_path)
+
+    def batch(self) -> FakeWriteBatch:
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs) -> FakeTransaction:
+        return FakeTransaction(self, **kwargs)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        """Fetch many documents in a single round trip"""
+        self._round_trip()
+        for reference in references:
+            yield self._snapshot(reference, field_paths)
+
+    def _round_trip(self):
+        with self._lock:
+            self.round_trips += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _snapshot(self, reference, field_paths=None) -> FakeDocumentSnapshot:
+        with self._lock:
+            data, update_time = self._documents.get(
+                reference.path, (None, None))
+        if data is not None and field_paths is not None:
+            data = {k: v for k, v in data.items() if k in field_paths}
+        return FakeDocumentSnapshot(reference, data, update_time)
+
+    def _collection_items(self, collection_path: str):
+        prefix = collection_path + '/'
+        with self._lock:
+            items = [(path, data, update_time)
+                     for path, (data, update_time) in self._documents.items()
+                     if path.startswith(prefix) and
+                     '/' not in path[len(prefix):]]
+        # firestore returns documents ordered by their id by default
+        items.sort(key=lambda item: item[0])
+        return [(FakeDocumentReference(self, path), data, update_time)
+                for path, data, update_time in items]
+
+    def write_option(self, last_update_time=None) -> FakeWriteOption:
+        return FakeWriteOption(last_update_time)
+
+    def _commit(self, writes, reads: dict = None,
+                preconditions: dict = None) -> [FakeWriteResult]:
+        """
+        Apply writes atomically, then notify listeners
+        reads: path -> update_time, abort if any document has changed
+        preconditions: path -> update_time, fail if any document changed
+        """
+        with self._lock:
+            for path, update_time in (reads or {}).items():
+                current = self._documents.get(path, (None, None))[1]
+                if current != update_time:
+                    raise google.api_core.exceptions.Aborted(
+                        f'{path} changed during transaction')
+            for path, update_time in (preconditions or {}).items():
+                current = self._documents.get(path, (None, None))[1]
+                if current is not None and current != update_time:
+                    raise google.api_core.exceptions.FailedPrecondition(
+                        f'{path} updated since {update_time}')
+
+            # all or nothing: check updated documents exist before writing
+            existing = set(self._documents)
+            for ref, op, _ in writes:
+                if op == 'update' and ref.path not in existing:
+                    raise google.api_core.exceptions.NotFound(
+                        f'{ref.path} does not exist')
+                elif op == 'set':
+                    existing.add(ref.path)
+                elif op == 'delete':
+                    existing.discard(ref.path)
+
+            results = [self._write(ref, op, data)
+                       for ref, op, data in writes]
+
+        if writes:
+            self._notify()
+        return results
+
+    def _listen(self, evaluate, callback) -> 'FakeWatch':
+        watch = FakeWatch(self, evaluate, callback)
+        with self._lock:
+            self._watches.append(watch)
+        watch._push()
+        return watch
+
+    def _notify(self):
+        with self._lock:
+            watches = list(self._watches)
+        for watch in watches:
+            watch._push()
+
+    def _write(self, reference, op: str, data: dict = None):
+        with self._lock:
+            # update times are unique so that transactions detect changes
+            update_time = _now()
+            if (self._last_update_time is not None and
+                    update_time <= self._last_update_time):
+                update_time = (self._last_update_time +
+                               datetime.timedelta(microseconds=1))
+            self._last_update_time = update_time
+            if op == 'set':
+                self._documents[reference.path] = (
+                    copy.deepcopy(data), update_time)
+            elif op == 'update':
+                try:
+                    current, _ = self._documents[reference.path]
+                except KeyError:
+                    raise google.api_core.exceptions.NotFound(
+                        f'{reference.path} does not exist')
+                current = dict(current)
+                current.update(copy.deepcopy(data))
+                self._documents[reference.path] = (current, update_time)
+            elif op == 'delete':
+                self._documents.pop(reference.path, None)
+        return FakeWriteResult(update_time)
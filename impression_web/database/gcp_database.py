@@ -1,29 +1,64 @@
 """
 Google firestore access
 """
-from typing import Iterable
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import logging
+import pathlib
+import time
+from typing import Callable, Iterable, List, Optional
 
 from google.cloud import firestore
 
-from impression_web.database.database import Database
+from impression_web import cache, clients, instrumentation, sdf, \
+    sharding, watch
+from impression_web.cache import JobCache
+from impression_web.database.database import Database, JobPage, \
+    decode_token, encode_token
+from impression_web.database.exceptions import LeaseError
+from impression_web.job.exceptions import JobCreationError
 from impression_web.job.gcp_job import GCPJob
+from impression_web.job.job import Job, JobStatus
+from impression_web.job.schema import TIME
+from impression_web.storage.exceptions import FileTransferError
+from impression_web.storage.file_storage import ImpressionFileStorage
+from impression_web.storage.signing import DEFAULT_URL_LIFETIME
+from impression_web.storage.transfer import DEFAULT_MAX_WORKERS
+
+logger = logging.getLogger(__name__)
 
 
 class GCPDatabase(Database):
     """
     Database management for Google Cloud Platform NoSQL document database
-    Overloads user_job_ids and user_jobs methods from parent
+    Overloads user_job_ids, user_jobs, jobs_between, user_job_summaries,
+    save_jobs, delete_jobs, delete_user_jobs, watch_user_jobs, shard_job,
+    merge_shards and the work queue methods (claim_next, renew_lease,
+    complete, fail) from parent
 
     """
     J_COLLECTION_PATH = u'jobs'
+    # Field path of the document id (FieldPath.document_id())
+    DOCUMENT_ID = u'__name__'
+    SUMMARY_FIELDS = (u'job_id', u'status', u'model', u'submission_time')
+    DEFAULT_LEASE_SECONDS = 600
+    # Queries for candidates before claim_next gives up on contention
+    CLAIM_ROUNDS = 5
+    TIME_FIELDS = tuple(f.name for f in Job.SCHEMA if f.kind == TIME)
 
-    def __init__(self):
-        self._db = None
+    def __init__(self, db: firestore.Client = None,
+                 cache: JobCache = None):
+        """
+        db: firestore client, the shared client when None
+        cache: optional read-through cache for user_jobs listings
+        """
+        self._db = db
+        self.cache = cache
 
     @property
     def db(self):
         if self._db is None:
-            self._db = firestore.Client()
+            self._db = clients.firestore_client()
 
         return self._db
 
@@ -35,22 +70,648 @@ class GCPDatabase(Database):
         """Get reference to specific job_id"""
         return self._jobs_collection().document(job_id)
 
-    def user_job_ids(self, username: str) -> Iterable[int]:
+    def user_job_ids(self, username: str) -> Iterable[str]:
         """Return iterator of job id associated with username"""
-        jobs = self._user_jobs(username)
+        jobs = self._user_jobs(username, fields=[GCPDatabase.DOCUMENT_ID])
         return GCPDatabase._ids_from_jobs(jobs)
 
-    def user_jobs(self, username: str) -> Iterable[GCPJob]:
-        """return iterator of Job instances associated with username"""
-        jobs = self._user_jobs(username)
-        return (GCPJob.from_dict(j.to_dict()) for j in jobs)
+    def user_job_summaries(self, username: str,
+                           fields: Iterable[str] = SUMMARY_FIELDS,
+                           status: JobStatus = None) -> Iterable[dict]:
+        """
+        Return iterator of dicts holding only fields of each job associated
+        with username, values as stored in the database
+        Only the requested fields are transferred (projection query)
+        """
+        fields = list(fields)
+        unknown = set(fields).difference(Job.FIELDS)
+        if unknown:
+            raise ValueError(f'Unknown job fields: {sorted(unknown)}')
+
+        jobs = self._user_jobs(username, fields=fields, status=status)
+        return (j.to_dict() for j in jobs)
+
+    def user_jobs(self, username: str, limit: int = None,
+                  order_by: str = None, start_after: str = None,
+                  status: JobStatus = None,
+                  descending: bool = False) -> JobPage:
+        """
+        Return JobPage of Job instances associated with username
+        Documents are streamed, so memory scales with the page size
+
+        limit: page size, all jobs when None
+        order_by: field to order by, ties (and None) by document id
+        start_after: next_token from the previous page of the same query
+        status: only jobs with this status
+        descending: reverse the ordering
+
+        Ordering by a field other than the document id requires a
+        composite index on (user, [status,] order_by) in firestore
+        """
+        if limit is not None and limit < 1:
+            raise ValueError(f'limit must be positive: {limit}')
+
+        listing = (limit, order_by, start_after,
+                   None if status is None else JobStatus(status).value,
+                   descending)
+        if self.cache is not None:
+            cached = self.cache.get_listing(username, listing)
+            if cached is not None:
+                entries, next_token = cached
+                return JobPage(entries, self._from_cached,
+                               next_token=next_token)
+
+        query = self._jobs_collection().where(u'user', u'==', username)
+        if status is not None:
+            query = query.where(u'status', u'==', JobStatus(status).value)
+        query, cursor = GCPDatabase._paginate(query, order_by, limit,
+                                              start_after, descending)
+
+        stream = instrumentation.iterate(query.stream(),
+                                         u'GCPDatabase.user_jobs')
+        if self.cache is None:
+            return JobPage(stream,
+                           lambda j: GCPJob.from_snapshot(j, self.db),
+                           limit, cursor)
+
+        # Record the documents of the page, and the update time they were
+        # read at, to cache once it is consumed
+        entries = []
+
+        def decode(snapshot: firestore.DocumentSnapshot) -> GCPJob:
+            job = GCPJob.from_snapshot(snapshot, self.db)
+            entries.append((job.to_dict(), job._update_time))
+            return job
+
+        def on_complete(page: JobPage):
+            self.cache.put_listing(username, listing,
+                                   (entries, page.next_token))
+
+        return JobPage(stream, decode, limit, cursor,
+                       on_complete=on_complete)
+
+    def _from_cached(self, entry: tuple) -> GCPJob:
+        """
+        Helper: job of a cached (document, update_time), in sync with its
+        entry as of update_time so that updates stay partial
+        """
+        document, update_time = entry
+        job = GCPJob.from_dict(document, self.db)
+        job._mark_synced(update_time)
+        return job
+
+    def jobs_between(self, start: datetime, end: datetime,
+                     username: str = None,
+                     field: str = u'submission_time', limit: int = None,
+                     start_after: str = None,
+                     descending: bool = False) -> JobPage:
+        """
+        Return JobPage of jobs (of username, if given) whose time field is
+        in [start, end), ordered by field on the server
+        Naive start/end are local time, see Job._timetodb
+
+        Only native timestamps are matched: jobs still holding legacy
+        string times are not, see migrate_timestamps
+        Filtering on username requires a composite index on (user, field)
+        """
+        if field not in GCPDatabase.TIME_FIELDS:
+            raise ValueError(f'Not a time field: {field}')
+        if limit is not None and limit < 1:
+            raise ValueError(f'limit must be positive: {limit}')
+
+        query = self._jobs_collection()
+        if username is not None:
+            query = query.where(u'user', u'==', username)
+        query = query.where(field, u'>=', Job._timetodb(start)).where(
+            field, u'<', Job._timetodb(end))
+        query, cursor = GCPDatabase._paginate(query, field, limit,
+                                              start_after, descending)
+        return JobPage(instrumentation.iterate(query.stream(),
+                                               u'GCPDatabase.jobs_between'),
+                       lambda j: GCPJob.from_snapshot(j, self.db),
+                       limit, cursor)
+
+    def migrate_timestamps(self, max_workers: int = None) -> List[str]:
+        """
+        Rewrite legacy _datetime_format string times as native timestamps
+        (read as local time) with batched updates
+        Return the ids of the migrated jobs
+        """
+        fields = list(GCPDatabase.TIME_FIELDS)
+        updates = []
+        for snapshot in self._jobs_collection().select(
+                fields + [u'user']).stream():
+            data = snapshot.to_dict()
+            update = {f: Job._timetodb(Job._timefromdb(data[f]))
+                      for f in fields if isinstance(data.get(f), str)}
+            if update:
+                updates.append((snapshot, update))
+
+        GCPJob._commit_batches(
+            self.db, updates,
+            lambda batch, item: batch.update(item[0].reference, item[1]),
+            max_workers=max_workers)
+        for snapshot, _ in updates:
+            cache.invalidate(snapshot.id, snapshot.to_dict().get(u'user'))
+        return [snapshot.id for snapshot, _ in updates]
+
+    @instrumentation.instrumented
+    def save_jobs(self, jobs: Iterable[GCPJob],
+                  max_workers: int = None) -> List[str]:
+        """
+        Create/update jobs with batched commits (committed in parallel)
+        Return the job ids, including any newly assigned, in order
+        Raises JobWriteError if some batches failed, see
+        GCPJob.update_many
+        """
+        return GCPJob.update_many(jobs, db=self.db, max_workers=max_workers)
+
+    @instrumentation.instrumented
+    def shard_job(self, job: GCPJob, input_path: pathlib.PurePath,
+                  storage: ImpressionFileStorage, shards: int = None,
+                  max_records: int = None,
+                  max_workers: int = DEFAULT_MAX_WORKERS) -> List[GCPJob]:
+        """
+        Split the SDF input at input_path into QUEUED child jobs of job at
+        record boundaries: shards children, or as many as keep each within
+        max_records records
+        The children's inputs are uploaded in parallel, then job (now
+        STARTED, tracking shard_progress, its lease released) and its
+        children are saved in batched writes
+        Children finishing through complete/fail count towards job, which
+        becomes FINISHED once all did (ERROR if any failed)
+        Return the children in input order
+
+        Raises JobCreationError if the input holds no records
+        Raises FileTransferError if uploading failed (nothing is saved)
+        """
+        index = sdf.SDFIndex.from_file(input_path)
+        ranges = sharding.plan(len(index), shards, max_records)
+        if not ranges:
+            raise JobCreationError(f'{input_path} holds no records')
+
+        if job.job_id is None:
+            # Passing None to document() generates a job-id client side
+            job.job_id = self._jobs_collection().document().id
+        suffix = pathlib.PurePath(input_path).suffix
+        names = sharding.upload_shards(
+            storage, input_path, ranges,
+            [sharding.shard_name(job.job_id, i, suffix)
+             for i in range(len(ranges))], index, max_workers)
+
+        now = datetime.now()
+        children = []
+        for shard_index, name in enumerate(names):
+            child = GCPJob(job.user, {u'input_name': job.input_name,
+                                      u'upload_name': name}, job.model)
+            child.parent_id = job.job_id
+            child.shard_index = shard_index
+            child.status = JobStatus.QUEUED
+            child.submission_time = now
+            children.append(child)
+
+        job.shards = len(children)
+        job.shards_finished = 0
+        job.shards_failed = 0
+        job.status = JobStatus.STARTED
+        job.start_time = now
+        # only the children are worked on: release any lease on job
+        job.worker_id = None
+        job.lease_expiry = None
+        try:
+            self.save_jobs([job] + children)
+        except Exception:
+            storage.delete_many(names, max_workers=max_workers)
+            raise
+        return children
+
+    @instrumentation.instrumented
+    def delete_jobs(self, job_ids: Iterable[str],
+                    storage: ImpressionFileStorage = None,
+                    max_workers: int = None) -> List[str]:
+        """
+        Delete many jobs with batched deletes committed in parallel
+        With storage, the jobs' input (upload_name) and output
+        (output_name) files are deleted too
+        Return the deleted job ids
+        """
+        job_ids = list(dict.fromkeys(job_ids))
+        files = []
+        # owners are needed to invalidate cached listings
+        if (storage is not None or cache.active()) and job_ids:
+            snapshots = self.db.get_all(
+                [self._job_reference(job_id) for job_id in job_ids],
+                field_paths=[u'user', u'upload_name', u'output_name'])
+            files = [s.to_dict() for s in snapshots if s.exists]
+            instrumentation.record(documents_read=len(job_ids))
+        return self._delete(job_ids, files, storage, max_workers)
+
+    @instrumentation.instrumented
+    def delete_user_jobs(self, username: str,
+                         storage: ImpressionFileStorage = None,
+                         max_workers: int = None) -> List[str]:
+        """
+        Delete all jobs associated with username, see delete_jobs
+        Return the deleted job ids
+        """
+        fields = ([u'upload_name', u'output_name'] if storage
+                  else [GCPDatabase.DOCUMENT_ID])
+        snapshots = list(self._user_jobs(username, fields=fields))
+        files = [dict(s.to_dict(), user=username) for s in snapshots]
+        return self._delete([s.id for s in snapshots], files, storage,
+                            max_workers)
+
+    def _delete(self, job_ids: List[str], files: List[dict],
+                storage: Optional[ImpressionFileStorage],
+                max_workers: int = None) -> List[str]:
+        """
+        Helper: batched delete of job_ids, then of the upload/output
+        files named in files from storage
+        """
+        GCPJob._commit_batches(
+            self.db, [self._job_reference(job_id) for job_id in job_ids],
+            lambda batch, ref: batch.delete(ref), max_workers=max_workers)
+        instrumentation.record(documents_deleted=len(job_ids))
+
+        for job_id in job_ids:
+            cache.invalidate(job_id)
+        for document in files:
+            cache.invalidate(user=document.get(u'user'))
+
+        deletes = []
+        if storage is None:
+            files = []
+        for document in files:
+            if document.get(u'upload_name'):
+                deletes.append((storage.delete_input_file,
+                                document[u'upload_name']))
+            if document.get(u'output_name'):
+                deletes.append((storage.delete_output_file,
+                                document[u'output_name']))
+
+        def delete_file(delete):
+            try:
+                delete[0](delete[1])
+            except FileTransferError:
+                pass  # already gone
+
+        if deletes:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(delete_file, deletes))
+
+        return job_ids
+
+    def watch_user_jobs(self, username: str,
+                        callback: Callable) -> watch.Subscription:
+        """
+        Call callback(job, previous_status) on each status change of a job
+        associated with username, starting with the current state of
+        every job (previous_status None)
+        All watchers of a user share one snapshot listener
+        """
+        query = self._jobs_collection().where(u'user', u'==', username)
+        return watch.hub.subscribe(
+            (self.db, u'user', username), query.on_snapshot,
+            lambda snapshot: GCPJob.from_snapshot(snapshot, self.db),
+            callback)
+
+    @instrumentation.instrumented
+    def claim_next(self, worker_id: str, model: str = None,
+                   lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                   candidates: int = 10) -> Optional[GCPJob]:
+        """
+        Atomically claim the oldest QUEUED job (of model, if given)
+        Jobs whose lease expired are only re-queued (see requeue_expired)
+        once no job is QUEUED
+        The claimed job moves QUEUED -> STARTED in a transaction with
+        worker_id, lease_expiry and start_time set; its update time is
+        unknown, reload it before updating it with a precondition
+        Return None when there is nothing to claim, or when every
+        candidate was taken by other workers in CLAIM_ROUNDS queries
+
+        Requires a composite index on (status, [model,] submission_time)
+        """
+        query = self._queue_query(JobStatus.QUEUED, model).order_by(
+            u'submission_time').limit(candidates)
+
+        requeued = False
+        for _ in range(self.CLAIM_ROUNDS):
+            snapshots = list(query.stream())
+            instrumentation.record(documents_read=len(snapshots))
+            if not snapshots:
+                if requeued or not self.requeue_expired(model):
+                    return None
+                requeued = True
+                continue
+
+            # Candidates may be claimed by other workers in the meantime
+            for snapshot in snapshots:
+                data = _claim(self.db.transaction(), snapshot.reference,
+                              worker_id, lease_seconds)
+                if data is not None:
+                    instrumentation.record(documents_written=1)
+                    cache.invalidate(snapshot.id, data.get(u'user'))
+                    job = GCPJob.from_dict(data, self.db)
+                    job._mark_synced()
+                    return job
+        return None
 
-    def _user_jobs(self, username) -> Iterable[firestore.DocumentSnapshot]:
-        """Helper: Query jobs associated with the username"""
-        return self._jobs_collection().where(u'user', u'==', username).get()
+    def requeue_expired(self, model: str = None) -> List[str]:
+        """
+        Return STARTED jobs with an expired lease to the queue
+        Sharded parents are never requeued, their children are
+
+        Requires a composite index on (status, [model,] lease_expiry)
+        """
+        query = self._queue_query(JobStatus.STARTED, model).where(
+            u'lease_expiry', u'<', time.time())
+        requeued = []
+        for snapshot in query.stream():
+            if _requeue(self.db.transaction(), snapshot.reference):
+                cache.invalidate(snapshot.id, snapshot.to_dict().get(u'user'))
+                requeued.append(snapshot.id)
+        return requeued
+
+    @instrumentation.instrumented
+    def renew_lease(self, job: GCPJob,
+                    lease_seconds: float = DEFAULT_LEASE_SECONDS) -> GCPJob:
+        """
+        Extend the lease held on job by job.worker_id, after which the
+        update time of job is unknown (see claim_next)
+        Raises LeaseError if the job is no longer leased by the worker
+        """
+        update = {u'lease_expiry': time.time() + lease_seconds}
+        _release(self.db.transaction(), self._job_reference(job.job_id),
+                 job.worker_id, update)
+        instrumentation.record(documents_written=1)
+        cache.invalidate(job.job_id, job.user)
+        job.lease_expiry = update[u'lease_expiry']
+        job._mark_synced(fields=update)
+        return job
+
+    @instrumentation.instrumented
+    def complete(self, job: GCPJob, storage: ImpressionFileStorage = None,
+                 url_lifetime: float = DEFAULT_URL_LIFETIME) -> GCPJob:
+        """
+        Mark the leased job FINISHED, storing its output_name,
+        output_file_url and info, and release the lease
+        With storage (an ImpressionFileStorage) output_file_url is set to a
+        signed url of the output valid for url_lifetime seconds, see
+        Job.signed_output_url, and the outputs of the parent job are
+        merged once its last shard completes (see merge_shards), marking
+        the parent ERROR if that fails
+        Raises LeaseError if the job is no longer leased by the worker
+        """
+        fields = {}
+        if storage is not None and job.output_name is not None:
+            fields[u'output_file_url'], fields[u'output_url_expiry'] = \
+                storage.output_url(job.output_name, url_lifetime)
+        return self._finish(job, JobStatus.FINISHED, fields, storage,
+                            url_lifetime)
+
+    @instrumentation.instrumented
+    def fail(self, job: GCPJob, err: str = None) -> GCPJob:
+        """
+        Mark the leased job ERROR (with err) and release the lease
+        Raises LeaseError if the job is no longer leased by the worker
+        """
+        return self._finish(job, JobStatus.ERROR,
+                            {} if err is None else {u'err': err})
+
+    def _finish(self, job: GCPJob, status: JobStatus, fields: dict,
+                storage: ImpressionFileStorage = None,
+                url_lifetime: float = DEFAULT_URL_LIFETIME) -> GCPJob:
+        """
+        Helper: release the lease on job, moving it to status with fields
+        (stored names of attributes of job) set, and count it towards its
+        parent if it is a shard
+        With storage, the outputs of a parent completed by job are merged;
+        job is committed by then, so a failed merge marks the parent ERROR
+        rather than raising
+        """
+        # job itself only changes once the transaction succeeds
+        completion_time = datetime.now()
+        document = job.to_dict()
+        update = {k: document[k] for k in
+                  (u'output_name', u'output_file_url', u'output_url_expiry',
+                   u'info', u'err')}
+        update.update(fields)
+        update.update({u'status': status.value,
+                       u'completion_time': Job._timetodb(completion_time),
+                       u'worker_id': None, u'lease_expiry': None})
+
+        parent = (None if job.parent_id is None
+                  else self._job_reference(job.parent_id))
+        parent_update = _release(
+            self.db.transaction(), self._job_reference(job.job_id),
+            job.worker_id, update, parent, status == JobStatus.ERROR)
+        instrumentation.record(documents_written=1 if parent is None else 2)
+        cache.invalidate(job.job_id, job.user)
+        if parent is not None:
+            cache.invalidate(job.parent_id, job.user)
+        for name, value in fields.items():
+            setattr(job, name, value)
+        job.status = status
+        job.completion_time = completion_time
+        job.worker_id = None
+        job.lease_expiry = None
+        job._mark_synced(fields=update)
+
+        if (storage is not None and parent_update is not None and
+                parent_update.get(u'status') == JobStatus.FINISHED.value):
+            try:
+                self.merge_shards(job.parent_id, storage, url_lifetime)
+            except Exception as e:
+                logger.exception('merging the shards of %s failed',
+                                 job.parent_id)
+                parent.update({u'status': JobStatus.ERROR.value,
+                               u'err': f'merging shard outputs failed: {e}'})
+                cache.invalidate(job.parent_id, job.user)
+        return job
+
+    @instrumentation.instrumented
+    def merge_shards(self, job_id: str, storage: ImpressionFileStorage,
+                     url_lifetime: float = DEFAULT_URL_LIFETIME,
+                     merged_name: str = None) -> str:
+        """
+        Concatenate the outputs of the shards of job_id in shard order
+        into one output file (sharding.merged_name by default), see
+        ImpressionFileStorage.merge_outputs, and record it as the job's
+        output_name with a signed output_file_url valid for url_lifetime
+        seconds
+        Return the merged output name
+
+        Raises FileTransferError if a shard has no output
+        """
+        query = self._jobs_collection().where(u'parent_id', u'==', job_id)
+        children = sorted((GCPJob.from_snapshot(s, self.db)
+                           for s in query.stream()),
+                          key=lambda child: child.shard_index)
+        names = [child.output_name for child in children]
+        if not names or None in names:
+            raise FileTransferError(f'{job_id}: shard outputs missing')
+        if merged_name is None:
+            merged_name = sharding.merged_name(
+                job_id, pathlib.PurePath(names[0]).suffix)
+
+        storage.merge_outputs(names, merged_name)
+        url, expiry = storage.output_url(merged_name, url_lifetime)
+        self._job_reference(job_id).update(
+            {u'output_name': merged_name, u'output_file_url': url,
+             u'output_url_expiry': expiry})
+        cache.invalidate(job_id, children[0].user)
+        return merged_name
+
+    def _queue_query(self, status: JobStatus,
+                     model: str = None) -> firestore.Query:
+        """Helper: jobs with status (and model)"""
+        query = self._jobs_collection().where(u'status', u'==', status.value)
+        if model is not None:
+            query = query.where(u'model', u'==', model)
+        return query
+
+    @staticmethod
+    def _paginate(query: firestore.Query, order_by: Optional[str],
+                  limit: Optional[int], start_after: Optional[str],
+                  descending: bool):
+        """
+        Helper: order query by order_by (then document id), resume it
+        after the start_after token and fetch limit + 1 documents
+        Return the query and the cursor function for JobPage
+        """
+        direction = (firestore.Query.DESCENDING if descending
+                     else firestore.Query.ASCENDING)
+        if order_by is not None:
+            query = query.order_by(order_by, direction=direction)
+        query = query.order_by(GCPDatabase.DOCUMENT_ID, direction=direction)
+
+        if start_after is not None:
+            field, value, document_id = decode_token(start_after)
+            if field != order_by:
+                raise ValueError(
+                    f'Continuation token does not match order_by={order_by}')
+            cursor = {GCPDatabase.DOCUMENT_ID: document_id}
+            if order_by is not None:
+                cursor[order_by] = value
+            query = query.start_after(cursor)
+
+        if limit is not None:
+            query = query.limit(limit + 1)
+
+        def cursor(snapshot: firestore.DocumentSnapshot) -> str:
+            value = (None if order_by is None
+                     else snapshot.to_dict().get(order_by))
+            return encode_token([order_by, value, snapshot.id])
+
+        return query, cursor
+
+    def _user_jobs(self, username, fields: Iterable[str] = None,
+                   status: JobStatus = None
+                   ) -> Iterable[firestore.DocumentSnapshot]:
+        """
+        Helper: Stream jobs associated with the username
+        fields: only transfer these fields of each job (all when None)
+        """
+        query = self._jobs_collection().where(u'user', u'==', username)
+        if status is not None:
+            query = query.where(u'status', u'==', JobStatus(status).value)
+        if fields is not None:
+            query = query.select(fields)
+        return instrumentation.iterate(query.stream(),
+                                       u'GCPDatabase._user_jobs')
 
     @staticmethod
     def _ids_from_jobs(
-            jobs: Iterable[firestore.DocumentSnapshot]) -> Iterable[int]:
+            jobs: Iterable[firestore.DocumentSnapshot]) -> Iterable[str]:
         """Helper: Exact job_ids from iterable of Job DocumentSnapshots"""
-        return map(lambda x: x.to_dict()['job_id'], jobs)
+        return map(lambda x: x.id, jobs)
+
+
+@firestore.transactional
+def _claim(transaction, ref: firestore.DocumentReference, worker_id: str,
+           lease_seconds: float) -> Optional[dict]:
+    """Lease a QUEUED job to worker_id, return its data (None if taken)"""
+    data = ref.get(transaction=transaction).to_dict()
+    if data is None or data.get(u'status') != JobStatus.QUEUED.value:
+        return None
+
+    now = time.time()
+    update = {u'status': JobStatus.STARTED.value,
+              u'worker_id': worker_id,
+              u'lease_expiry': now + lease_seconds,
+              u'start_time': Job._timetodb(
+                  datetime.fromtimestamp(now, timezone.utc))}
+    transaction.update(ref, update)
+    data.update(update)
+    return data
+
+
+@firestore.transactional
+def _requeue(transaction, ref: firestore.DocumentReference) -> bool:
+    """
+    Return a STARTED job with an expired lease to QUEUED, unless it is
+    a sharded parent
+    """
+    data = ref.get(transaction=transaction).to_dict()
+    if (data is None or data.get(u'shards') or
+            data.get(u'status') != JobStatus.STARTED.value or
+            data.get(u'lease_expiry') is None or
+            data[u'lease_expiry'] >= time.time()):
+        return False
+
+    transaction.update(ref, {u'status': JobStatus.QUEUED.value,
+                             u'worker_id': None,
+                             u'lease_expiry': None,
+                             u'start_time': None})
+    return True
+
+
+@firestore.transactional
+def _release(transaction, ref: firestore.DocumentReference, worker_id: str,
+             update: dict, parent: firestore.DocumentReference = None,
+             failed: bool = False):
+    """
+    Apply update to a job only while it is leased by worker_id
+    With parent, count the job as a finished (or failed) shard of it and
+    return the update of the parent
+    """
+    data = ref.get(transaction=transaction).to_dict()
+    # all reads precede the writes of a transaction
+    parent_data = (None if parent is None
+                   else parent.get(transaction=transaction).to_dict())
+    if (data is None or
+            data.get(u'status') != JobStatus.STARTED.value or
+            worker_id is None or
+            data.get(u'worker_id') != worker_id):
+        raise LeaseError(f'{ref.id} is not leased by {worker_id}')
+
+    transaction.update(ref, update)
+    if parent_data is None:
+        return None
+    parent_update = _shard_completed(parent_data, failed)
+    transaction.update(parent, parent_update)
+    return parent_update
+
+
+def _shard_completed(parent: dict, failed: bool) -> dict:
+    """
+    Update of a parent job counting one more completed shard, completing
+    the parent with its last shard
+    """
+    finished = parent.get(u'shards_finished') or 0
+    failures = parent.get(u'shards_failed') or 0
+    if failed:
+        failures += 1
+    else:
+        finished += 1
+    update = {u'shards_finished': finished, u'shards_failed': failures}
+
+    shards = parent.get(u'shards') or 0
+    if finished + failures >= shards:
+        update[u'completion_time'] = Job._timetodb(datetime.now(timezone.utc))
+        if failures:
+            update[u'status'] = JobStatus.ERROR.value
+            update[u'err'] = f'{failures} of {shards} shards failed'
+        else:
+            update[u'status'] = JobStatus.FINISHED.value
+    return update
@@ -0,0 +1,352 @@
+"""
+Instrumentation of the job, database and storage layers
+Calls are measured as Spans: operation (e.g. 'GCPJob.update_in_db'),
+duration, error and counts of what they moved ('bytes',
+'documents_read', 'documents_written', 'documents_deleted')
+
+instrumented: decorator measuring every call of a function
+iterate: measure the consumption of a stream of documents
+record/recording: add counts to (check for) the current call's span
+Instrument: receiver of spans, ignores them; set_instrument() installs
+    one process wide (none by default: calls then cost one check)
+Collector: in-process call counts, latency histograms, counts and errors
+    per operation, e.g. for tests
+OpenTelemetryInstrument: spans (and optionally metrics) of an
+    OpenTelemetry style tracer (and meter)
+"""
+import bisect
+import contextlib
+import functools
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+BYTES = 'bytes'
+DOCUMENTS_READ = 'documents_read'
+DOCUMENTS_WRITTEN = 'documents_written'
+DOCUMENTS_DELETED = 'documents_deleted'
+
+# Upper bounds (seconds) of the latency histogram buckets of a Collector
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Span:
+    """
+    Measurement of one call of operation
+    counts: totals added with record() during the call
+    seconds and error (the exception raised, if any) are set once it
+    returns
+    stream: measures the consumption of a stream (see iterate), which
+        may start and finish on different threads, with other calls
+        in between
+    handle: state of the instrument, e.g. its tracing span
+    """
+    __slots__ = ('operation', 'counts', 'start', 'seconds', 'error',
+                 'stream', 'handle')
+
+    def __init__(self, operation: str, stream: bool = False):
+        self.operation = operation
+        self.stream = stream
+        self.counts = {}
+        self.start = time.perf_counter()
+        self.seconds = None
+        self.error = None
+        self.handle = None
+
+    def add(self, counts: Dict[str, int]):
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+
+class Instrument:
+    """
+    Receiver of the spans of instrumented calls
+    start(span) is called before the call, finish(span) after it, both
+    on the calling thread, except for stream spans: those start at the
+    first item and finish at the end of the stream, on whichever
+    threads consume it
+    The base ignores them
+    """
+    def start(self, span: Span):
+        pass
+
+    def finish(self, span: Span):
+        pass
+
+
+_instrument: Optional[Instrument] = None
+_local = threading.local()
+
+
+def set_instrument(instrument: Optional[Instrument]):
+    """Send the spans of all calls to instrument (None to stop)"""
+    global _instrument
+    _instrument = instrument
+
+
+def get_instrument() -> Optional[Instrument]:
+    return _instrument
+
+
+@contextlib.contextmanager
+def instrumenting(instrument: Instrument):
+    """Use instrument for the duration, restoring the previous one"""
+    previous = _instrument
+    set_instrument(instrument)
+    try:
+        yield instrument
+    finally:
+        set_instrument(previous)
+
+
+def _stack() -> List[Span]:
+    try:
+        return _local.spans
+    except AttributeError:
+        _local.spans = []
+        return _local.spans
+
+
+def _begin(instrument: Instrument, operation: str) -> Span:
+    span = Span(operation)
+    instrument.start(span)
+    _stack().append(span)
+    return span
+
+
+def _end(instrument: Instrument, span: Span, error: BaseException = None):
+    _stack().pop()
+    span.seconds = time.perf_counter() - span.start
+    span.error = error
+    instrument.finish(span)
+
+
+def recording() -> bool:
+    """Is the current call measured? (to skip computing counts if not)"""
+    return _instrument is not None and bool(getattr(_local, 'spans', None))
+
+
+def record(**counts: int):
+    """Add counts to the span of the current instrumented call, if any"""
+    spans = getattr(_local, 'spans', None)
+    if spans:
+        spans[-1].add(counts)
+
+
+def instrumented(fn: Callable = None, operation: str = None):
+    """
+    Decorator measuring each call of fn as a span of operation
+    (fn's qualified name by default, e.g. 'GCPJob.update_in_db')
+    Use as @instrumented or @instrumented(operation=...)
+    """
+    if fn is None:
+        return functools.partial(instrumented, operation=operation)
+    name = fn.__qualname__ if operation is None else operation
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        instrument = _instrument
+        if instrument is None:
+            return fn(*args, **kwargs)
+        span = _begin(instrument, name)
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            _end(instrument, span, e)
+            raise
+        _end(instrument, span)
+        return result
+    return wrapper
+
+
+def iterate(iterable: Iterable, operation: str,
+            count: str = DOCUMENTS_READ) -> Iterable:
+    """
+    iterable, measured from its first item until it is exhausted (or
+    closed) as a span of operation counting its items as count
+    Returned as is when there is no instrument
+    """
+    if _instrument is None:
+        return iterable
+    return _measured_iterator(iter(iterable), _instrument, operation, count)
+
+
+def _measured_iterator(iterator: Iterator, instrument: Instrument,
+                       operation: str, count: str) -> Iterator:
+    """Helper: generator of iterate"""
+    span = Span(operation, stream=True)
+    instrument.start(span)
+    items = 0
+    error = None
+    try:
+        for item in iterator:
+            items += 1
+            yield item
+    except BaseException as e:
+        # GeneratorExit when closed before the end
+        if not isinstance(e, GeneratorExit):
+            error = e
+        raise
+    finally:
+        span.counts[count] = items
+        span.seconds = time.perf_counter() - span.start
+        span.error = error
+        instrument.finish(span)
+
+
+class OperationStats:
+    """
+    Totals of the calls of one operation
+    histogram[i]: calls that took at most LATENCY_BUCKETS[i] seconds (and
+    more than the previous bound)
+    """
+    __slots__ = ('calls', 'errors', 'seconds', 'histogram', 'counts')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.histogram = [0] * len(LATENCY_BUCKETS)
+        self.counts = {}
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.seconds / self.calls if self.calls else 0.0
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q quantile of latencies"""
+        rank = q * self.calls
+        seen = 0
+        for bound, calls in zip(LATENCY_BUCKETS, self.histogram):
+            seen += calls
+            if calls and seen >= rank:
+                return bound
+        return 0.0
+
+    def to_dict(self) -> dict:
+        return {'calls': self.calls, 'errors': self.errors,
+                'seconds': self.seconds,
+                'histogram': dict(zip(map(str, LATENCY_BUCKETS),
+                                      self.histogram)),
+                'counts': dict(self.counts)}
+
+
+class Collector(Instrument):
+    """
+    Thread safe in-process totals of the spans per operation
+    stats[operation] are its OperationStats; with keep_spans the spans
+    themselves are kept in spans, in the order the calls finished
+    """
+    def __init__(self, keep_spans: bool = False):
+        self.keep_spans = keep_spans
+        self._lock = threading.Lock()
+        self.stats: Dict[str, OperationStats] = {}
+        self.spans: List[Span] = []
+
+    def finish(self, span: Span):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, span.seconds)
+        with self._lock:
+            stats = self.stats.get(span.operation)
+            if stats is None:
+                stats = self.stats[span.operation] = OperationStats()
+            stats.calls += 1
+            stats.errors += span.error is not None
+            stats.seconds += span.seconds
+            stats.histogram[bucket] += 1
+            for name, value in span.counts.items():
+                stats.counts[name] = stats.counts.get(name, 0) + value
+            if self.keep_spans:
+                self.spans.append(span)
+
+    def __getitem__(self, operation: str) -> OperationStats:
+        """Stats of operation (empty if never called)"""
+        with self._lock:
+            return self.stats.get(operation) or OperationStats()
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {operation: stats.to_dict()
+                    for operation, stats in self.stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}
+            self.spans = []
+
+
+class OpenTelemetryInstrument(Instrument):
+    """
+    Spans of an OpenTelemetry style tracer, each call a child of the
+    current span, its counts set as attributes and errors recorded
+    Stream spans are never made current (so never parents) as other
+    calls run while a stream is open
+    With meter, also records the metrics impression.calls,
+    impression.errors, impression.duration (histogram, seconds) and a
+    counter impression.<count> per count, attributed by operation
+
+    tracer needs start_as_current_span(name) and start_span(name), whose
+    spans have set_attribute, record_exception and end; meter needs
+    create_counter and create_histogram (opentelemetry.trace.get_tracer
+    and opentelemetry.metrics.get_meter provide both)
+    """
+    PREFIX = 'impression.'
+
+    def __init__(self, tracer, meter=None):
+        self.tracer = tracer
+        self.meter = meter
+        self._lock = threading.Lock()
+        self._counters = {}
+        if meter is not None:
+            self._duration = meter.create_histogram(
+                self.PREFIX + 'duration', unit='s',
+                description='Duration of instrumented calls')
+
+    def start(self, span: Span):
+        name = self.PREFIX + span.operation
+        if span.stream:
+            span.handle = (None, self.tracer.start_span(name))
+        else:
+            context = self.tracer.start_as_current_span(name)
+            span.handle = (context, context.__enter__())
+
+    def finish(self, span: Span):
+        context, traced = span.handle
+        try:
+            for name, value in span.counts.items():
+                traced.set_attribute(self.PREFIX + name, value)
+            if span.error is not None:
+                traced.record_exception(span.error)
+                _set_error_status(traced, span.error)
+        finally:
+            if context is None:
+                traced.end()
+            else:
+                context.__exit__(None, None, None)
+
+        if self.meter is not None:
+            attributes = {'operation': span.operation}
+            self._counter('calls').add(1, attributes)
+            if span.error is not None:
+                self._counter('errors').add(1, attributes)
+            self._duration.record(span.seconds, attributes)
+            for name, value in span.counts.items():
+                self._counter(name).add(value, attributes)
+
+    def _counter(self, name: str):
+        """Helper: counter impression.<name>, created once"""
+        with self._lock:
+            counter = self._counters.get(name)
+            if counter is None:
+                counter = self._counters[name] = self.meter.create_counter(
+                    self.PREFIX + name)
+            return counter
+
+
+def _set_error_status(traced, error: BaseException):
+    """Helper: mark an opentelemetry span failed, where available"""
+    try:
+        from opentelemetry.trace import Status, StatusCode
+    except ImportError:
+        return
+    traced.set_status(Status(StatusCode.ERROR, str(error)))
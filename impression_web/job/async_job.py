@@ -0,0 +1,55 @@
+"""
+Asyncio counterpart of Job
+"""
+from typing import Callable, Optional
+
+from impression_web import aio, watch
+from impression_web.job.job import Job
+
+
+class AsyncJob(aio.Counterpart):
+    """
+    Job whose database access is awaited rather than blocking
+    Fields and non-database methods (to_dict, dirty_fields, ...) are those
+    of the wrapped platform job (sync), reads and writes pass through
+
+    Coroutines: update_in_db, delete_in_db, watch, signed_output_url
+    Platform calls run on the shared aio executor, see impression_web.aio
+    Created by ImpressionJobFactory(platform, mode='async')
+    """
+    __slots__ = ()
+
+    def __init__(self, job: Job):
+        super().__init__(job)
+
+    def __getattr__(self, name):
+        return getattr(self.sync, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.sync, name, value)
+
+    def __repr__(self):
+        return f'AsyncJob({self.sync!r})'
+
+    async def update_in_db(self, *args, **kwargs) -> str:
+        return await aio.run(self.sync.update_in_db, *args, **kwargs)
+
+    async def delete_in_db(self) -> bool:
+        return await aio.run(self.sync.delete_in_db)
+
+    async def signed_output_url(self, storage, *args,
+                                **kwargs) -> Optional[str]:
+        """See Job.signed_output_url, storage may be an AsyncFileStorage"""
+        return await aio.run(self.sync.signed_output_url,
+                             aio.unwrap(storage), *args, **kwargs)
+
+    async def watch(self, callback: Callable) -> watch.Subscription:
+        """
+        Call callback(job, previous_status) with the AsyncJob on each
+        status change, on the current event loop
+        callback may be a coroutine function
+        """
+        notify = aio.loop_callback(callback)
+        return await aio.run(
+            self.sync.watch,
+            lambda job, previous: notify(AsyncJob(job), previous))
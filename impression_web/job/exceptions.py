@@ -16,3 +16,19 @@ class JobNotFoundError(Exception):
 class JobAccessError(Exception):
     """No access to impression_web"""
     pass
+
+
+class JobConflictError(Exception):
+    """Job changed in the database since it was loaded"""
+    pass
+
+
+class JobWriteError(Exception):
+    """
+    Some batches of a bulk write failed
+    written/failed: ids of the jobs stored/not stored
+    """
+    def __init__(self, message, written=(), failed=()):
+        super().__init__(message)
+        self.written = list(written)
+        self.failed = list(failed)
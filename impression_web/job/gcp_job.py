@@ -1,12 +1,19 @@
 """
 IMPRESSION Job for GCP
 """
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List
+
+import google.api_core.exceptions
 from google.cloud import firestore
 from google.cloud.firestore import DocumentReference
 
+from impression_web import cache, clients, watch
+from impression_web.instrumentation import instrumented, record
 from impression_web.job.exceptions import \
-    JobCreationError, JobNotFoundError, JobAccessError
-from impression_web.job.job import Job, JobStatus
+    JobCreationError, JobNotFoundError, JobAccessError, JobConflictError, \
+    JobWriteError
+from impression_web.job.job import Job, JobLookup
 
 
 class GCPJob(Job):
@@ -15,12 +22,18 @@ class GCPJob(Job):
     Representation of a job in the GCP database
     Allow update/deletion of own record in database
 
-    Overloads delete_in_db, update_in_db, from_dict, from_id from parent Job
+    Overloads delete_in_db, update_in_db, update_many, from_dict,
+    from_dicts, from_id, from_ids, watch from parent Job
 
     Raises JobCreationError on invalid File dictionary
     Raises JobAccessError: init from db : permission denied
     Raises JobNotFoundError: init from db: no such impression_web id
+    Raises JobConflictError: update_in_db: entry changed since load
     """
+    __slots__ = ()
+
+    # Maximum number of writes firestore accepts in a single batched commit
+    BATCH_LIMIT = 500
 
     def __init__(self,
                  user: str = None,
@@ -32,27 +45,28 @@ class GCPJob(Job):
     @property
     def db(self):
         if self._db is None:
-            self._db = firestore.Client()
+            self._db = clients.firestore_client()
         return self._db
 
     @staticmethod
-    def from_dict(src: dict):
-        job = GCPJob()
-        for k, v in src.items():
-            try:
-                if 'time' in k:
-                    setattr(job, k, Job._datetimefromstr(v))
-
-                elif k == 'status':
-                    setattr(job, k, JobStatus(v))
-                else:
-                    setattr(job, k, v)
-            except AttributeError:
-                pass
-
+    def from_dict(src: dict, db: firestore.Client = None):
+        """Job from its database representation, using client db if given"""
+        job = GCPJob._decode(src)
+        job._db = db
         return job
 
     @staticmethod
+    def from_dicts(srcs: Iterable[dict],
+                   db: firestore.Client = None) -> List['GCPJob']:
+        """Jobs from many database representations (bulk from_dict)"""
+        jobs = GCPJob._decode_many(srcs)
+        if db is not None:
+            for job in jobs:
+                job._db = db
+        return jobs
+
+    @staticmethod
+    @instrumented
     def from_id(job_id: str, user: str,
                 admin_access=None, db: firestore.Client = None):
         """
@@ -61,12 +75,13 @@ class GCPJob(Job):
         Admin access allows non-matching user to query
         """
         if db is None:
-            db = firestore.Client()
+            db = clients.firestore_client()
 
         job_ref = db.collection(u'jobs').document(job_id).get()
+        record(documents_read=1)
 
         if job_ref.exists:
-            job = GCPJob.from_dict(job_ref.to_dict())
+            job = GCPJob.from_snapshot(job_ref, db)
             if job.user == user or admin_access:
                 return job
             else:
@@ -74,9 +89,72 @@ class GCPJob(Job):
         else:
             raise JobNotFoundError(f'{job_id} does not exist')
 
-    def update_in_db(self, job_id=None) -> str:
-        jid = self.job_id if job_id is None else job_id
+    @staticmethod
+    @instrumented
+    def from_ids(job_ids: Iterable[str], user: str,
+                 admin_access=None, db: firestore.Client = None) -> JobLookup:
+        """
+        Look up many job_ids in the database with a single multi-get
+        Ownership is checked per job: missing and forbidden ids are
+        reported in the returned JobLookup rather than raised
+        """
+        # dict preserves request order and drops duplicate ids
+        job_ids = list(dict.fromkeys(job_ids))
+        lookup = JobLookup(jobs={}, missing=[], forbidden=[])
+        if not job_ids:
+            return lookup
+
+        if db is None:
+            db = clients.firestore_client()
+
+        collection = db.collection(u'jobs')
+        snapshots = {snapshot.id: snapshot for snapshot in
+                     db.get_all([collection.document(job_id)
+                                 for job_id in job_ids])}
+        record(documents_read=len(job_ids))
+
+        for job_id in job_ids:
+            snapshot = snapshots.get(job_id)
+            if snapshot is None or not snapshot.exists:
+                lookup.missing.append(job_id)
+                continue
 
+            job = GCPJob.from_snapshot(snapshot, db)
+            if job.user == user or admin_access:
+                lookup.jobs[job_id] = job
+            else:
+                lookup.forbidden.append(job_id)
+
+        return lookup
+
+    @staticmethod
+    def from_snapshot(snapshot: firestore.DocumentSnapshot,
+                      db: firestore.Client) -> 'GCPJob':
+        """
+        Job loaded from a document snapshot of client db, in sync with
+        the database
+        """
+        job = GCPJob.from_dict(snapshot.to_dict(), db)
+        job._mark_synced(snapshot.update_time)
+        return job
+
+    def watch(self, callback: Callable) -> watch.Subscription:
+        """
+        Call callback(job, previous_status) on each status change of this
+        job, starting with its current state (previous_status None)
+        All watchers of a job share one snapshot listener
+        """
+        if self.job_id is None:
+            raise JobNotFoundError('Cannot watch a job without a job_id')
+
+        ref = self.db.collection(u'jobs').document(self.job_id)
+        return watch.hub.subscribe(
+            (self.db, ref.path), ref.on_snapshot,
+            lambda snapshot: GCPJob.from_snapshot(snapshot, self.db),
+            callback)
+
+    def _check_not_empty(self):
+        """Raise JobCreationError if there is nothing to store"""
         if (self.user is None and
                 self.file is None and
                 self.model is None):
@@ -84,23 +162,176 @@ class GCPJob(Job):
                 f"""Cannot add empty impression_web to database:
                 {self.user}, {self.file}, {self.model}""")
 
+    @instrumented
+    def update_in_db(self, job_id=None, precondition: bool = False) -> str:
+        """
+        Create/update own entry in the database
+        A job loaded from (or saved to) its entry only sends the fields
+        changed since, otherwise the whole entry is overwritten
+
+        precondition: only update if the entry is unchanged since this
+        job was loaded/saved (raises JobConflictError otherwise)
+        """
+        jid = self.job_id if job_id is None else job_id
+
+        self._check_not_empty()
+
         # Passing None to document() generates a impression_web-id
         ref: DocumentReference = self.db.collection(u'jobs').document(jid)
 
-        write_res: firestore.types.WriteResult = ref.set(self.to_dict())
+        if not (self._in_db and jid == self.job_id):
+            document = self.to_dict()
+            # the stored job_id is the entry's, also for generated ids
+            document[u'job_id'] = ref.id
+            write_res: firestore.types.WriteResult = ref.set(document)
+        elif self._dirty:
+            document = self.to_dict()
+            write_res = self._update(
+                ref, {k: document[k] for k in self._dirty}, precondition)
+        else:
+            return self.job_id
 
+        record(documents_written=1)
         if write_res:
             self.job_id = ref.id
+            self._mark_synced(write_res.update_time)
+            cache.invalidate(self.job_id, self.user)
 
         return self.job_id
 
+    def _update(self, ref: DocumentReference, fields: dict,
+                precondition: bool) -> firestore.types.WriteResult:
+        """Helper: partial update of own entry"""
+        option = None
+        if precondition:
+            if self._update_time is None:
+                raise JobConflictError(
+                    f'{self.job_id}: update time unknown, reload the job')
+            option = self.db.write_option(last_update_time=self._update_time)
+
+        try:
+            return ref.update(fields, option=option)
+        except google.api_core.exceptions.FailedPrecondition as e:
+            raise JobConflictError(
+                f'{self.job_id} changed since it was loaded') from e
+        except google.api_core.exceptions.NotFound as e:
+            raise JobNotFoundError(f'{self.job_id} does not exist') from e
+
+    @staticmethod
+    @instrumented
+    def update_many(jobs: Iterable['GCPJob'],
+                    db: firestore.Client = None,
+                    batch_size: int = BATCH_LIMIT,
+                    max_workers: int = None) -> List[str]:
+        """
+        Create/update many jobs using batched commits
+        Jobs without a job_id are assigned one before being written, so
+        that retrying after a failure rewrites the same entries
+        Batches of at most batch_size writes are committed in parallel
+        Return the job ids in the same order as jobs
+
+        Raises JobCreationError if any job is empty (nothing is written)
+        Raises JobWriteError if any batch failed, the other batches are
+        written (and their jobs in sync)
+        """
+        jobs = list(jobs)
+        for job in jobs:
+            job._check_not_empty()
+
+        if not jobs:
+            return []
+        # before any job_id is assigned
+        GCPJob._check_batch_size(batch_size)
+
+        if db is None:
+            db = clients.firestore_client()
+
+        collection = db.collection(u'jobs')
+        # Passing None to document() generates a job-id client side
+        refs = [collection.document(job.job_id) for job in jobs]
+        for job, ref in zip(jobs, refs):
+            job.job_id = ref.id
+
+        def write(batch, job_ref):
+            job, ref = job_ref
+            document = job.to_dict()
+            document[u'job_id'] = ref.id
+            batch.set(ref, document)
+
+        errors = []
+        results = GCPJob._commit_batches(db, list(zip(jobs, refs)), write,
+                                         batch_size, max_workers, errors)
+        record(documents_written=len(results))
+
+        for (job, ref), write_res in results:
+            if job._db is None:
+                job._db = db
+            job._mark_synced(write_res.update_time)
+            cache.invalidate(job.job_id, job.user)
+
+        if errors:
+            # batches fail in completion order, report in job order
+            written = [job.job_id for (job, _), _ in results]
+            written_ids = set(written)
+            failed = [job.job_id for job in jobs
+                      if job.job_id not in written_ids]
+            raise JobWriteError(
+                f'{len(failed)} of {len(jobs)} jobs not written: '
+                f'{errors[0][1]}',
+                written=written, failed=failed) from errors[0][1]
+        return [job.job_id for job in jobs]
+
+    @staticmethod
+    def _check_batch_size(batch_size: int):
+        """Raise ValueError unless batch_size is within 1-BATCH_LIMIT"""
+        if not 0 < batch_size <= GCPJob.BATCH_LIMIT:
+            raise ValueError(
+                f'batch_size must be within 1-{GCPJob.BATCH_LIMIT}')
+
+    @staticmethod
+    def _commit_batches(db: firestore.Client, items: list, write,
+                        batch_size: int = BATCH_LIMIT,
+                        max_workers: int = None,
+                        errors: list = None) -> list:
+        """
+        Helper: write(batch, item) for every item, in batches of at most
+        batch_size writes committed in parallel
+        Return (item, WriteResult) pairs in order of items
+        With errors, the (items, exception) of failed batches are appended
+        to it and the other batches returned, else failures are raised
+        """
+        GCPJob._check_batch_size(batch_size)
+
+        def commit(start: int):
+            batch = db.batch()
+            chunk = items[start:start + batch_size]
+            for item in chunk:
+                write(batch, item)
+            if errors is None:
+                return zip(chunk, batch.commit())
+            try:
+                return zip(chunk, batch.commit())
+            except Exception as e:
+                errors.append((chunk, e))
+                return ()
+
+        starts = range(0, len(items), batch_size)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return [result for chunk in executor.map(commit, starts)
+                    for result in chunk]
+
+    @instrumented
     def delete_in_db(self) -> bool:
         if self.job_id is not None:
             ref: DocumentReference = self.db.collection(
                 u'jobs').document(self.job_id)
 
-            ref.delete()
-            return not ref.get().exists
+            # The delete result is enough: no read back needed
+            delete_time = ref.delete()
+            record(documents_deleted=1)
+            self._in_db = False
+            cache.invalidate(self.job_id, self.user)
+            return delete_time is not None
 
         else:
             return False
@@ -4,10 +4,26 @@ JobAccessError, JobCreationError, JobNotFoundError
 JobStatus enum
 """
 import abc
-from datetime import datetime
+from datetime import datetime, timezone
 import enum
+import functools
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional
 
 from impression_web.job.exceptions import JobCreationError
+from impression_web.job.schema import Codec, Field, STATUS, TIME
+
+
+class JobStatus(enum.IntEnum):
+    """
+    Enumeration for Job states
+    """
+    NONE = 0
+    SUBMITTED = 1
+    QUEUED = 2
+    STARTED = 3
+    FINISHED = 4
+    ERROR = 5
 
 
 class Job(abc.ABC):
@@ -15,15 +31,23 @@ class Job(abc.ABC):
     Base Job object for IMPRESSION
     On creation, methods for database access will be passed via the
     command pattern
-    _time instance variables are exposed via getter interfaces
-    to ensure that a compliant string is produced
+    _time instance variables are stored as UTC timestamps (to the
+    second) and exposed via getter interfaces as compliant
+    _datetime_format strings in local time
 
     public methods
     to_dict: return a dictionary representation (database storage)
+    dirty_fields: stored fields changed since last load/save
+    shard_progress: completed fraction of a sharded job's children
+    from_dicts: return Job objects from many dictionaries (bulk decode)
     from_dict (abstract): return a Job object from a passed dictionary
     from_id (abstract): return a Job object give a document database id
+    from_ids (abstract): return a JobLookup for many document database ids
+    signed_output_url: direct download url of a finished job's output
     update_in_db (abstract): created/update self in database
+    update_many (abstract): create/update many jobs in batched writes
     delete_in_db (abstract): delete own entry from database
+    watch (abstract): subscribe to status changes of own entry
 
     Raises JobCreationError on invalid File dictionary
     Raises JobAccessError: init from db : permission denied
@@ -31,6 +55,37 @@ class Job(abc.ABC):
     """
     _datetime_format = '%y-%m-%d::%H:%M'
 
+    # Database representation, in to_dict order
+    SCHEMA = (Field(u'job_id', 'job_id'),
+              Field(u'user', 'user'),
+              Field(u'status', 'status', STATUS, 0),
+              Field(u'input_name', 'input_name'),
+              Field(u'upload_name', '_upload_name'),
+              Field(u'output_name', '_output_name'),
+              Field(u'model', 'model'),
+              Field(u'submission_time', '_submission_time', TIME),
+              Field(u'start_time', '_start_time', TIME),
+              Field(u'completion_time', '_completion_time', TIME),
+              Field(u'info', '_info', default=""),
+              Field(u'err', '_err', default=""),
+              Field(u'output_file_url', '_output_file_url'),
+              Field(u'output_url_expiry', 'output_url_expiry'),
+              Field(u'worker_id', 'worker_id'),
+              Field(u'lease_expiry', 'lease_expiry'),
+              Field(u'parent_id', 'parent_id'),
+              Field(u'shard_index', 'shard_index'),
+              Field(u'shards', 'shards'),
+              Field(u'shards_finished', 'shards_finished'),
+              Field(u'shards_failed', 'shards_failed'))
+    FIELDS = tuple(field.name for field in SCHEMA)
+    # attribute -> stored field, for change tracking
+    _ATTR_FIELDS = {field.attr: field.name for field in SCHEMA}
+    # Slots outside the schema and their value on decoded jobs
+    _EXTRA_SLOTS = {'file': None, '_db': None, '_bucket': None,
+                    '_dirty': None, '_in_db': False, '_update_time': None}
+
+    __slots__ = tuple(_ATTR_FIELDS) + tuple(_EXTRA_SLOTS)
+
     def __init__(self,
                  user: str = None,
                  file: dict = None,
@@ -39,6 +94,12 @@ class Job(abc.ABC):
         """
         Creating a new impression job via submission system
         """
+        # Change tracking against the database entry, see _mark_synced
+        # _dirty: set of changed fields, None until the first change
+        self._dirty = None
+        self._in_db = False
+        self._update_time = None
+
         self.user = user
         self.file = file
         self.model = model
@@ -52,7 +113,21 @@ class Job(abc.ABC):
         self._info = ""
         self._err = ""
 
+        # Signed direct download url of the output and its expiry (epoch s)
         self._output_file_url = None
+        self.output_url_expiry: float = None
+
+        # Work queue lease: worker holding the job and lease expiry (epoch s)
+        self.worker_id: str = None
+        self.lease_expiry: float = None
+
+        # Sharding: a child's parent job and position among its siblings,
+        # a parent's number of children and how many finished/failed
+        self.parent_id: str = None
+        self.shard_index: int = None
+        self.shards: int = None
+        self.shards_finished: int = None
+        self.shards_failed: int = None
 
         self._db = None
         self._bucket = None
@@ -68,6 +143,41 @@ class Job(abc.ABC):
             self._upload_name = None
             self._output_name = None
 
+    def __setattr__(self, name, value):
+        """Record assignments to stored fields (or their _private value)"""
+        object.__setattr__(self, name, value)
+        field = Job._ATTR_FIELDS.get(name)
+        if field is not None:
+            if self._dirty is None:
+                object.__setattr__(self, '_dirty', {field})
+            else:
+                self._dirty.add(field)
+
+    @property
+    def dirty_fields(self) -> frozenset:
+        """Stored fields assigned since the job was loaded or saved"""
+        return frozenset(self._dirty or ())
+
+    def _mark_synced(self, update_time=None, fields=None):
+        """
+        Helper: record that the database entry matches fields (all when
+        None) of this job, as of update_time if known
+        """
+        if fields is None or not self._dirty:
+            self._dirty = None
+        else:
+            self._dirty.difference_update(fields)
+        self._in_db = True
+        self._update_time = update_time
+
+    @property
+    def shard_progress(self) -> Optional[float]:
+        """Fraction of the shards of a parent job completed, else None"""
+        if not self.shards:
+            return None
+        return ((self.shards_finished or 0)
+                + (self.shards_failed or 0)) / self.shards
+
     @property
     def submission_time(self):
         try:
@@ -120,7 +230,7 @@ class Job(abc.ABC):
 
     @property
     def output_name(self):
-        return self._upload_name
+        return self._output_name
 
     @output_name.setter
     def output_name(self, value):
@@ -153,26 +263,29 @@ class Job(abc.ABC):
     pass
 
     def to_dict(self):
-        return {u'job_id': self.job_id,
-                u'user': self.user,
-                u'status': self.status.value,
-                u'input_name': self.input_name,
-                u'upload_name': self._upload_name,
-                u'output_name': self._output_name,
-                u'model': self.model,
-                u'submission_time': self.submission_time,
-                u'start_time': self.start_time,
-                u'completion_time': self.completion_time,
-                u'info': self._info,
-                u'err': self._err,
-                u'output_file_url': self._output_file_url
-                }
+        return Job._codec.encode(self)
 
     @staticmethod
     @abc.abstractmethod
     def from_dict(src: dict):
         pass
 
+    @staticmethod
+    @abc.abstractmethod
+    def from_dicts(srcs: [dict]):
+        """Return Job objects from many dictionaries"""
+        pass
+
+    @classmethod
+    def _decode(cls, src: dict) -> 'Job':
+        """Helper: new job of cls from its database representation"""
+        return Job._codec.decode(cls, src)
+
+    @classmethod
+    def _decode_many(cls, srcs: Iterable[dict]) -> List['Job']:
+        """Helper: new jobs of cls from many database representations"""
+        return Job._codec.decode_many(cls, srcs)
+
     @staticmethod
     @abc.abstractmethod
     def from_id(job_id: str, user: str, admin_access=False):
@@ -183,6 +296,36 @@ class Job(abc.ABC):
         """
         pass
 
+    @staticmethod
+    @abc.abstractmethod
+    def from_ids(job_ids: [str], user: str, admin_access=False):
+        """
+        Look up many job_ids in the database in a single request
+        Return a JobLookup of the accessible jobs and the ids that are
+        missing or not owned by user (unless admin_access)
+        """
+        pass
+
+    def signed_output_url(self, storage, min_remaining: float = 60.0,
+                          lifetime: float = None) -> Optional[str]:
+        """
+        Signed url downloading the output of a FINISHED job from storage
+        (an ImpressionFileStorage), None for other jobs
+        The stored url is reused while it remains valid for min_remaining
+        seconds, otherwise a new one is signed (for lifetime seconds,
+        storage's default if None) and saved if the job is in the database
+        """
+        if self.status != JobStatus.FINISHED or self._output_name is None:
+            return None
+        if (self._output_file_url is None or self.output_url_expiry is None
+                or self.output_url_expiry - time.time() < min_remaining):
+            signed = (storage.output_url(self._output_name) if lifetime is None
+                      else storage.output_url(self._output_name, lifetime))
+            self._output_file_url, self.output_url_expiry = signed
+            if self._in_db:
+                self.update_in_db()
+        return self._output_file_url
+
     @abc.abstractmethod
     def update_in_db(self, job_id=None) -> str:
         """
@@ -190,6 +333,15 @@ class Job(abc.ABC):
         """
         pass
 
+    @staticmethod
+    @abc.abstractmethod
+    def update_many(jobs, *args, **kwargs) -> [str]:
+        """
+        Create/update many jobs in the database with batched writes
+        Return the job ids in the order of jobs
+        """
+        pass
+
     @abc.abstractmethod
     def delete_in_db(self) -> bool:
         """
@@ -197,28 +349,88 @@ class Job(abc.ABC):
         """
         pass
 
+    @abc.abstractmethod
+    def watch(self, callback):
+        """
+        Call callback(job, previous_status) when own status changes
+        Return a subscription with unsubscribe()
+        """
+        pass
+
+    @staticmethod
+    def _timetodb(dt: datetime) -> datetime:
+        """
+        Stored form of dt: timezone aware UTC, whole seconds
+        Naive datetimes are taken to be local time (datetime.now())
+        """
+        if dt is None:
+            return None
+        return dt.astimezone(timezone.utc).replace(microsecond=0)
+
     @staticmethod
+    def _timefromdb(value) -> datetime:
+        """
+        UTC datetime of a stored time: a timestamp, epoch seconds or a
+        legacy _datetime_format string (local time, see migrate_timestamps)
+        """
+        if isinstance(value, datetime):
+            if value.tzinfo is timezone.utc:
+                return value
+            return value.astimezone(timezone.utc)
+        if isinstance(value, str):
+            return Job._datetimefromstr(value)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return datetime.fromtimestamp(value, timezone.utc)
+        return None
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
     def _datetimefromstr(string: str) -> datetime:
+        """
+        UTC datetime from the legacy _datetime_format, sliced rather than
+        strptime
+        Cached: jobs submitted in the same minute share one datetime
+        """
+        if string is None:
+            return None
         try:
-            return datetime.strptime(string, Job._datetime_format)
+            if (len(string) == 15 and string[2] == string[5] == '-' and
+                    string[8:10] == '::' and string[12] == ':'):
+                year = int(string[0:2])
+                # %y: 69-99 are 1969-1999, 00-68 are 2000-2068
+                local = datetime(year + (1900 if year >= 69 else 2000),
+                                 int(string[3:5]), int(string[6:8]),
+                                 int(string[10:12]), int(string[13:15]))
+            else:
+                local = datetime.strptime(string, Job._datetime_format)
         except TypeError:
             return None
+        return local.astimezone(timezone.utc)
 
     @staticmethod
-    def _strfromdatetime(dt: datetime) -> datetime:
-        try:
-            return dt.strftime(Job._datetime_format)
-        except TypeError:
+    def _strfromdatetime(dt: datetime) -> str:
+        """_datetime_format of dt in local time, formatted without strftime"""
+        if dt is None:
             return None
+        if dt.tzinfo is not None:
+            dt = dt.astimezone()
+        return '%02d-%02d-%02d::%02d:%02d' % (
+            dt.year % 100, dt.month, dt.day, dt.hour, dt.minute)
 
 
-class JobStatus(enum.IntEnum):
+Job._codec = Codec(Job, Job.SCHEMA, JobStatus,
+                   encode_time=Job._timetodb,
+                   decode_time=Job._timefromdb,
+                   extra_slots=Job._EXTRA_SLOTS)
+
+
+class JobLookup(NamedTuple):
     """
-    Enumeration for Job states
+    Result of looking up many job ids
+    jobs: job_id -> Job, in the order requested
+    missing: ids with no entry in the database
+    forbidden: ids not owned by the requesting user
     """
-    NONE = 0
-    SUBMITTED = 1
-    QUEUED = 2
-    STARTED = 3
-    FINISHED = 4
-    ERROR = 5
+    jobs: Dict[str, Job]
+    missing: List[str]
+    forbidden: List[str]
@@ -1,16 +1,31 @@
+from impression_web import aio
+from impression_web.cache import JobCache
+from impression_web.job.async_job import AsyncJob
+from impression_web.job.exceptions import JobAccessError
 from impression_web.job.gcp_job import GCPJob
+from impression_web.job.job import JobLookup
 
 
 class ImpressionJobFactory:
     """
     Create platform specific Job objects
     directly (job)
-    from dictionary (from_dict)
+    from dictionary (from_dict) or many dictionaries (from_dicts)
     from id (database job id)
+    from ids (many database job ids in one request)
+    many jobs to the database in batches (update_many)
+
+    With a JobCache, from_id/from_ids read through the cache
+
+    mode='async' creates AsyncJobs instead, from_id, from_ids and
+    update_many are then coroutines
     """
-    def __init__(self, platform):
+    def __init__(self, platform, cache: JobCache = None,
+                 mode: str = aio.SYNC):
         self.platform = platform
         self.cls_ = ImpressionJobFactory._select(platform)
+        self.cache = cache
+        self.mode = aio.check_mode(mode)
 
     @staticmethod
     def _select(platform):
@@ -21,12 +36,103 @@ class ImpressionJobFactory:
             raise NotImplementedError(
                 f'Invalid platform: {platform}')
 
+    def _wrap(self, job):
+        """Helper: job in the factory's mode"""
+        return AsyncJob(job) if self.mode == aio.ASYNC else job
+
     def job(self, *args, **kwargs):
         """Platform specific Job creation"""
-        return self.cls_(*args, **kwargs)
+        return self._wrap(self.cls_(*args, **kwargs))
 
     def from_dict(self, *args, **kwargs):
-        return self.cls_.from_dict(*args, **kwargs)
+        return self._wrap(self.cls_.from_dict(*args, **kwargs))
+
+    def from_dicts(self, *args, **kwargs):
+        jobs = self.cls_.from_dicts(*args, **kwargs)
+        if self.mode == aio.ASYNC:
+            return [AsyncJob(job) for job in jobs]
+        return jobs
+
+    def from_id(self, job_id, user, admin_access=None, **kwargs):
+        if self.mode == aio.ASYNC:
+            return self._async_from_id(job_id, user, admin_access, **kwargs)
+        return self._from_id(job_id, user, admin_access, **kwargs)
+
+    async def _async_from_id(self, *args, **kwargs):
+        return AsyncJob(await aio.run(self._from_id, *args, **kwargs))
+
+    def _from_id(self, job_id, user, admin_access=None, **kwargs):
+        if self.cache is None:
+            return self.cls_.from_id(job_id, user, admin_access, **kwargs)
+
+        entry = self.cache.get_synced(job_id)
+        if entry is None:
+            # Cache regardless of owner, access is checked on every lookup
+            job = self.cls_.from_id(job_id, user, True, **kwargs)
+            self.cache.put(job.to_dict(), job_id, job._update_time)
+        else:
+            job = self._from_cached(entry, **kwargs)
+
+        if job.user == user or admin_access:
+            return job
+        raise JobAccessError(f"{user} does not own {job_id}")
+
+    def from_ids(self, job_ids, user, admin_access=None, **kwargs):
+        if self.mode == aio.ASYNC:
+            return self._async_from_ids(job_ids, user, admin_access,
+                                        **kwargs)
+        return self._from_ids(job_ids, user, admin_access, **kwargs)
+
+    async def _async_from_ids(self, *args, **kwargs):
+        lookup = await aio.run(self._from_ids, *args, **kwargs)
+        return lookup._replace(jobs={job_id: AsyncJob(job) for job_id, job
+                                     in lookup.jobs.items()})
+
+    def _from_ids(self, job_ids, user, admin_access=None, **kwargs):
+        if self.cache is None:
+            return self.cls_.from_ids(job_ids, user, admin_access, **kwargs)
+
+        job_ids = list(dict.fromkeys(job_ids))
+        entries = {job_id: self.cache.get_synced(job_id)
+                   for job_id in job_ids}
+        fetched = self.cls_.from_ids(
+            [job_id for job_id, e in entries.items() if e is None],
+            user, True, **kwargs)
+        for job_id, job in fetched.jobs.items():
+            self.cache.put(job.to_dict(), job_id, job._update_time)
+
+        lookup = JobLookup(jobs={}, missing=fetched.missing, forbidden=[])
+        for job_id, entry in entries.items():
+            if entry is None:
+                job = fetched.jobs.get(job_id)
+                if job is None:
+                    continue
+            else:
+                job = self._from_cached(entry, **kwargs)
+
+            if job.user == user or admin_access:
+                lookup.jobs[job_id] = job
+            else:
+                lookup.forbidden.append(job_id)
+
+        return lookup
+
+    def _from_cached(self, entry, **kwargs):
+        """
+        Helper: job of a cached (document, update_time), in sync with its
+        database entry as of update_time so that updates stay partial
+        """
+        document, update_time = entry
+        job = self.cls_.from_dict(document, **kwargs)
+        job._mark_synced(update_time)
+        return job
+
+    def update_many(self, jobs, *args, **kwargs):
+        if self.mode == aio.ASYNC:
+            return self._async_update_many(jobs, *args, **kwargs)
+        return self.cls_.update_many(jobs, *args, **kwargs)
 
-    def from_id(self, *args, **kwargs):
-        return self.cls_.from_id(*args, **kwargs)
\ No newline at end of file
+    async def _async_update_many(self, jobs, *args, **kwargs):
+        return await aio.run(self.cls_.update_many,
+                             [aio.unwrap(job) for job in jobs],
+                             *args, **kwargs)
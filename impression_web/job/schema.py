@@ -0,0 +1,91 @@
+"""
+Declarative field schema for Job and the codec generated from it
+The codec's encode/decode functions are generated once per schema so that
+converting between jobs and their database representation is a flat
+sequence of attribute reads/writes, without per-key branching
+"""
+from typing import Callable, Dict, Iterable, List, NamedTuple
+
+# Field kinds
+VALUE = 'value'
+STATUS = 'status'
+TIME = 'time'
+
+
+class Field(NamedTuple):
+    """
+    A stored job field
+    name: key in the database representation
+    attr: slot holding the value on the job
+    kind: VALUE (stored as is), STATUS (JobStatus) or TIME (datetime)
+    default: value of the slot when the field is absent
+    """
+    name: str
+    attr: str
+    kind: str = VALUE
+    default: object = None
+
+
+class Codec:
+    """
+    Specialised encode/decode for a schema
+    encode(job) -> dict in schema order
+    decode(cls, src) -> new instance of cls (__init__ is not called),
+        slots not in the schema are set from extra_slots
+    decode_many(cls, srcs) -> list of new instances
+    """
+    def __init__(self, cls: type, fields: Iterable[Field],
+                 status_type: type, encode_time: Callable,
+                 decode_time: Callable, extra_slots: Dict[str, object]):
+        self.fields = tuple(fields)
+        namespace = {
+            'new': object.__new__,
+            'status_type': status_type,
+            'statuses': {s.value: s for s in status_type},
+            'encode_time': encode_time,
+            'decode_time': decode_time,
+        }
+
+        encode = ['def encode(job):', '    return {']
+        decode = ['def decode(cls, src):',
+                  '    job = new(cls)',
+                  '    get = src.get']
+        for i, field in enumerate(self.fields):
+            setter = f'set_{i}'
+            namespace[setter] = getattr(cls, field.attr).__set__
+            namespace[f'default_{i}'] = field.default
+            value = f'job.{field.attr}'
+            get = f'get({field.name!r}, default_{i})'
+
+            if field.kind == STATUS:
+                encode.append(f'        {field.name!r}: {value}.value,')
+                decode.append(f'    value = {get}')
+                decode.append(f'    {setter}(job, statuses[value] '
+                              f'if value in statuses '
+                              f'else status_type(value))')
+            elif field.kind == TIME:
+                encode.append(
+                    f'        {field.name!r}: encode_time({value}),')
+                decode.append(f'    {setter}(job, decode_time({get}))')
+            else:
+                encode.append(f'        {field.name!r}: {value},')
+                decode.append(f'    {setter}(job, {get})')
+        encode.append('    }')
+
+        for i, (attr, default) in enumerate(extra_slots.items()):
+            setter = f'extra_{i}'
+            namespace[setter] = getattr(cls, attr).__set__
+            # mutable defaults (e.g. set()) are copied for every instance
+            namespace[f'extra_default_{i}'] = default
+            copy = '.copy()' if isinstance(default, (dict, list, set)) else ''
+            decode.append(f'    {setter}(job, extra_default_{i}{copy})')
+        decode.append('    return job')
+
+        exec('\n'.join(encode), namespace)
+        exec('\n'.join(decode), namespace)
+        self.encode: Callable = namespace['encode']
+        self.decode: Callable = namespace['decode']
+
+    def decode_many(self, cls: type, srcs: Iterable[dict]) -> List:
+        decode = self.decode
+        return [decode(cls, src) for src in srcs]
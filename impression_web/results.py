@@ -0,0 +1,180 @@
+"""
+NMREDATA results of output files as NumPy arrays
+Shifts (NMREDATA_ASSIGNMENT) and couplings (NMREDATA_J) of every molecule
+of a file are parsed together: the text of all blocks is tokenised and
+converted column by column in single array operations
+
+Results: structured arrays of shifts and couplings, with a compact binary
+    form (to_bytes/from_bytes)
+load_output: results of a stored output, optionally through a DiskCache
+    keyed by output_name
+"""
+import io
+import pathlib
+import re
+import tempfile
+from typing import BinaryIO, NamedTuple
+
+import numpy as np
+
+from impression_web import sdf
+from impression_web.storage.disk_cache import DiskCache
+from impression_web.storage.file_storage import ImpressionFileStorage
+
+ASSIGNMENT = b'NMREDATA_ASSIGNMENT'
+COUPLING = b'NMREDATA_J'
+# Cache token of parsed results, change whenever their arrays change
+CACHE_FORMAT = 'nmredata-1'
+
+SHIFT_DTYPE = np.dtype([('molecule', '<i4'), ('atom', '<i4'),
+                        ('shift', '<f8'), ('element', '<i2'),
+                        ('error', '<f8')])
+
+
+def coupling_dtype(type_size: int = 8) -> np.dtype:
+    """Couplings with type labels of up to type_size bytes"""
+    return np.dtype([('molecule', '<i4'), ('atom1', '<i4'),
+                     ('atom2', '<i4'), ('value', '<f8'),
+                     ('type', f'S{type_size}'), ('error', '<f8')])
+
+
+class Results(NamedTuple):
+    """
+    Parsed results of an output file, molecules in file order
+    names: title (first line) of each molecule
+    shifts: SHIFT_DTYPE rows, atom index, shift, element (atomic number)
+    couplings: coupling_dtype rows, atom pair, value, type (e.g. b'1JCH')
+    Rows are grouped by their molecule index
+    """
+    names: np.ndarray
+    shifts: np.ndarray
+    couplings: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def molecule(self, i: int) -> tuple:
+        """(shifts, couplings) of molecule i, views of the arrays"""
+        return (_rows(self.shifts, i), _rows(self.couplings, i))
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez(buffer, names=self.names, shifts=self.shifts,
+                 couplings=self.couplings)
+        return buffer.getvalue()
+
+    @staticmethod
+    def from_bytes(raw: bytes) -> 'Results':
+        with np.load(io.BytesIO(raw), allow_pickle=False) as arrays:
+            return Results(arrays['names'], arrays['shifts'],
+                           arrays['couplings'])
+
+
+def _rows(rows: np.ndarray, molecule: int) -> np.ndarray:
+    """Helper: the rows of molecule, rows being ordered by molecule"""
+    start, end = np.searchsorted(rows['molecule'], [molecule, molecule + 1])
+    return rows[start:end]
+
+
+def _block_pattern(tag: bytes):
+    """Helper: regex of the data lines of a tag, up to a blank line"""
+    return re.compile(rb'^>\s*<' + re.escape(tag) + rb'>[^\n]*\n(.*?)'
+                      rb'(?=\n[ \t\r]*\n|\n\$\$\$\$|\Z)', re.M | re.S)
+
+
+_BLOCKS = {ASSIGNMENT: _block_pattern(ASSIGNMENT),
+           COUPLING: _block_pattern(COUPLING)}
+_SEPARATORS = bytes.maketrans(b',\\', b'  ')
+
+
+def _table(data, tag: bytes, ends: np.ndarray, columns: int) -> tuple:
+    """
+    Helper: (molecule index of each row, tokens shaped (rows, columns))
+    of the tag blocks in data, ends being the record ends
+    """
+    starts, texts, rows = [], [], []
+    for match in _BLOCKS[tag].finditer(data):
+        text = match.group(1).strip()
+        if text:
+            starts.append(match.start())
+            texts.append(text)
+            rows.append(text.count(b'\n') + 1)
+
+    tokens = np.array(b' '.join(texts).translate(_SEPARATORS).split())
+    if tokens.size != sum(rows) * columns:
+        raise ValueError(f'Malformed {tag.decode()} block: expected '
+                         f'{columns} columns')
+    molecules = np.repeat(np.searchsorted(ends, starts, side='right'), rows)
+    return molecules, tokens.reshape(-1, columns)
+
+
+def parse(data) -> Results:
+    """
+    Results of the records of data (bytes or a memory map of an output)
+    Raises ValueError on malformed blocks
+    """
+    offsets = np.frombuffer(sdf.SDFIndex.build(data).offsets, dtype='<u8')
+    names = np.array([bytes(data[start:start + 256]).split(b'\n', 1)[0]
+                      .strip().decode(errors='replace')
+                      for start in offsets[:-1]], dtype=str)
+    ends = offsets[1:]
+
+    molecules, table = _table(data, ASSIGNMENT, ends, 4)
+    shifts = np.empty(len(table), SHIFT_DTYPE)
+    shifts['molecule'] = molecules
+    shifts['atom'] = table[:, 0].astype(np.int32)
+    shifts['shift'] = table[:, 1].astype(np.float64)
+    shifts['element'] = table[:, 2].astype(np.int16)
+    shifts['error'] = table[:, 3].astype(np.float64)
+
+    molecules, table = _table(data, COUPLING, ends, 5)
+    types = table[:, 3]
+    couplings = np.empty(len(table), coupling_dtype(
+        int(np.char.str_len(types).max()) if len(types) else 8))
+    couplings['molecule'] = molecules
+    couplings['atom1'] = table[:, 0].astype(np.int32)
+    couplings['atom2'] = table[:, 1].astype(np.int32)
+    couplings['value'] = table[:, 2].astype(np.float64)
+    couplings['type'] = types
+    couplings['error'] = table[:, 4].astype(np.float64)
+
+    return Results(names, shifts, couplings)
+
+
+def parse_file(path: pathlib.PurePath) -> Results:
+    """Results of the output file at path (memory mapped)"""
+    with open(path, 'rb') as file:
+        data = sdf.map_file(file)
+        try:
+            return parse(data)
+        finally:
+            if not isinstance(data, bytes):
+                data.close()
+
+
+def parse_stream(stream: BinaryIO) -> Results:
+    """Results of the content of a readable stream (e.g. open_output)"""
+    with stream:
+        return parse(stream.read())
+
+
+def load_output(storage: ImpressionFileStorage, output_name: str,
+                cache: DiskCache = None) -> Results:
+    """
+    Results of output_name in storage's output bucket
+    With cache, parsed results are kept in (and served from) it under
+    output_name: outputs are written once, so the entry stays valid
+    """
+    if cache is None:
+        return parse_stream(storage.open_output(output_name))
+
+    key = f'results/{output_name}'
+    with tempfile.TemporaryDirectory() as directory:
+        path = pathlib.Path(directory) / 'results.npz'
+        if cache.get(key, CACHE_FORMAT, path):
+            return Results.from_bytes(path.read_bytes())
+
+        results = parse_stream(storage.open_output(output_name))
+        path.write_bytes(results.to_bytes())
+        cache.put(key, CACHE_FORMAT, path)
+        return results
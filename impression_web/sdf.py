@@ -0,0 +1,265 @@
+"""
+Lazy access to multi-record SDF (NMREDATA) files
+Records are separated by '$$$$' lines; a final record may omit it
+
+SDFIndex: byte offsets of the records of a file, built in one scan and
+    stored (to_bytes/from_bytes, upload_index/download_index) so that
+    files can be sized, split and randomly accessed without reading them
+SDFFile: memory mapped file iterating its records lazily
+
+Records are bytes as stored, including their '$$$$' line, so that
+concatenated records reproduce the file
+"""
+from array import array
+import io
+import mmap
+import pathlib
+import struct
+import sys
+from typing import BinaryIO, Iterator, Optional
+
+from impression_web.storage.file_storage import ImpressionFileStorage, \
+    INPUT
+
+DELIMITER = b'$$$$'
+# Stored index layout: MAGIC, then file size and record count, then the
+# count + 1 record boundaries, all little endian unsigned 64 bit
+MAGIC = b'SDFIDX1\n'
+_HEADER = struct.Struct('<QQ')
+INDEX_SUFFIX = '.index'
+
+
+def _record_ends(data) -> Iterator[int]:
+    """Helper: offsets just past each '$$$$' line of data (bytes/mmap)"""
+    position = 0
+    size = len(data)
+    while True:
+        if data[position:position + len(DELIMITER)] == DELIMITER:
+            found = position
+        else:
+            found = data.find(b'\n' + DELIMITER, position)
+            if found < 0:
+                return
+            found += 1
+        end = data.find(b'\n', found)
+        position = size if end < 0 else end + 1
+        yield position
+        if position >= size:
+            return
+
+
+class SDFIndex:
+    """
+    Record boundaries of an SDF file of size bytes
+    Record i spans bytes offsets[i] to offsets[i + 1]
+    len() is the number of records (molecules)
+    """
+    __slots__ = ('size', 'offsets')
+
+    def __init__(self, size: int, offsets: array):
+        self.size = size
+        self.offsets = offsets
+
+    @staticmethod
+    def build(data) -> 'SDFIndex':
+        """Index of the content of data (bytes or a memory map)"""
+        offsets = array('Q', [0])
+        offsets.extend(_record_ends(data))
+        # a final record without '$$$$', unless only whitespace is left
+        if _has_content(data, offsets[-1]):
+            offsets.append(len(data))
+        return SDFIndex(len(data), offsets)
+
+    @staticmethod
+    def from_file(path: pathlib.PurePath) -> 'SDFIndex':
+        with open(path, 'rb') as file:
+            data = map_file(file)
+            try:
+                return SDFIndex.build(data)
+            finally:
+                if isinstance(data, mmap.mmap):
+                    data.close()
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __eq__(self, other) -> bool:
+        return (isinstance(other, SDFIndex) and self.size == other.size
+                and self.offsets == other.offsets)
+
+    def span(self, i: int) -> tuple:
+        """(start, end) byte offsets of record i"""
+        if not -len(self) <= i < len(self):
+            raise IndexError(f'record {i} out of range ({len(self)})')
+        i %= len(self)
+        return self.offsets[i], self.offsets[i + 1]
+
+    def to_bytes(self) -> bytes:
+        offsets = array('Q', self.offsets)
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return (MAGIC + _HEADER.pack(self.size, len(self))
+                + offsets.tobytes())
+
+    @staticmethod
+    def from_bytes(raw: bytes) -> 'SDFIndex':
+        """Index from to_bytes, raise ValueError if malformed"""
+        start = len(MAGIC) + _HEADER.size
+        if raw[:len(MAGIC)] != MAGIC or len(raw) < start:
+            raise ValueError('Not an SDF index')
+        size, count = _HEADER.unpack_from(raw, len(MAGIC))
+        offsets = array('Q')
+        if len(raw) - start != (count + 1) * offsets.itemsize:
+            raise ValueError('Truncated SDF index')
+        offsets.frombytes(raw[start:])
+        if sys.byteorder == 'big':
+            offsets.byteswap()
+        return SDFIndex(size, offsets)
+
+
+def _has_content(data, start: int, chunk_size: int = 64 * 1024) -> bool:
+    """Helper: is there anything but whitespace in data from start"""
+    for position in range(start, len(data), chunk_size):
+        if data[position:position + chunk_size].strip():
+            return True
+    return False
+
+
+def map_file(file):
+    """Read only memory map of open file (empty bytes if it is empty)"""
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        # empty files cannot be mapped
+        return b''
+
+
+class SDFFile:
+    """
+    Memory mapped SDF file at path, use as a context manager or close()
+    Iterating yields records lazily, file[i] is record i and len(file)
+    the record count, both through the index (built on first use if
+    not given)
+    Raises ValueError if the given index is not of this file
+    """
+    def __init__(self, path: pathlib.PurePath, index: SDFIndex = None):
+        self.path = pathlib.Path(path)
+        self._file = open(self.path, 'rb')
+        self._data = map_file(self._file)
+        if index is not None and index.size != len(self._data):
+            self.close()
+            raise ValueError(f'Index of a {index.size} byte file, '
+                             f'{self.path} has {len(self._data)} bytes')
+        self._index = index
+
+    @property
+    def index(self) -> SDFIndex:
+        if self._index is None:
+            self._index = SDFIndex.build(self._data)
+        return self._index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, i: int) -> bytes:
+        start, end = self.index.span(i)
+        return self._data[start:end]
+
+    def __iter__(self) -> Iterator[bytes]:
+        """Records in order, scanning the file unless indexed"""
+        if self._index is not None:
+            return self.records()
+        return self._scan()
+
+    def _scan(self) -> Iterator[bytes]:
+        start = 0
+        for end in _record_ends(self._data):
+            yield self._data[start:end]
+            start = end
+        if _has_content(self._data, start):
+            yield self._data[start:]
+
+    def records(self, start: int = 0,
+                stop: Optional[int] = None) -> Iterator[bytes]:
+        """Records start to stop (all remaining if None)"""
+        offsets = self.index.offsets
+        stop = len(self) if stop is None else min(stop, len(self))
+        for i in range(start, stop):
+            yield self._data[offsets[i]:offsets[i + 1]]
+
+    def open_records(self, start: int = 0,
+                     stop: Optional[int] = None) -> BinaryIO:
+        """
+        Seekable stream of the bytes of records start to stop (all
+        remaining if None), read from the map without copying them all
+        Must be closed before the file
+        """
+        offsets = self.index.offsets
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return io.BytesIO()
+        return io.BufferedReader(
+            _SpanReader(self._data, offsets[start], offsets[stop]))
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+    def __enter__(self) -> 'SDFFile':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _SpanReader(io.RawIOBase):
+    """Raw seekable reader of data[start:end]"""
+    def __init__(self, data, start: int, end: int):
+        self._data = data
+        self._start = start
+        self._end = end
+        self._position = start
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position - self._start
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: self._start, io.SEEK_CUR: self._position,
+                io.SEEK_END: self._end}[whence]
+        self._position = min(max(base + offset, self._start), self._end)
+        return self.tell()
+
+    def readinto(self, b) -> int:
+        chunk = self._data[self._position:min(self._position + len(b),
+                                              self._end)]
+        b[:len(chunk)] = chunk
+        self._position += len(chunk)
+        return len(chunk)
+
+
+def index_name(file_name: str) -> str:
+    """Name the index of a stored file is kept under, beside it"""
+    return file_name + INDEX_SUFFIX
+
+
+def upload_index(storage: ImpressionFileStorage, file_name: str,
+                 index: SDFIndex):
+    """Store index of input file_name beside it in storage's input bucket"""
+    storage.upload_bytes(index.to_bytes(), index_name(file_name), INPUT)
+
+
+def download_index(storage: ImpressionFileStorage,
+                   file_name: str) -> SDFIndex:
+    """
+    Index stored beside input file_name by upload_index
+    Raises FileTransferError if there is none
+    """
+    return SDFIndex.from_bytes(
+        storage.download_bytes(index_name(file_name), INPUT))
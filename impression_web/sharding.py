@@ -0,0 +1,87 @@
+"""
+Splitting multi-record SDF inputs into shards at record boundaries so
+that one submission runs as many child jobs
+plan: record ranges of the shards
+upload_shards: upload the shards of a file in parallel
+shard_name/merged_name: stored names of shard inputs and merged outputs
+
+Child jobs are created, and their parent completed, by the database
+(Database.shard_job)
+"""
+import pathlib
+from typing import List, Tuple
+
+from impression_web import sdf
+from impression_web.storage.file_storage import ImpressionFileStorage
+from impression_web.storage.transfer import DEFAULT_MAX_WORKERS, \
+    transfer_many
+
+SHARD_PREFIX = 'shards/'
+
+
+def plan(records: int, shards: int = None,
+         max_records: int = None) -> List[Tuple[int, int]]:
+    """
+    Contiguous (start, stop) record ranges splitting records into shards
+    ranges of sizes differing by at most one, or with max_records into as
+    few ranges as keep each within max_records
+    Empty ranges are never returned
+    """
+    if (shards is None) == (max_records is None):
+        raise ValueError('Give one of shards and max_records')
+    if shards is None:
+        if max_records < 1:
+            raise ValueError(f'max_records must be positive: {max_records}')
+        shards = -(-records // max_records)
+    elif shards < 1:
+        raise ValueError(f'shards must be positive: {shards}')
+
+    shards = min(shards, records)
+    size, extra = divmod(records, shards) if shards else (0, 0)
+    ranges = []
+    start = 0
+    for i in range(shards):
+        stop = start + size + (i < extra)
+        ranges.append((start, stop))
+        start = stop
+    return ranges
+
+
+def shard_name(job_id: str, shard_index: int, suffix: str = '') -> str:
+    """Input file name of shard shard_index of job_id"""
+    return f'{SHARD_PREFIX}{job_id}/{shard_index:05d}{suffix}'
+
+
+def merged_name(job_id: str, suffix: str = '') -> str:
+    """Output file name of the merged outputs of the shards of job_id"""
+    return f'{SHARD_PREFIX}{job_id}/merged{suffix}'
+
+
+def upload_shards(storage: ImpressionFileStorage, path: pathlib.PurePath,
+                  ranges: List[Tuple[int, int]], names: List[str],
+                  index: sdf.SDFIndex = None,
+                  max_workers: int = DEFAULT_MAX_WORKERS) -> List[str]:
+    """
+    Upload records start to stop of the SDF file at path to the input
+    bucket as names[i], for each (start, stop) of ranges, in parallel
+    Records are streamed from a memory map of the file
+    Return the stored names (content names with deduplicate)
+
+    Raises FileTransferError if any shard failed, the uploaded ones are
+    then deleted
+    """
+    with sdf.SDFFile(path, index) as records:
+        offsets = records.index.offsets
+
+        def upload(name, span):
+            with records.open_records(*span) as stream:
+                stored = storage.upload_input_stream(stream, name)
+            return stored, offsets[span[1]] - offsets[span[0]]
+
+        report = transfer_many(upload, zip(names, ranges), max_workers)
+
+    if report.failed:
+        storage.delete_many([r.file_name for r in report.succeeded],
+                            max_workers=max_workers)
+        report.raise_for_errors()
+    return [result.file_name for result in report]
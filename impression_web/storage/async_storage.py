@@ -0,0 +1,145 @@
+"""
+Asyncio counterpart of ImpressionFileStorage
+AsyncReader: readable stream whose reads are awaited
+"""
+import io
+import pathlib
+from typing import BinaryIO, Iterable
+
+from impression_web import aio
+from impression_web.storage.file_storage import ImpressionFileStorage, \
+    INPUT, OUTPUT
+from impression_web.storage.signing import DEFAULT_URL_LIFETIME, SignedURL
+from impression_web.storage.transfer import DEFAULT_MAX_WORKERS, \
+    TransferReport
+
+
+class AsyncReader:
+    """
+    Stream of a stored file, read off the event loop
+    await read(size), async for over chunks of chunk_size bytes, and
+    async with (or await close()) to release it
+    """
+    def __init__(self, stream: BinaryIO,
+                 chunk_size: int = io.DEFAULT_BUFFER_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+
+    async def read(self, size: int = -1) -> bytes:
+        return await aio.run(self.stream.read, size)
+
+    async def close(self):
+        await aio.run(self.stream.close)
+
+    async def __aenter__(self) -> 'AsyncReader':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def __aiter__(self):
+        while True:
+            chunk = await self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class AsyncFileStorage(aio.Counterpart):
+    """
+    ImpressionFileStorage (sync) whose transfers are coroutines with the
+    same arguments and results; open_input/open_output return
+    AsyncReaders
+
+    Platform calls run on the shared aio executor, see impression_web.aio,
+    so many transfers proceed concurrently per event loop
+    Created by ImpressionFileStorageFactory(platform, mode='async')
+    """
+    __slots__ = ()
+
+    def __init__(self, storage: ImpressionFileStorage):
+        super().__init__(storage)
+
+    async def upload_input_file(self, file_path: pathlib.PurePath,
+                                file_name: str = None) -> str:
+        return await aio.run(self.sync.upload_input_file, file_path,
+                             file_name)
+
+    async def download_input_file(self, destination: pathlib.PurePath,
+                                  file_name: str = None):
+        await aio.run(self.sync.download_input_file, destination, file_name)
+
+    async def upload_output_file(self, file_path: pathlib.PurePath,
+                                 file_name: str = None):
+        await aio.run(self.sync.upload_output_file, file_path, file_name)
+
+    async def download_output_file(self, destination: pathlib.PurePath,
+                                   file_name: str = None):
+        await aio.run(self.sync.download_output_file, destination,
+                      file_name)
+
+    async def delete_input_file(self, file_name: str):
+        await aio.run(self.sync.delete_input_file, file_name)
+
+    async def delete_output_file(self, file_name: str):
+        await aio.run(self.sync.delete_output_file, file_name)
+
+    async def references(self, file_name: str) -> int:
+        return await aio.run(self.sync.references, file_name)
+
+    async def output_url(self, file_name: str,
+                         lifetime: float = DEFAULT_URL_LIFETIME
+                         ) -> SignedURL:
+        return await aio.run(self.sync.output_url, file_name, lifetime)
+
+    async def merge_outputs(self, file_names: Iterable[str],
+                            merged_name: str) -> str:
+        return await aio.run(self.sync.merge_outputs, list(file_names),
+                             merged_name)
+
+    async def upload_input_stream(self, fileobj: BinaryIO,
+                                  file_name: str) -> str:
+        return await aio.run(self.sync.upload_input_stream, fileobj,
+                             file_name)
+
+    async def upload_output_stream(self, fileobj: BinaryIO, file_name: str):
+        await aio.run(self.sync.upload_output_stream, fileobj, file_name)
+
+    async def open_input(self, file_name: str) -> AsyncReader:
+        return self._reader(
+            await aio.run(self.sync.open_input, file_name))
+
+    async def open_output(self, file_name: str) -> AsyncReader:
+        return self._reader(
+            await aio.run(self.sync.open_output, file_name))
+
+    def _reader(self, stream: BinaryIO) -> AsyncReader:
+        return AsyncReader(stream,
+                           self.sync.chunk_size or io.DEFAULT_BUFFER_SIZE)
+
+    async def upload_bytes(self, data: bytes, file_name: str,
+                           bucket: str = INPUT):
+        await aio.run(self.sync.upload_bytes, data, file_name, bucket)
+
+    async def download_bytes(self, file_name: str,
+                             bucket: str = OUTPUT) -> bytes:
+        return await aio.run(self.sync.download_bytes, file_name, bucket)
+
+    async def upload_many(self, files: Iterable, bucket: str = INPUT,
+                          max_workers: int = DEFAULT_MAX_WORKERS
+                          ) -> TransferReport:
+        return await aio.run(self.sync.upload_many, files, bucket,
+                             max_workers)
+
+    async def download_many(self, files: Iterable, bucket: str = OUTPUT,
+                            max_workers: int = DEFAULT_MAX_WORKERS
+                            ) -> TransferReport:
+        return await aio.run(self.sync.download_many, files, bucket,
+                             max_workers)
+
+    async def delete_many(self, file_names: Iterable[str],
+                          bucket: str = INPUT,
+                          max_workers: int = DEFAULT_MAX_WORKERS
+                          ) -> TransferReport:
+        return await aio.run(self.sync.delete_many, file_names, bucket,
+                             max_workers)
@@ -0,0 +1,117 @@
+"""
+Streaming compression of stored files
+Compressed files carry their method in metadata under METADATA_KEY, files
+without it are stored raw, so compressed and raw files can be mixed
+
+GZIP uses the standard library, ZSTD requires the zstandard package
+"""
+import gzip
+import io
+import zlib
+from typing import BinaryIO, Optional
+
+from impression_web.storage.streams import RewindableReader
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+METHODS = (GZIP, ZSTD)
+METADATA_KEY = 'impression-compression'
+
+# Bytes read from the source per compression step, and the window of
+# compressed output kept for rewinding (chunk retries of uploads)
+DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(
+            'zstd compression requires the zstandard package') from e
+    return zstandard
+
+
+def check(method: Optional[str]):
+    """Raise ValueError for unknown methods, ImportError if unavailable"""
+    if method is None:
+        return
+    if method not in METHODS:
+        raise ValueError(f'Unknown compression: {method}, use one of '
+                         f'{METHODS}')
+    if method == ZSTD:
+        _zstandard()
+
+
+def _compressor(method: str, level: int = None):
+    if method == GZIP:
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+    if method == ZSTD:
+        return _zstandard().ZstdCompressor(
+            level=3 if level is None else level).compressobj()
+    raise ValueError(f'Unknown compression: {method}')
+
+
+class CompressingReader(RewindableReader):
+    """
+    Readable stream of the compressed content of source, compressed
+    chunk_size bytes at a time as it is read
+    tell() and seeking back by up to rewind bytes are supported so that
+    resumable uploads can retry their last chunk
+    """
+    def __init__(self, source: BinaryIO, method: str,
+                 chunk_size: int = DEFAULT_CHUNK_SIZE, rewind: int = 0,
+                 level: int = None):
+        super().__init__(rewind)
+        self._source = source
+        self._compressor = _compressor(method, level)
+        self._chunk_size = chunk_size
+
+    def _fill(self) -> bytes:
+        chunk = self._source.read(self._chunk_size)
+        if chunk:
+            return self._compressor.compress(chunk)
+        self._eof = True
+        return self._compressor.flush()
+
+
+class _DecompressingReader(io.RawIOBase):
+    """Raw reader over a decompressing stream, closing both on close"""
+    def __init__(self, stream: BinaryIO, reader):
+        self._stream = stream
+        self._reader = reader
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        return self._reader.readinto(b)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._reader.close()
+            finally:
+                self._stream.close()
+        super().close()
+
+
+def decompressing_reader(stream: BinaryIO, method: Optional[str],
+                         chunk_size: int = io.DEFAULT_BUFFER_SIZE
+                         ) -> BinaryIO:
+    """
+    Readable stream of the decompressed content of stream (returned as
+    is when method is None)
+    Closing it closes stream
+    """
+    if method is None:
+        return stream
+    if method == GZIP:
+        reader = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif method == ZSTD:
+        # merged outputs are several frames one after another
+        reader = _zstandard().ZstdDecompressor().stream_reader(
+            stream, read_across_frames=True)
+    else:
+        raise ValueError(f'Unknown compression: {method}')
+    return io.BufferedReader(_DecompressingReader(stream, reader), chunk_size)
@@ -0,0 +1,185 @@
+"""
+Bounded local disk cache of downloaded files
+Entries are validated against a version token of the stored file (blob
+generation and checksum) so a changed file is never served stale, and
+are evicted least recently used first once the cache exceeds its size
+
+Files are placed atomically (written aside, then renamed), in the cache
+and at download destinations
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import threading
+import uuid
+
+
+class DiskCache:
+    """
+    Thread safe LRU of files in directory, holding at most max_bytes
+    get(): place the cached file at a destination if still current
+    put(): cache a downloaded file
+    Entries survive restarts: they are reloaded from directory
+
+    link: place hits as hard links rather than copies (callers must then
+        not modify downloaded files in place)
+    """
+    def __init__(self, directory: pathlib.PurePath, max_bytes: int,
+                 link: bool = False):
+        if max_bytes < 1:
+            raise ValueError(f'max_bytes must be positive: {max_bytes}')
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.link = link
+
+        self._lock = threading.Lock()
+        # key -> (token, size), least recently used first
+        self._entries = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._load()
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.directory / hashlib.sha256(key.encode()).hexdigest()
+
+    @staticmethod
+    def _index_path(path: pathlib.Path) -> pathlib.Path:
+        return path.with_suffix('.json')
+
+    def _load(self):
+        """Helper: index entries left in directory, oldest use first"""
+        for leftover in self.directory.glob('.*.p*'):
+            leftover.unlink()
+        entries = []
+        for index in self.directory.glob('*.json'):
+            path = index.with_suffix('')
+            try:
+                entry = json.loads(index.read_text())
+                entries.append((path.stat().st_mtime_ns, entry))
+            except (OSError, ValueError):
+                self._remove_files(path)
+        for _, entry in sorted(entries, key=lambda e: e[0]):
+            self._entries[entry['key']] = (entry['token'], entry['size'])
+            self.bytes += entry['size']
+        with self._lock:
+            self._evict()
+
+    def _remove_files(self, path: pathlib.Path):
+        for file in (path, self._index_path(path)):
+            try:
+                file.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _remove(self, key: str):
+        """Helper: remove key, lock must be held"""
+        _, size = self._entries.pop(key)
+        self.bytes -= size
+        self._remove_files(self._path(key))
+
+    def _evict(self):
+        """Helper: drop least recently used entries, lock must be held"""
+        while self.bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def get(self, key: str, token: str,
+            destination: pathlib.PurePath) -> bool:
+        """
+        Place the cached file of key at destination if it was cached with
+        token (the current version of the stored file)
+        Return False on a miss, destination is then untouched
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != token:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return False
+            path = self._path(key)
+            # pin the content against eviction while it is placed
+            pinned = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.pin')
+            try:
+                # recency survives restarts through the modification time
+                os.utime(path)
+                try:
+                    os.link(path, pinned)
+                except OSError:
+                    shutil.copyfile(path, pinned)
+            except OSError:
+                # the cached file was removed behind the cache's back
+                self._remove(key)
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+        try:
+            _place(pinned, pathlib.Path(destination), self.link)
+        finally:
+            pinned.unlink()
+        return True
+
+    def put(self, key: str, token: str, source: pathlib.PurePath):
+        """Cache a copy of the file at source as version token of key"""
+        size = os.path.getsize(source)
+        if size > self.max_bytes:
+            return
+        path = self._path(key)
+        partial = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.part')
+        shutil.copyfile(source, partial)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            os.replace(partial, path)
+            self._index_path(path).write_text(
+                json.dumps({'key': key, 'token': token, 'size': size}))
+            self._entries[key] = (token, size)
+            self.bytes += size
+            self._evict()
+
+    def invalidate(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {u'hits': self.hits,
+                    u'misses': self.misses,
+                    u'evictions': self.evictions,
+                    u'entries': len(self._entries),
+                    u'bytes': self.bytes}
+
+
+def _place(source: pathlib.Path, destination: pathlib.Path, link: bool):
+    """Atomically put a copy (or hard link) of source at destination"""
+    partial = destination.with_name(
+        f'.{destination.name}.{uuid.uuid4().hex}.part')
+    if link:
+        try:
+            os.link(source, partial)
+        except OSError:
+            # e.g. another filesystem
+            shutil.copyfile(source, partial)
+    else:
+        shutil.copyfile(source, partial)
+    try:
+        os.replace(partial, destination)
+    except OSError:
+        partial.unlink()
+        raise
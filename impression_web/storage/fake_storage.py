@@ -0,0 +1,301 @@
+"""
+In-process stand-in for the google cloud storage client
+Implements the subset of the client API used by GCPStorage so that
+storage code can be exercised (and benchmarked) offline
+Requests may be slowed down to model the network, see FakeStorageClient
+"""
+import base64
+import gzip
+import io
+import itertools
+import threading
+import time
+from typing import BinaryIO, Dict, List, Optional
+import zlib
+
+import google.api_core.exceptions
+
+
+class _Object:
+    """Stored generation of an object"""
+    __slots__ = ('data', 'metadata', 'content_encoding', 'generation',
+                 'metageneration')
+
+    def __init__(self, data: bytes, metadata: Optional[Dict[str, str]],
+                 generation: int, content_encoding: str = None):
+        self.data = data
+        self.metadata = metadata
+        self.content_encoding = content_encoding
+        self.generation = generation
+        self.metageneration = 1
+
+
+class FakeBlob:
+    """
+    Object of a FakeBucket, loaded (generation, metadata, ...) when
+    returned by get_blob or after a write
+    Objects with content_encoding gzip are decompressed on download
+    unless raw_download, as by the library
+    """
+    def __init__(self, bucket: 'FakeBucket', name: str,
+                 chunk_size: int = None):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = chunk_size
+        self.metadata = None
+        self.content_encoding = None
+        self.generation = None
+        self.metageneration = None
+        self.size = None
+        self.crc32c = None
+
+    @property
+    def _client(self) -> 'FakeStorageClient':
+        return self.bucket.client
+
+    def _not_found(self) -> google.api_core.exceptions.NotFound:
+        return google.api_core.exceptions.NotFound(
+            f'No such object: {self.bucket.name}/{self.name}')
+
+    def _load(self, stored: _Object) -> 'FakeBlob':
+        self.metadata = (None if stored.metadata is None
+                         else dict(stored.metadata))
+        self.content_encoding = stored.content_encoding
+        self.generation = stored.generation
+        self.metageneration = stored.metageneration
+        self.size = len(stored.data)
+        # base64 checksum as the library reports it (crc32 stands in for
+        # crc32c, both only identify the content)
+        self.crc32c = base64.b64encode(
+            zlib.crc32(stored.data).to_bytes(4, 'big')).decode()
+        return self
+
+    def exists(self) -> bool:
+        self._client._round_trip()
+        return self._client._get(self.bucket.name, self.name) is not None
+
+    def upload_from_file(self, file_obj: BinaryIO,
+                         if_generation_match: int = None):
+        """
+        Store the remaining content of file_obj, one request per
+        chunk_size bytes when set (resumable upload), else one request
+        if_generation_match=0: only if there is no live object
+        """
+        chunks = []
+        while True:
+            chunk = file_obj.read(self.chunk_size or -1)
+            if self.chunk_size is not None:
+                self._client._round_trip(len(chunk))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if self.chunk_size is None:
+                break
+        data = b''.join(chunks)
+        if self.chunk_size is None:
+            self._client._round_trip(len(data))
+        self._load(self._client._put(self.bucket.name, self.name, data,
+                                     self.metadata, if_generation_match,
+                                     self.content_encoding))
+
+    def upload_from_filename(self, filename: str, **kwargs):
+        with open(filename, 'rb') as file_obj:
+            self.upload_from_file(file_obj, **kwargs)
+
+    def upload_from_string(self, data, **kwargs):
+        if isinstance(data, str):
+            data = data.encode()
+        self.upload_from_file(io.BytesIO(data), **kwargs)
+
+    def _stored(self, if_generation_match: int = None) -> _Object:
+        stored = self._client._get(self.bucket.name, self.name)
+        if stored is None:
+            raise self._not_found()
+        if (if_generation_match is not None and
+                stored.generation != if_generation_match):
+            raise google.api_core.exceptions.PreconditionFailed(
+                f'{self.bucket.name}/{self.name} is not at generation '
+                f'{if_generation_match}')
+        return stored
+
+    def download_as_bytes(self, start: int = None, end: int = None,
+                          raw_download: bool = False,
+                          if_generation_match: int = None,
+                          checksum: str = 'md5') -> bytes:
+        """Content, bytes start to end (inclusive) of it if given"""
+        data = self._stored(if_generation_match).data
+        if self.content_encoding == 'gzip' and not raw_download:
+            data = gzip.decompress(data)
+        data = data[start or 0:None if end is None else end + 1]
+        self._client._round_trip(len(data))
+        return data
+
+    def download_to_filename(self, filename: str,
+                             raw_download: bool = False,
+                             if_generation_match: int = None):
+        with open(filename, 'wb') as file_obj:
+            file_obj.write(self.download_as_bytes(
+                raw_download=raw_download,
+                if_generation_match=if_generation_match))
+
+    def patch(self, if_metageneration_match: int = None):
+        """Store metadata, at metageneration if given"""
+        self._client._round_trip()
+        self._load(self._client._patch(self.bucket.name, self.name,
+                                       self.metadata,
+                                       if_metageneration_match))
+
+    def delete(self):
+        self.bucket.delete_blob(self.name)
+
+    def compose(self, sources: List['FakeBlob']):
+        """
+        Store the content of sources, in order, with metadata and
+        content_encoding
+        """
+        self._client._round_trip()
+        client = self._client
+        with client._lock:
+            parts = [client._get(self.bucket.name, source.name)
+                     for source in sources]
+            missing = [s.name for s, p in zip(sources, parts) if p is None]
+            if missing:
+                raise google.api_core.exceptions.NotFound(
+                    f'No such object: {self.bucket.name}/{missing[0]}')
+            stored = client._put(self.bucket.name, self.name,
+                                 b''.join(part.data for part in parts),
+                                 self.metadata,
+                                 content_encoding=self.content_encoding)
+        self._load(stored)
+
+    def generate_signed_url(self, version: str = 'v4', method: str = 'GET',
+                            expiration=None, **kwargs) -> str:
+        """Url of the fake (never served), no request is made"""
+        expires = ('' if expiration is None
+                   else f'?expires={int(expiration.timestamp())}')
+        return (f'https://storage.fake/{self.bucket.name}/{self.name}'
+                f'{expires}')
+
+
+class FakeBucket:
+    """Bucket of a FakeStorageClient"""
+    def __init__(self, client: 'FakeStorageClient', name: str):
+        self.client = client
+        self.name = name
+
+    def blob(self, blob_name: str, chunk_size: int = None) -> FakeBlob:
+        return FakeBlob(self, blob_name, chunk_size)
+
+    def get_blob(self, blob_name: str) -> Optional[FakeBlob]:
+        self.client._round_trip()
+        stored = self.client._get(self.name, blob_name)
+        if stored is None:
+            return None
+        return FakeBlob(self, blob_name)._load(stored)
+
+    def delete_blob(self, blob_name: str,
+                    if_metageneration_match: int = None):
+        self.client._round_trip()
+        self.client._delete(self.name, blob_name, if_metageneration_match)
+
+    def list_blobs(self, prefix: str = '') -> List[FakeBlob]:
+        self.client._round_trip()
+        with self.client._lock:
+            items = sorted((name, stored) for (bucket, name), stored
+                           in self.client._objects.items()
+                           if bucket == self.name and name.startswith(prefix))
+        return [FakeBlob(self, name)._load(stored) for name, stored in items]
+
+
+class FakeStorageClient:
+    """
+    Thread safe, in-memory replacement for google.cloud.storage.Client
+    Buckets exist once created (or fetched with get_bucket)
+    round_trips counts the number of simulated requests to the server
+
+    latency: seconds each request waits
+    bandwidth: bytes per second transferred by each request (unlimited
+        when None)
+    Waiting happens outside the client's lock, so concurrent requests
+    overlap as they would over the network
+    """
+    def __init__(self, project: str = 'fake-project', latency: float = 0.0,
+                 bandwidth: float = None):
+        self.project = project
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.round_trips = 0
+        self._objects = {}
+        self._buckets = set()
+        self._lock = threading.RLock()
+        self._generations = itertools.count(1)
+
+    def bucket(self, bucket_name: str) -> FakeBucket:
+        return FakeBucket(self, bucket_name)
+
+    def create_bucket(self, bucket_name: str) -> FakeBucket:
+        self._round_trip()
+        with self._lock:
+            self._buckets.add(bucket_name)
+        return FakeBucket(self, bucket_name)
+
+    def get_bucket(self, bucket_name: str) -> FakeBucket:
+        """The bucket, created if it does not exist"""
+        return self.create_bucket(bucket_name)
+
+    def _round_trip(self, size: int = 0):
+        with self._lock:
+            self.round_trips += 1
+        delay = self.latency
+        if self.bandwidth is not None:
+            delay += size / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+    def _get(self, bucket: str, name: str) -> Optional[_Object]:
+        with self._lock:
+            return self._objects.get((bucket, name))
+
+    def _put(self, bucket: str, name: str, data: bytes,
+             metadata: Optional[Dict[str, str]],
+             if_generation_match: int = None,
+             content_encoding: str = None) -> _Object:
+        with self._lock:
+            current = self._objects.get((bucket, name))
+            if if_generation_match is not None and if_generation_match != (
+                    0 if current is None else current.generation):
+                raise google.api_core.exceptions.PreconditionFailed(
+                    f'Generation mismatch: {bucket}/{name}')
+            stored = _Object(data, None if metadata is None
+                             else dict(metadata), next(self._generations),
+                             content_encoding)
+            self._objects[(bucket, name)] = stored
+            return stored
+
+    def _check(self, bucket: str, name: str,
+               if_metageneration_match: int = None) -> _Object:
+        """Helper: stored bucket/name at metageneration (if given)"""
+        current = self._objects.get((bucket, name))
+        if current is None:
+            raise google.api_core.exceptions.NotFound(
+                f'No such object: {bucket}/{name}')
+        if (if_metageneration_match is not None and
+                if_metageneration_match != current.metageneration):
+            raise google.api_core.exceptions.PreconditionFailed(
+                f'Metageneration mismatch: {bucket}/{name}')
+        return current
+
+    def _patch(self, bucket: str, name: str,
+               metadata: Optional[Dict[str, str]],
+               if_metageneration_match: int = None) -> _Object:
+        with self._lock:
+            current = self._check(bucket, name, if_metageneration_match)
+            current.metadata = None if metadata is None else dict(metadata)
+            current.metageneration += 1
+            return current
+
+    def _delete(self, bucket: str, name: str,
+                if_metageneration_match: int = None):
+        with self._lock:
+            self._check(bucket, name, if_metageneration_match)
+            del self._objects[(bucket, name)]
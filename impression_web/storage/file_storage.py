@@ -2,13 +2,75 @@
 Abstract base class for file storage
 """
 import abc
+import functools
+import hashlib
+import io
+import os
 import pathlib
+import time
+from typing import BinaryIO, Callable, Dict, Iterable, List, Optional, Tuple, \
+    Union
+
+from impression_web.storage import compression
+from impression_web.storage.disk_cache import DiskCache
+from impression_web.storage.exceptions import FileTransferError
+from impression_web.storage.signing import DEFAULT_URL_LIFETIME, SignedURL
+from impression_web.storage.streams import ConcatenatingReader
+from impression_web.storage.transfer import DEFAULT_MAX_WORKERS, \
+    TransferReport, transfer_many
+
+# Buckets of a file storage
+INPUT = 'input'
+OUTPUT = 'output'
+
+# Content addressed inputs: name prefix and metadata key of their
+# reference count
+CONTENT_PREFIX = 'sha256/'
+REFERENCES_KEY = 'impression-references'
 
 
 class ImpressionFileStorage(abc.ABC):
     """Manage input and output files within file storage
     Platform agnostic
+    upload_*_stream, open_* and upload_bytes/download_bytes transfer
+    file objects and bytes without local files
+    upload_many, download_many and delete_many transfer many files of
+    a bucket (INPUT or OUTPUT) in parallel
+
+    compression: None (files stored raw), compression.GZIP or
+        compression.ZSTD, files are compressed on upload and recorded as
+        such in their metadata; compressed files are decompressed on
+        download whatever the setting
+    deduplicate: inputs are stored once under CONTENT_PREFIX + their
+        sha256 (upload skipped when already stored) with a count of the
+        jobs referencing them; deleting such a file drops a reference and
+        the file goes with the last one
+    disk_cache: download_input_file/download_output_file copy (or link)
+        files from this DiskCache while they are unchanged in storage
+
+    output_url() gives time limited urls downloading outputs directly
+    merge_outputs() concatenates outputs into one file
     """
+    compression: Optional[str] = None
+    # store inputs content addressed, see upload_input_file
+    deduplicate: bool = False
+    # local cache of downloads, see disk_cache.DiskCache
+    disk_cache: Optional[DiskCache] = None
+    # bytes per request of chunked transfers, platform default when None
+    chunk_size: Optional[int] = None
+
+    @property
+    @abc.abstractmethod
+    def _input_bucket(self):
+        """Platform bucket of input files"""
+        pass
+
+    @property
+    @abc.abstractmethod
+    def _output_bucket(self):
+        """Platform bucket of output files"""
+        pass
+
     @abc.abstractmethod
     def _download_file(self, bucket, dest_path: pathlib.PurePath,
                        file_name: str):
@@ -21,6 +83,72 @@ class ImpressionFileStorage(abc.ABC):
         """Upload file at file_path to bucket/file_name"""
         pass
 
+    @abc.abstractmethod
+    def _put_stream(self, bucket, fileobj: BinaryIO, file_name: str,
+                    metadata: Dict[str, str], if_absent: bool = False
+                    ) -> bool:
+        """
+        Store the remaining content of fileobj as is in bucket/file_name,
+        with metadata
+        if_absent: only if there is no such file yet, return False if
+            there is
+        """
+        pass
+
+    @abc.abstractmethod
+    def _signed_url(self, bucket, file_name: str, expiry: float) -> str:
+        """Direct download url of bucket/file_name valid until expiry"""
+        pass
+
+    @abc.abstractmethod
+    def _generation(self, bucket, file_name: str) -> Optional[str]:
+        """
+        Token identifying the stored content of bucket/file_name, changing
+        whenever it is rewritten, None if there is no such file
+        """
+        pass
+
+    @abc.abstractmethod
+    def _stat(self, bucket,
+              file_name: str) -> Optional[Tuple[Dict[str, str], object]]:
+        """
+        Metadata of bucket/file_name and a version token changing with
+        every metadata update, None if there is no such file
+        """
+        pass
+
+    @abc.abstractmethod
+    def _update_metadata(self, bucket, file_name: str,
+                         metadata: Dict[str, str], version) -> bool:
+        """
+        Replace the metadata of bucket/file_name if it is still at version
+        (see _stat), return False if it is not
+        """
+        pass
+
+    @abc.abstractmethod
+    def _delete_version(self, bucket, file_name: str, version) -> bool:
+        """
+        Delete bucket/file_name if it is still at version (see _stat),
+        return False if it is not
+        """
+        pass
+
+    @abc.abstractmethod
+    def _get_stream(self, bucket,
+                    file_name: str) -> Tuple[BinaryIO, Dict[str, str]]:
+        """
+        Readable binary stream of the stored content of bucket/file_name
+        (fetched in chunks) and its metadata
+        FileTransferError if there is no such file
+        """
+        pass
+
+    @abc.abstractmethod
+    def _delete_file(self, bucket, file_name: str):
+        """Delete bucket/file_name, FileTransferError if there is none"""
+        pass
+
     @abc.abstractmethod
     def upload_input_file(self, file_path: pathlib.PurePath,
                           file_name: str = None):
@@ -54,3 +182,342 @@ class ImpressionFileStorage(abc.ABC):
     def delete_output_file(self, file_name: str):
         """Delete file_name from input_bucket"""
         pass
+
+    def _upload_stream(self, bucket, fileobj: BinaryIO, file_name: str,
+                       metadata: Dict[str, str] = None,
+                       if_absent: bool = False) -> bool:
+        """
+        Upload the remaining content of fileobj to bucket/file_name,
+        compressed while it is sent when compression is set
+        if_absent: see _put_stream
+        """
+        metadata = dict(metadata or {})
+        if self.compression is not None:
+            fileobj = compression.CompressingReader(
+                fileobj, self.compression, rewind=self._chunk_bytes())
+            metadata[compression.METADATA_KEY] = self.compression
+        return self._put_stream(bucket, fileobj, file_name, metadata,
+                                if_absent)
+
+    def _upload_content(self, bucket, fileobj: BinaryIO,
+                        suffix: str = '') -> str:
+        """
+        Helper: store the content of seekable fileobj under its hash in
+        bucket, uploading it only if it is not stored already, and add a
+        reference to it
+        Return the content file name
+        """
+        if not fileobj.seekable():
+            raise ValueError('Deduplicated uploads need a seekable stream')
+        start = fileobj.tell()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: fileobj.read(self._chunk_bytes()), b''):
+            digest.update(chunk)
+        file_name = f'{CONTENT_PREFIX}{digest.hexdigest()}{suffix}'
+
+        # optimistic: retried when another upload/delete got in between
+        while True:
+            stat = self._stat(bucket, file_name)
+            if stat is None:
+                fileobj.seek(start)
+                if self._upload_stream(bucket, fileobj, file_name,
+                                       {REFERENCES_KEY: '1'},
+                                       if_absent=True):
+                    return file_name
+                continue
+
+            metadata, version = stat
+            count = int(metadata.get(REFERENCES_KEY, 0)) + 1
+            if self._update_metadata(
+                    bucket, file_name,
+                    dict(metadata, **{REFERENCES_KEY: str(count)}),
+                    version):
+                return file_name
+
+    def _upload_content_file(self, bucket, file_path: pathlib.PurePath,
+                             file_name: str) -> str:
+        """Helper: _upload_content of the file at file_path"""
+        try:
+            with open(file_path, 'rb') as fileobj:
+                return self._upload_content(
+                    bucket, fileobj, pathlib.PurePath(file_name).suffix)
+        except FileNotFoundError:
+            raise FileTransferError(
+                f'file upload failed: {file_name} not found')
+
+    def _release_content(self, bucket, file_name: str) -> int:
+        """
+        Helper: drop a reference to content stored by _upload_content,
+        deleting it with its last reference
+        Return the number of references left
+        Raises FileTransferError if there is no such file
+        """
+        while True:
+            stat = self._stat(bucket, file_name)
+            if stat is None:
+                raise FileTransferError(
+                    f'file deletion failed: {file_name} not found')
+
+            metadata, version = stat
+            count = int(metadata.get(REFERENCES_KEY, 1)) - 1
+            if count <= 0:
+                if self._delete_version(bucket, file_name, version):
+                    return 0
+            elif self._update_metadata(
+                    bucket, file_name,
+                    dict(metadata, **{REFERENCES_KEY: str(count)}),
+                    version):
+                return count
+
+    def references(self, file_name: str) -> int:
+        """
+        Number of jobs referencing content addressed input file_name
+        (0 if there is no such file)
+        """
+        stat = self._stat(self._input_bucket, file_name)
+        if stat is None:
+            return 0
+        return int(stat[0].get(REFERENCES_KEY, 1))
+
+    def _open_file(self, bucket, file_name: str) -> BinaryIO:
+        """
+        Readable binary stream of bucket/file_name, decompressed while it
+        is read if it was stored compressed
+        FileTransferError if there is no such file
+        """
+        stream, metadata = self._get_stream(bucket, file_name)
+        return compression.decompressing_reader(
+            stream, metadata.get(compression.METADATA_KEY))
+
+    def output_url(self, file_name: str,
+                   lifetime: float = DEFAULT_URL_LIFETIME) -> SignedURL:
+        """
+        Time limited url downloading output_bucket/file_name directly
+        from storage (as stored, i.e. compressed if it was, with the
+        matching Content-Encoding where the platform serves it), valid
+        for lifetime seconds
+        """
+        if lifetime <= 0:
+            raise ValueError(f'lifetime must be positive: {lifetime}')
+        expiry = time.time() + lifetime
+        return SignedURL(
+            self._signed_url(self._output_bucket, file_name, expiry), expiry)
+
+    def _download(self, bucket, bucket_name: str,
+                  destination: pathlib.PurePath, file_name: str):
+        """
+        Download bucket/file_name to destination, through disk_cache if
+        set: a cached copy is used while the stored file is unchanged
+        """
+        if self.disk_cache is None:
+            self._download_file(bucket, destination, file_name)
+            return
+        self._cached_download(
+            bucket_name, destination, file_name,
+            self._generation(bucket, file_name),
+            lambda: self._download_file(bucket, destination, file_name))
+
+    def _cached_download(self, bucket_name: str,
+                         destination: pathlib.PurePath, file_name: str,
+                         token: Optional[str], download: Callable[[], None]):
+        """
+        Helper: place the disk_cache copy of bucket_name/file_name at
+        version token (see _generation) at destination, else download()
+        it there and cache it
+        """
+        if token is None:
+            raise FileTransferError(
+                f'file download failed: {file_name} '
+                f'not found in {bucket_name}')
+        key = f'{type(self).__name__}/{bucket_name}/{file_name}'
+        if not self.disk_cache.get(key, token, destination):
+            download()
+            self.disk_cache.put(key, token, destination)
+
+    def _set_compression(self, method: Optional[str]):
+        """Helper: compress uploads with method (None: store raw)"""
+        compression.check(method)
+        self.compression = method
+
+    def _chunk_bytes(self) -> int:
+        """Helper: size of a chunk of streamed uploads"""
+        return self.chunk_size or compression.DEFAULT_CHUNK_SIZE
+
+    def upload_input_stream(self, fileobj: BinaryIO, file_name: str) -> str:
+        """
+        Upload binary file object fileobj to input_bucket/file_name
+        With deduplicate, fileobj must be seekable and is stored under its
+        content hash (keeping the suffix of file_name)
+        Return the file name in the bucket (the job's upload_name)
+        """
+        if self.deduplicate:
+            return self._upload_content(self._input_bucket, fileobj,
+                                        pathlib.PurePath(file_name).suffix)
+        self._upload_stream(self._input_bucket, fileobj, file_name)
+        return file_name
+
+    def upload_output_stream(self, fileobj: BinaryIO, file_name: str):
+        """Upload binary file object fileobj to output_bucket/file_name"""
+        self._upload_stream(self._output_bucket, fileobj, file_name)
+
+    def open_input(self, file_name: str) -> BinaryIO:
+        """Readable stream of input_bucket/file_name, close when done"""
+        return self._open_file(self._input_bucket, file_name)
+
+    def open_output(self, file_name: str) -> BinaryIO:
+        """Readable stream of output_bucket/file_name, close when done"""
+        return self._open_file(self._output_bucket, file_name)
+
+    def upload_bytes(self, data: bytes, file_name: str,
+                     bucket: str = INPUT):
+        """Upload data to bucket (INPUT or OUTPUT)/file_name"""
+        self._upload_stream(self._bucket(bucket), io.BytesIO(data),
+                            file_name)
+
+    def download_bytes(self, file_name: str, bucket: str = OUTPUT) -> bytes:
+        """Content of bucket (INPUT or OUTPUT)/file_name"""
+        with self._open_file(self._bucket(bucket), file_name) as stream:
+            return stream.read()
+
+    def merge_outputs(self, file_names: Iterable[str],
+                      merged_name: str) -> str:
+        """
+        Concatenate the output_bucket files file_names, in order, into
+        output_bucket/merged_name without holding their content in memory
+        Files sharing their compression are joined as stored (server side
+        where the platform composes objects), compressed files joining
+        into one valid file; mixed files are decompressed and stored
+        with the storage's compression
+        Return merged_name
+        Raises FileTransferError if a file does not exist
+        """
+        self._merge(self._output_bucket, list(file_names), merged_name)
+        return merged_name
+
+    def _merge(self, bucket, file_names: List[str], destination: str):
+        """Helper: concatenate bucket/file_names into bucket/destination"""
+        if not file_names:
+            raise ValueError('Nothing to merge')
+        methods = set()
+        for file_name in file_names:
+            stat = self._stat(bucket, file_name)
+            if stat is None:
+                raise FileTransferError(
+                    f'merge failed: {file_name} not found')
+            methods.add(stat[0].get(compression.METADATA_KEY))
+
+        if len(methods) > 1:
+            self._upload_stream(bucket, ConcatenatingReader(
+                [functools.partial(self._open_file, bucket, file_name)
+                 for file_name in file_names],
+                self._chunk_bytes(), rewind=self._chunk_bytes()),
+                destination)
+            return
+
+        method = methods.pop()
+        metadata = {} if method is None else {compression.METADATA_KEY: method}
+        if not self._compose(bucket, file_names, destination, metadata):
+            self._put_stream(bucket, ConcatenatingReader(
+                [functools.partial(self._raw_stream, bucket, file_name)
+                 for file_name in file_names],
+                self._chunk_bytes(), rewind=self._chunk_bytes()),
+                destination, metadata)
+
+    def _raw_stream(self, bucket, file_name: str) -> BinaryIO:
+        """Helper: stream of bucket/file_name as stored"""
+        return self._get_stream(bucket, file_name)[0]
+
+    def _compose(self, bucket, file_names: List[str], destination: str,
+                 metadata: Dict[str, str]) -> bool:
+        """
+        Join bucket/file_names as stored into bucket/destination with
+        metadata on the server, return False where the platform cannot
+        (the files are then streamed through this process)
+        """
+        return False
+
+    def _bucket(self, bucket: str):
+        """Helper: platform bucket for INPUT or OUTPUT"""
+        if bucket == INPUT:
+            return self._input_bucket
+        if bucket == OUTPUT:
+            return self._output_bucket
+        raise ValueError(f'Unknown bucket: {bucket}')
+
+    @staticmethod
+    def _bucket_method(bucket: str, input_method, output_method):
+        """Helper: input_method for INPUT, output_method for OUTPUT"""
+        if bucket == INPUT:
+            return input_method
+        if bucket == OUTPUT:
+            return output_method
+        raise ValueError(f'Unknown bucket: {bucket}')
+
+    def upload_many(self,
+                    files: Iterable[Union[pathlib.PurePath, tuple]],
+                    bucket: str = INPUT,
+                    max_workers: int = DEFAULT_MAX_WORKERS
+                    ) -> TransferReport:
+        """
+        Upload many files to bucket (INPUT or OUTPUT) in parallel
+        files: file paths (stored under their name) or
+            (file_path, file_name) pairs
+        Return a TransferReport, failed files do not stop the others
+        """
+        upload_file = self._bucket_method(bucket, self.upload_input_file,
+                                          self.upload_output_file)
+
+        def upload(file_name, file_path):
+            stored = upload_file(file_path, file_name)
+            return stored or file_name, os.path.getsize(file_path)
+
+        return transfer_many(upload, _named(files), max_workers)
+
+    def download_many(self,
+                      files: Iterable[Union[pathlib.PurePath, tuple]],
+                      bucket: str = OUTPUT,
+                      max_workers: int = DEFAULT_MAX_WORKERS
+                      ) -> TransferReport:
+        """
+        Download many files from bucket (INPUT or OUTPUT) in parallel
+        files: destination paths (fetching the file of the same name) or
+            (destination, file_name) pairs
+        Return a TransferReport, failed files do not stop the others
+        """
+        download_file = self._bucket_method(bucket, self.download_input_file,
+                                            self.download_output_file)
+
+        def download(file_name, destination):
+            download_file(destination, file_name)
+            return file_name, os.path.getsize(destination)
+
+        return transfer_many(download, _named(files), max_workers)
+
+    def delete_many(self, file_names: Iterable[str], bucket: str = INPUT,
+                    max_workers: int = DEFAULT_MAX_WORKERS
+                    ) -> TransferReport:
+        """
+        Delete many files from bucket (INPUT or OUTPUT) in parallel
+        (content addressed inputs lose a reference, see deduplicate)
+        Return a TransferReport, failed files do not stop the others
+        """
+        delete_file = self._bucket_method(bucket, self.delete_input_file,
+                                          self.delete_output_file)
+
+        def delete(file_name, _):
+            delete_file(file_name)
+            return file_name, 0
+
+        return transfer_many(delete, ((name, None) for name in file_names),
+                             max_workers)
+
+
+def _named(files: Iterable) -> Iterable[tuple]:
+    """Helper: (file_name, path) for paths or (path, file_name) pairs"""
+    for file in files:
+        if isinstance(file, tuple):
+            path, file_name = file
+        else:
+            path, file_name = file, None
+        path = pathlib.Path(path)
+        yield (path.name if file_name is None else file_name), path
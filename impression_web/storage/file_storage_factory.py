@@ -1,21 +1,35 @@
 """
 Factory for platform specific FileStorage instances
 """
+from impression_web import aio
+from impression_web.storage.async_storage import AsyncFileStorage
 from impression_web.storage.gcp_storage import GCPStorage
+from impression_web.storage.local_storage import LocalStorage
 
 
 class ImpressionFileStorageFactory:
-    def __init__(self, platform):
+    """
+    Platform specific file storages ('gcp' or 'local')
+    file_storage() creates instances for the chosen platform,
+    AsyncFileStorages with mode='async'
+    """
+    def __init__(self, platform, mode: str = aio.SYNC):
         self.platform = platform
         self.cls_ = ImpressionFileStorageFactory._select(platform)
+        self.mode = aio.check_mode(mode)
 
     @staticmethod
     def _select(platform):
         if platform == 'gcp':
             return GCPStorage
+        elif platform == 'local':
+            return LocalStorage
         else:
             raise NotImplementedError(
                 f'Invalid platform: {platform}')
 
     def file_storage(self, *args, **kwargs):
-        return self.cls_(*args, **kwargs)
+        storage = self.cls_(*args, **kwargs)
+        if self.mode == aio.ASYNC:
+            return AsyncFileStorage(storage)
+        return storage
@@ -2,21 +2,63 @@
 GCP Storage class
 Manage file upload, download, deletion from relevant buckets
 """
+from datetime import datetime, timezone
+import io
 import pathlib
+import shutil
+import time
+from typing import BinaryIO, Dict, List, Optional, Tuple
+import uuid
 
 import google.cloud.storage as gc_storage
 import google.api_core.exceptions
 
-from impression_web.storage.file_storage import ImpressionFileStorage
+from impression_web import clients, instrumentation
+from impression_web.storage import compression
+from impression_web.storage.disk_cache import DiskCache
+from impression_web.storage.file_storage import CONTENT_PREFIX, \
+    ImpressionFileStorage
 from impression_web.storage.exceptions import FileTransferError
+from impression_web.storage.streams import RangedReader, \
+    RewindableReader
 
 
 class GCPStorage(ImpressionFileStorage):
     """
     Upload, download and delete input/output files
     """
-    def __init__(self, input_bucket_name, output_bucket_name):
-        self._client: gc_storage.Client = None
+    # Blob chunk sizes must be multiples of 256 KiB
+    CHUNK_MULTIPLE = 256 * 1024
+    # Longest lifetime of V4 signed urls (seconds)
+    MAX_URL_LIFETIME = 7 * 24 * 3600
+    # Most source objects of a compose request
+    MAX_COMPOSE = 32
+    # Bytes per request of streamed downloads without chunk_size
+    DOWNLOAD_CHUNK_SIZE = 40 * 1024 * 1024
+
+    def __init__(self, input_bucket_name, output_bucket_name,
+                 client: gc_storage.Client = None, chunk_size: int = None,
+                 compression: str = None, deduplicate: bool = False,
+                 disk_cache: DiskCache = None):
+        """
+        client: storage client, the shared client when None
+        chunk_size: bytes per request of chunked transfers (a multiple of
+            CHUNK_MULTIPLE), the library defaults when None
+            Uploads are resumable: each chunk is retried on its own
+        compression: compress uploads, see ImpressionFileStorage
+        deduplicate: store inputs content addressed, see
+            ImpressionFileStorage
+        disk_cache: local cache of downloads, see ImpressionFileStorage
+        """
+        self._set_compression(compression)
+        self.deduplicate = deduplicate
+        self.disk_cache = disk_cache
+        if chunk_size is not None and (
+                chunk_size <= 0 or chunk_size % GCPStorage.CHUNK_MULTIPLE):
+            raise ValueError(f'chunk_size must be a positive multiple of '
+                             f'{GCPStorage.CHUNK_MULTIPLE}: {chunk_size}')
+        self.chunk_size = chunk_size
+        self._client: gc_storage.Client = client
         self.input_bucket_name = input_bucket_name
         self.output_bucket_name = output_bucket_name
 
@@ -26,7 +68,7 @@ class GCPStorage(ImpressionFileStorage):
     @property
     def client(self):
         if self._client is None:
-            self._client = gc_storage.Client()
+            self._client = clients.storage_client()
         return self._client
 
     @property
@@ -43,26 +85,64 @@ class GCPStorage(ImpressionFileStorage):
                 self.output_bucket_name)
         return self.__output_bucket
 
+    def _download(self, bucket: gc_storage.Bucket, bucket_name: str,
+                  destination: pathlib.PurePath, file_name: str):
+        """
+        As ImpressionFileStorage._download, with a single metadata request
+        for the cache token and the download
+        """
+        blob = self._get_blob(bucket, file_name)
+        if self.disk_cache is None:
+            self._download_file(bucket, destination, file_name, blob)
+            return
+        self._cached_download(
+            bucket_name, destination, file_name, self._blob_generation(blob),
+            lambda: self._download_file(bucket, destination, file_name,
+                                        blob))
+
+    @instrumentation.instrumented
     def _download_file(self,
                        bucket: gc_storage.Bucket,
                        destination: pathlib.PurePath,
-                       file_name: str):
+                       file_name: str,
+                       blob: gc_storage.Blob = None):
         """
         Download file name (captured from file_path from bucket)
         :param destination: file_path to save file
         :type bucket: :class:`google.cloud.storage.Bucket`
         :param bucket: storage bucket
-        :raises: :class: `google.cloud.exception.NotFound`
+        :param blob: bucket/file_name as loaded by _get_blob, looked up
+            when None; its generation is downloaded
+        :raises: :class: `FileTransferError`
         """
+        if blob is None:
+            blob = self._get_blob(bucket, file_name)
+        metadata = blob.metadata or {}
+        if metadata.get(compression.METADATA_KEY):
+            # stored compressed (by any storage), decompress while writing
+            stream, _ = self._get_stream(bucket, file_name, blob)
+            with compression.decompressing_reader(
+                    stream, metadata[compression.METADATA_KEY]) as stream, \
+                    open(destination, 'wb') as file:
+                shutil.copyfileobj(stream, file, self._chunk_bytes())
+            instrumentation.record(bytes=blob.size or 0)
+            return
 
-        file_blob = bucket.blob(file_name)
+        blob.chunk_size = self.chunk_size
         try:
-            file_blob.download_to_filename(destination.as_posix())
+            blob.download_to_filename(destination.as_posix(),
+                                      if_generation_match=blob.generation)
         except google.api_core.exceptions.NotFound:
             raise FileTransferError(
-                f'file download failed: {file_name}'
+                f'file download failed: {file_name} '
                 f'not found in {bucket.name}')
+        except google.api_core.exceptions.PreconditionFailed:
+            raise FileTransferError(
+                f'file download failed: {file_name} '
+                f'changed in {bucket.name}')
+        instrumentation.record(bytes=blob.size or 0)
 
+    @instrumentation.instrumented
     def _upload_file(self,
                      bucket: gc_storage.Bucket,
                      file_path: pathlib.PurePath,
@@ -72,26 +152,212 @@ class GCPStorage(ImpressionFileStorage):
         Raises FileTransferError on invalid file path
         """
 
-        blob = bucket.blob(file_name)
         try:
-            blob.upload_from_filename(file_path.as_posix())
+            if self.compression is not None:
+                with open(file_path, 'rb') as fileobj:
+                    self._upload_stream(bucket, fileobj, file_name)
+                    instrumentation.record(bytes=fileobj.tell())
+            else:
+                blob = self._blob(bucket, file_name)
+                blob.upload_from_filename(file_path.as_posix())
+                instrumentation.record(bytes=blob.size or 0)
         except FileNotFoundError:
             raise FileTransferError(
                 f'file upload failed: {file_name} not found')
 
+    def _blob(self, bucket: gc_storage.Bucket,
+              file_name: str) -> gc_storage.Blob:
+        """Helper: blob of bucket/file_name transferred in chunk_size"""
+        return bucket.blob(file_name, chunk_size=self.chunk_size)
+
+    @instrumentation.instrumented
+    def _put_stream(self,
+                    bucket: gc_storage.Bucket,
+                    fileobj: BinaryIO,
+                    file_name: str,
+                    metadata: Dict[str, str],
+                    if_absent: bool = False) -> bool:
+        """
+        Upload the remaining content of fileobj to bucket/file_name
+        Streams of unknown size are sent as a resumable upload, in chunks
+        of chunk_size when set
+        """
+        blob = self._blob(bucket, file_name)
+        if metadata:
+            blob.metadata = metadata
+            blob.content_encoding = _content_encoding(metadata)
+        if blob.chunk_size is None and isinstance(fileobj, RewindableReader):
+            # generated (e.g. compressed) streams can only rewind within
+            # one chunk
+            blob.chunk_size = self._chunk_bytes()
+        try:
+            # generation 0: only if there is no live object
+            blob.upload_from_file(
+                fileobj, if_generation_match=0 if if_absent else None)
+        except google.api_core.exceptions.PreconditionFailed:
+            return False
+        instrumentation.record(bytes=blob.size or 0)
+        return True
+
+    @instrumentation.instrumented
+    def _compose(self, bucket: gc_storage.Bucket, file_names: List[str],
+                 destination: str, metadata: Dict[str, str]) -> bool:
+        """
+        Join bucket/file_names into bucket/destination with server side
+        compose requests (of at most MAX_COMPOSE sources each, through
+        intermediate objects deleted afterwards)
+        """
+        sources = [bucket.blob(file_name) for file_name in file_names]
+        intermediates = []
+        try:
+            while len(sources) > GCPStorage.MAX_COMPOSE:
+                groups = [sources[i:i + GCPStorage.MAX_COMPOSE] for i in
+                          range(0, len(sources), GCPStorage.MAX_COMPOSE)]
+                sources = []
+                for group in groups:
+                    part = bucket.blob(
+                        f'{destination}.compose-{uuid.uuid4().hex}')
+                    part.compose(group)
+                    intermediates.append(part)
+                    sources.append(part)
+
+            blob = bucket.blob(destination)
+            blob.metadata = metadata or None
+            blob.content_encoding = _content_encoding(metadata or {})
+            blob.compose(sources)
+        except google.api_core.exceptions.NotFound as e:
+            raise FileTransferError(f'merge failed: {e}') from e
+        finally:
+            for part in intermediates:
+                try:
+                    part.delete()
+                except google.api_core.exceptions.NotFound:
+                    pass
+        return True
+
+    def _signed_url(self, bucket: gc_storage.Bucket, file_name: str,
+                    expiry: float) -> str:
+        """
+        V4 signed GET url of bucket/file_name (at most 7 days)
+        Compressed files are served with their Content-Encoding: storage
+        decompresses gzip ones for clients not accepting gzip, zstd ones
+        need clients accepting zstd
+        The client's credentials must be able to sign (e.g. a service
+        account key)
+        """
+        if expiry - time.time() > GCPStorage.MAX_URL_LIFETIME:
+            raise ValueError(f'Signed urls are valid for at most '
+                             f'{GCPStorage.MAX_URL_LIFETIME} seconds')
+        return bucket.blob(file_name).generate_signed_url(
+            version='v4', method='GET',
+            expiration=datetime.fromtimestamp(expiry, timezone.utc))
+
+    def _generation(self, bucket: gc_storage.Bucket,
+                    file_name: str) -> Optional[str]:
+        """Generation and crc32c checksum of bucket/file_name"""
+        blob = bucket.get_blob(file_name)
+        if blob is None:
+            return None
+        return self._blob_generation(blob)
+
+    @staticmethod
+    def _blob_generation(blob: gc_storage.Blob) -> str:
+        """Helper: _generation of a loaded blob"""
+        return f'{blob.generation}:{blob.crc32c}'
+
+    @staticmethod
+    def _get_blob(bucket: gc_storage.Bucket,
+                  file_name: str) -> gc_storage.Blob:
+        """
+        Helper: bucket/file_name loaded (generation, size, metadata, ...)
+        Raises FileTransferError if there is no such file
+        """
+        blob = bucket.get_blob(file_name)
+        if blob is None:
+            raise FileTransferError(
+                f'file download failed: {file_name} '
+                f'not found in {bucket.name}')
+        return blob
+
+    def _stat(self, bucket: gc_storage.Bucket,
+              file_name: str) -> Optional[Tuple[Dict[str, str], int]]:
+        """Metadata and metageneration of bucket/file_name"""
+        blob = bucket.get_blob(file_name)
+        if blob is None:
+            return None
+        return blob.metadata or {}, blob.metageneration
+
+    def _update_metadata(self, bucket: gc_storage.Bucket, file_name: str,
+                         metadata: Dict[str, str], version: int) -> bool:
+        """Patch the metadata of bucket/file_name at metageneration"""
+        blob = bucket.blob(file_name)
+        blob.metadata = metadata
+        try:
+            blob.patch(if_metageneration_match=version)
+        except (google.api_core.exceptions.PreconditionFailed,
+                google.api_core.exceptions.NotFound):
+            return False
+        return True
+
+    def _delete_version(self, bucket: gc_storage.Bucket, file_name: str,
+                        version: int) -> bool:
+        """Delete bucket/file_name at metageneration"""
+        try:
+            bucket.delete_blob(file_name, if_metageneration_match=version)
+        except (google.api_core.exceptions.PreconditionFailed,
+                google.api_core.exceptions.NotFound):
+            return False
+        return True
+
+    @instrumentation.instrumented
+    def _get_stream(self,
+                    bucket: gc_storage.Bucket,
+                    file_name: str,
+                    blob: gc_storage.Blob = None
+                    ) -> Tuple[BinaryIO, Dict[str, str]]:
+        """
+        Readable stream of bucket/file_name as stored (compressed files
+        are not decoded), fetched chunk_size bytes at a time from the
+        generation of blob (see _get_blob, looked up when None), and its
+        metadata
+        Raises FileTransferError if there is no such file
+        """
+        if blob is None:
+            blob = self._get_blob(bucket, file_name)
+        instrumentation.record(bytes=blob.size or 0)
+        generation = blob.generation
+
+        # raw downloads keep gzip content-encoding as stored
+        def fetch(start: int, end: int) -> bytes:
+            return blob.download_as_bytes(
+                start=start, end=end, raw_download=True,
+                if_generation_match=generation, checksum=None)
+
+        chunk_size = self.chunk_size or self.DOWNLOAD_CHUNK_SIZE
+        return (io.BufferedReader(
+                    RangedReader(fetch, blob.size or 0, chunk_size),
+                    chunk_size),
+                blob.metadata or {})
+
     def _exists(self, bucket: gc_storage.Bucket, file_name: str) -> bool:
         """Does bucket/file_name exist?"""
         blob = bucket.blob(file_name)
         return blob.exists()
 
     def upload_input_file(self, file_path: pathlib.PurePath,
-                          file_name: str = None):
+                          file_name: str = None) -> str:
         """Upload file at file_path to input file bucket under its `name`
+        (under its content hash with deduplicate, skipped if present)
         :param file_name: name of file in bucket
         :param file_path: file_path to file to be uploaded
+        :returns: name of the file in the bucket (the job's upload_name)
         """
         file_name = file_path.name if file_name is None else file_name
+        if self.deduplicate:
+            return self._upload_content_file(self._input_bucket, file_path,
+                                             file_name)
         self._upload_file(self._input_bucket, file_path, file_name)
+        return file_name
 
     def download_input_file(self, destination: pathlib.PurePath,
                             file_name: str = None):
@@ -102,7 +368,8 @@ class GCPStorage(ImpressionFileStorage):
         :raises: :class: `google.cloud.exception.NotFound`
         """
         file_name = destination.name if file_name is None else file_name
-        self._download_file(self._input_bucket, destination, file_name)
+        self._download(self._input_bucket, self.input_bucket_name,
+                       destination, file_name)
 
     def upload_output_file(self, file_path: pathlib.PurePath,
                            file_name: str = None):
@@ -123,18 +390,39 @@ class GCPStorage(ImpressionFileStorage):
         :raises: :class: `google.cloud.exception.NotFound`
         """
         file_name = destination.name if file_name is None else file_name
-        self._download_file(self._output_bucket, destination, file_name)
+        self._download(self._output_bucket, self.output_bucket_name,
+                       destination, file_name)
+
+    @instrumentation.instrumented
+    def _delete_file(self, bucket: gc_storage.Bucket, file_name: str):
+        """
+        Delete bucket/file_name
+        Raises FileTransferError if there is no such file
+        """
+        try:
+            bucket.delete_blob(file_name)
+        except google.api_core.exceptions.NotFound:
+            raise FileTransferError(
+                f'file deletion failed: {file_name} '
+                f'not found in {bucket.name}')
 
-    # todo except invalid file_names
     def delete_input_file(self, file_name: str):
         """
         Delete input_bucket/file_name
+        Content addressed files only lose a reference, see deduplicate
         """
-        self._input_bucket.delete_blob(file_name)
+        if file_name.startswith(CONTENT_PREFIX):
+            self._release_content(self._input_bucket, file_name)
+        else:
+            self._delete_file(self._input_bucket, file_name)
 
-    # todo except invalid file_names
     def delete_output_file(self, file_name: str):
         """
         Delete output_bucket/file_name
         """
-        self._output_bucket.delete_blob(file_name)
+        self._delete_file(self._output_bucket, file_name)
+
+
+def _content_encoding(metadata: Dict[str, str]) -> Optional[str]:
+    """Helper: Content-Encoding of a file stored with metadata"""
+    return metadata.get(compression.METADATA_KEY)
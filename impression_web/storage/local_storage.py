@@ -0,0 +1,300 @@
+"""
+Local filesystem storage
+Buckets are directories under a root directory, a stand-in for cloud
+storage in development and tests
+"""
+import io
+import json
+import os
+import pathlib
+import shutil
+import threading
+from typing import BinaryIO, Dict, Optional, Tuple
+import uuid
+
+from impression_web import instrumentation
+from impression_web.storage.file_storage import CONTENT_PREFIX, \
+    ImpressionFileStorage
+from impression_web.storage.disk_cache import DiskCache
+from impression_web.storage.exceptions import FileTransferError
+from impression_web.storage.signing import HMACSigner
+
+
+class LocalStorage(ImpressionFileStorage):
+    """
+    Upload, download and delete input/output files in local directories
+    root/input_bucket_name and root/output_bucket_name
+    """
+    # Guards conditional writes (_put_stream if_absent, _update_metadata,
+    # _delete_version) within the process
+    _lock = threading.RLock()
+
+    def __init__(self, input_bucket_name, output_bucket_name,
+                 root: pathlib.PurePath = None, chunk_size: int = None,
+                 compression: str = None, deduplicate: bool = False,
+                 disk_cache: DiskCache = None,
+                 url_signer: HMACSigner = None):
+        """
+        root: directory holding the buckets, the working directory if None
+        chunk_size: buffer size of stream transfers, io default if None
+        compression: compress uploads, see ImpressionFileStorage
+        deduplicate: store inputs content addressed, see
+            ImpressionFileStorage
+        disk_cache: local cache of downloads, see ImpressionFileStorage
+        url_signer: signs output_url()s, by default file: urls under root
+            signed with a per process key; see open_url
+        Metadata of bucket/name is kept in bucket/.name.metadata.json
+        """
+        self.root = pathlib.Path('.' if root is None else root)
+        self.chunk_size = chunk_size
+        self._set_compression(compression)
+        self.deduplicate = deduplicate
+        self.disk_cache = disk_cache
+        self.url_signer = (HMACSigner(self.root.resolve().as_uri())
+                           if url_signer is None else url_signer)
+        self.input_bucket_name = input_bucket_name
+        self.output_bucket_name = output_bucket_name
+
+    def _directory(self, name: str) -> pathlib.Path:
+        directory = self.root / name
+        directory.mkdir(parents=True, exist_ok=True)
+        return directory
+
+    @property
+    def _input_bucket(self) -> pathlib.Path:
+        return self._directory(self.input_bucket_name)
+
+    @property
+    def _output_bucket(self) -> pathlib.Path:
+        return self._directory(self.output_bucket_name)
+
+    @staticmethod
+    def _path(bucket: pathlib.Path, file_name: str) -> pathlib.Path:
+        """Helper: path of file_name within bucket"""
+        path = bucket / file_name
+        if bucket.resolve() not in path.resolve().parents:
+            raise FileTransferError(f'invalid file name: {file_name}')
+        return path
+
+    @instrumentation.instrumented
+    def _download_file(self,
+                       bucket: pathlib.Path,
+                       destination: pathlib.PurePath,
+                       file_name: str):
+        """
+        Copy (decompressing) bucket/file_name to destination
+        Raises FileTransferError if there is no such file
+        """
+        with self._open_file(bucket, file_name) as stream, \
+                open(destination, 'wb') as file:
+            shutil.copyfileobj(stream, file,
+                               self.chunk_size or io.DEFAULT_BUFFER_SIZE)
+            instrumentation.record(bytes=file.tell())
+
+    @instrumentation.instrumented
+    def _upload_file(self,
+                     bucket: pathlib.Path,
+                     file_path: pathlib.PurePath,
+                     file_name: str):
+        """
+        Copy file_path to bucket/file_name (replaced atomically)
+        Raises FileTransferError on invalid file path
+        """
+        try:
+            with open(file_path, 'rb') as fileobj:
+                self._upload_stream(bucket, fileobj, file_name)
+                instrumentation.record(bytes=fileobj.tell())
+        except FileNotFoundError:
+            raise FileTransferError(
+                f'file upload failed: {file_name} not found')
+
+    @staticmethod
+    def _metadata_path(path: pathlib.Path) -> pathlib.Path:
+        return path.with_name(f'.{path.name}.metadata.json')
+
+    @instrumentation.instrumented
+    def _put_stream(self, bucket: pathlib.Path, fileobj: BinaryIO,
+                    file_name: str, metadata: Dict[str, str],
+                    if_absent: bool = False) -> bool:
+        """
+        Copy the remaining content of fileobj to bucket/file_name
+        (replaced atomically) and record its metadata
+        """
+        path = self._path(bucket, file_name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.part')
+        try:
+            with open(partial, 'wb') as destination:
+                shutil.copyfileobj(fileobj, destination,
+                                   self.chunk_size or io.DEFAULT_BUFFER_SIZE)
+                instrumentation.record(bytes=destination.tell())
+            with LocalStorage._lock:
+                if if_absent and path.exists():
+                    partial.unlink()
+                    return False
+                self._write_metadata(path, metadata)
+                os.replace(partial, path)
+            return True
+        except BaseException:
+            if partial.exists():
+                partial.unlink()
+            raise
+
+    def _write_metadata(self, path: pathlib.Path, metadata: Dict[str, str]):
+        if metadata:
+            self._metadata_path(path).write_text(json.dumps(metadata))
+        else:
+            try:
+                self._metadata_path(path).unlink()
+            except FileNotFoundError:
+                pass
+
+    def _read_metadata(self, path: pathlib.Path) -> Dict[str, str]:
+        try:
+            return json.loads(self._metadata_path(path).read_text())
+        except FileNotFoundError:
+            return {}
+
+    def _signed_url(self, bucket: pathlib.Path, file_name: str,
+                    expiry: float) -> str:
+        """url_signer url of bucket/file_name"""
+        return self.url_signer.sign(bucket.name, file_name, expiry)
+
+    def open_url(self, url: str) -> BinaryIO:
+        """
+        Stream of the file a signed url (output_url()) downloads, as stored
+        The local counterpart of fetching the url
+        Raises FileTransferError if the url is forged or expired
+        """
+        bucket_name, file_name = self.url_signer.verify(url)
+        if bucket_name not in (self.input_bucket_name,
+                               self.output_bucket_name):
+            raise FileTransferError(f'invalid url: {url}')
+        return self._get_stream(self._directory(bucket_name), file_name)[0]
+
+    def _generation(self, bucket: pathlib.Path,
+                    file_name: str) -> Optional[str]:
+        """Inode, size and modification time of bucket/file_name"""
+        try:
+            stat = self._path(bucket, file_name).stat()
+        except FileNotFoundError:
+            return None
+        return f'{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}'
+
+    def _stat(self, bucket: pathlib.Path,
+              file_name: str) -> Optional[Tuple[Dict[str, str], dict]]:
+        """Metadata of bucket/file_name, which is also its version"""
+        path = self._path(bucket, file_name)
+        with LocalStorage._lock:
+            if not path.is_file():
+                return None
+            metadata = self._read_metadata(path)
+            return metadata, dict(metadata)
+
+    def _update_metadata(self, bucket: pathlib.Path, file_name: str,
+                         metadata: Dict[str, str], version: dict) -> bool:
+        """Replace the metadata of bucket/file_name if it is version"""
+        path = self._path(bucket, file_name)
+        with LocalStorage._lock:
+            if not path.is_file() or self._read_metadata(path) != version:
+                return False
+            self._write_metadata(path, metadata)
+            return True
+
+    def _delete_version(self, bucket: pathlib.Path, file_name: str,
+                        version: dict) -> bool:
+        """Delete bucket/file_name if its metadata is version"""
+        path = self._path(bucket, file_name)
+        with LocalStorage._lock:
+            if not path.is_file() or self._read_metadata(path) != version:
+                return False
+            self._delete_file(bucket, file_name)
+            return True
+
+    @instrumentation.instrumented
+    def _get_stream(self, bucket: pathlib.Path,
+                    file_name: str) -> Tuple[BinaryIO, Dict[str, str]]:
+        """
+        Readable stream of bucket/file_name and its metadata
+        Raises FileTransferError if there is no such file
+        """
+        path = self._path(bucket, file_name)
+        try:
+            stream = open(path, 'rb', buffering=self.chunk_size or -1)
+        except FileNotFoundError:
+            raise FileTransferError(
+                f'file download failed: {file_name} not found in {bucket}')
+        if instrumentation.recording():
+            instrumentation.record(bytes=os.fstat(stream.fileno()).st_size)
+        return stream, self._read_metadata(path)
+
+    def _exists(self, bucket: pathlib.Path, file_name: str) -> bool:
+        """Does bucket/file_name exist?"""
+        return self._path(bucket, file_name).is_file()
+
+    @instrumentation.instrumented
+    def _delete_file(self, bucket: pathlib.Path, file_name: str):
+        """
+        Delete bucket/file_name
+        Raises FileTransferError if there is no such file
+        """
+        path = self._path(bucket, file_name)
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            raise FileTransferError(
+                f'file deletion failed: {file_name} not found in {bucket}')
+        try:
+            self._metadata_path(path).unlink()
+        except FileNotFoundError:
+            pass
+
+    def upload_input_file(self, file_path: pathlib.PurePath,
+                          file_name: str = None) -> str:
+        """
+        Upload file at file_path to the input bucket (under its content
+        hash with deduplicate, skipped if present)
+        Return the name of the file in the bucket (the job's upload_name)
+        """
+        file_name = file_path.name if file_name is None else file_name
+        if self.deduplicate:
+            return self._upload_content_file(self._input_bucket, file_path,
+                                             file_name)
+        self._upload_file(self._input_bucket, file_path, file_name)
+        return file_name
+
+    def download_input_file(self, destination: pathlib.PurePath,
+                            file_name: str = None):
+        """Download file_name from the input bucket to destination"""
+        file_name = destination.name if file_name is None else file_name
+        self._download(self._input_bucket, self.input_bucket_name,
+                       destination, file_name)
+
+    def upload_output_file(self, file_path: pathlib.PurePath,
+                           file_name: str = None):
+        """Upload file at file_path to the output bucket"""
+        file_name = file_path.name if file_name is None else file_name
+        self._upload_file(self._output_bucket, file_path, file_name)
+
+    def download_output_file(self, destination: pathlib.PurePath,
+                             file_name: str = None):
+        """Download file_name from the output bucket to destination"""
+        file_name = destination.name if file_name is None else file_name
+        self._download(self._output_bucket, self.output_bucket_name,
+                       destination, file_name)
+
+    def delete_input_file(self, file_name: str):
+        """
+        Delete input_bucket/file_name
+        Content addressed files only lose a reference, see deduplicate
+        """
+        if file_name.startswith(CONTENT_PREFIX):
+            self._release_content(self._input_bucket, file_name)
+        else:
+            self._delete_file(self._input_bucket, file_name)
+
+    def delete_output_file(self, file_name: str):
+        """
+        Delete output_bucket/file_name
+        """
+        self._delete_file(self._output_bucket, file_name)
@@ -0,0 +1,74 @@
+"""
+Time limited download URLs
+SignedURL: url and its expiry
+HMACSigner: local stand-in for cloud storage signed URLs, signing
+    (bucket, file name, expiry) with a secret key
+"""
+import base64
+import hashlib
+import hmac
+import os
+import time
+from typing import NamedTuple, Tuple
+from urllib.parse import parse_qs, quote, unquote, urlencode, urlsplit
+
+from impression_web.storage.exceptions import FileTransferError
+
+# Seconds signed URLs are valid for unless requested otherwise
+DEFAULT_URL_LIFETIME = 3600.0
+
+
+class SignedURL(NamedTuple):
+    """url: direct download url, expiry: epoch seconds it stops working"""
+    url: str
+    expiry: float
+
+
+class HMACSigner:
+    """
+    Sign and verify urls base_url/bucket/file_name?expires=&signature=
+    secret: signing key, random (valid for this process only) when None
+    """
+    def __init__(self, base_url: str, secret: bytes = None):
+        self.base_url = base_url.rstrip('/')
+        self._secret = os.urandom(32) if secret is None else secret
+
+    def _signature(self, path: str, expires: int) -> str:
+        digest = hmac.new(self._secret, f'{path}\n{expires}'.encode(),
+                          hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+    def sign(self, bucket: str, file_name: str, expiry: float) -> str:
+        """URL of bucket/file_name valid until expiry (epoch seconds)"""
+        path = f'{quote(bucket)}/{quote(file_name)}'
+        expires = int(expiry)
+        query = urlencode({'expires': expires,
+                           'signature': self._signature(path, expires)})
+        return f'{self.base_url}/{path}?{query}'
+
+    def verify(self, url: str, now: float = None) -> Tuple[str, str]:
+        """
+        (bucket, file_name) of a url from sign()
+        Raises FileTransferError if it is forged or expired
+        """
+        parts = urlsplit(url)
+        base = urlsplit(self.base_url)
+        prefix = base.path.rstrip('/') + '/'
+        query = parse_qs(parts.query)
+        try:
+            if ((parts.scheme, parts.netloc) != (base.scheme, base.netloc)
+                    or not parts.path.startswith(prefix)):
+                raise ValueError(url)
+            path = parts.path[len(prefix):]
+            bucket, file_name = path.split('/', 1)
+            expires = int(query['expires'][0])
+            signature = query['signature'][0]
+        except (KeyError, ValueError) as e:
+            raise FileTransferError(f'invalid url: {url}') from e
+
+        if not hmac.compare_digest(signature,
+                                   self._signature(path, expires)):
+            raise FileTransferError(f'invalid url signature: {url}')
+        if expires <= (time.time() if now is None else now):
+            raise FileTransferError(f'url expired: {url}')
+        return unquote(bucket), unquote(file_name)
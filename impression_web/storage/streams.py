@@ -0,0 +1,126 @@
+"""
+Readable streams produced while they are read
+RewindableReader: base of streams generated piece by piece, supporting
+    tell() and seeking back within a window so that resumable uploads can
+    retry their last chunk
+ConcatenatingReader: the content of several streams one after another
+RangedReader: the content of a remote object fetched by byte ranges
+"""
+import abc
+from collections import deque
+import io
+from typing import BinaryIO, Callable, Iterable
+
+
+class RewindableReader(io.RawIOBase, abc.ABC):
+    """
+    Readable stream of the bytes returned by _fill() until it sets _eof
+    tell() and seeking back by up to rewind bytes are supported
+    """
+    def __init__(self, rewind: int = 0):
+        self._rewind = rewind
+        # produced output, _buffer[_offset:] is not yet read
+        self._buffer = bytearray()
+        self._offset = 0
+        # stream position of _buffer[0]
+        self._start = 0
+        self._eof = False
+
+    @abc.abstractmethod
+    def _fill(self) -> bytes:
+        """Next bytes of the stream (maybe none), set _eof at its end"""
+        pass
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def tell(self) -> int:
+        return self._start + self._offset
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.tell()
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation('seek from end')
+        if not self._start <= offset <= self._start + len(self._buffer):
+            raise io.UnsupportedOperation(
+                f'cannot seek to {offset}, outside the rewind window')
+        self._offset = offset - self._start
+        return offset
+
+    def readinto(self, b) -> int:
+        while len(self._buffer) - self._offset < len(b) and not self._eof:
+            self._buffer += self._fill()
+
+        n = min(len(b), len(self._buffer) - self._offset)
+        b[:n] = self._buffer[self._offset:self._offset + n]
+        self._offset += n
+
+        # drop output behind the rewind window
+        drop = self._offset - self._rewind
+        if drop > 0:
+            del self._buffer[:drop]
+            self._offset -= drop
+            self._start += drop
+        return n
+
+
+class ConcatenatingReader(RewindableReader):
+    """
+    Stream of the content of the streams returned by each of openers in
+    turn, opened only once the previous one is exhausted (and closed)
+    """
+    def __init__(self, openers: Iterable[Callable[[], BinaryIO]],
+                 chunk_size: int = io.DEFAULT_BUFFER_SIZE, rewind: int = 0):
+        super().__init__(rewind)
+        self._openers = deque(openers)
+        self._chunk_size = chunk_size
+        self._current = None
+
+    def _fill(self) -> bytes:
+        if self._current is None:
+            if not self._openers:
+                self._eof = True
+                return b''
+            self._current = self._openers.popleft()()
+        chunk = self._current.read(self._chunk_size)
+        if not chunk:
+            self._current.close()
+            self._current = None
+        return chunk
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        super().close()
+
+
+class RangedReader(RewindableReader):
+    """
+    Stream of size bytes fetched chunk_size bytes at a time by
+    fetch(start, end) (both offsets inclusive)
+    """
+    def __init__(self, fetch: Callable[[int, int], bytes], size: int,
+                 chunk_size: int = io.DEFAULT_BUFFER_SIZE, rewind: int = 0):
+        super().__init__(rewind)
+        self._fetch = fetch
+        self._size = size
+        self._chunk_size = chunk_size
+        self._position = 0
+
+    def _fill(self) -> bytes:
+        if self._position >= self._size:
+            self._eof = True
+            return b''
+        end = min(self._position + self._chunk_size, self._size) - 1
+        chunk = self._fetch(self._position, end)
+        if not chunk:
+            # the object shrank, which its generation forbids
+            raise IOError(f'no bytes at offset {self._position} of '
+                          f'{self._size}')
+        self._position += len(chunk)
+        return chunk
@@ -0,0 +1,116 @@
+"""
+Results of multi-file transfers (upload_many/download_many/delete_many)
+TransferResult: outcome of a single file
+TransferReport: per-file results in request order and aggregate stats
+"""
+from concurrent.futures import ThreadPoolExecutor
+import time
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+from impression_web.storage.exceptions import FileTransferError
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class TransferResult(NamedTuple):
+    """
+    file_name: name in the bucket (the content name of deduplicated
+        uploads)
+    path: local file path (None for deletions)
+    size: bytes transferred
+    seconds: time taken by this file
+    error: exception raised by the transfer, None on success
+    """
+    file_name: str
+    path: object
+    size: int
+    seconds: float
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class TransferReport:
+    """
+    Per-file results of a multi-file transfer and aggregate throughput
+    results: TransferResult for each requested file, in request order
+    seconds: wall clock time of the whole transfer
+    """
+    def __init__(self, results: List[TransferResult], seconds: float):
+        self.results = results
+        self.seconds = seconds
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    @property
+    def succeeded(self) -> List[TransferResult]:
+        return [r for r in self.results if r.ok]
+
+    @property
+    def failed(self) -> List[TransferResult]:
+        return [r for r in self.results if not r.ok]
+
+    @property
+    def bytes(self) -> int:
+        """Total bytes of the successful transfers"""
+        return sum(r.size for r in self.results if r.ok)
+
+    @property
+    def bytes_per_second(self) -> float:
+        return self.bytes / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def files_per_second(self) -> float:
+        return len(self.succeeded) / self.seconds if self.seconds > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {u'files': len(self.results),
+                u'succeeded': len(self.succeeded),
+                u'failed': len(self.failed),
+                u'bytes': self.bytes,
+                u'seconds': self.seconds,
+                u'bytes_per_second': self.bytes_per_second,
+                u'files_per_second': self.files_per_second}
+
+    def raise_for_errors(self):
+        """Raise FileTransferError naming every failed file"""
+        failed = self.failed
+        if failed:
+            raise FileTransferError(
+                f'{len(failed)} of {len(self.results)} transfers failed: '
+                + ', '.join(f'{r.file_name} ({r.error})' for r in failed)
+            ) from failed[0].error
+
+
+def transfer_many(transfer: Callable, items: Iterable[tuple],
+                  max_workers: int = DEFAULT_MAX_WORKERS) -> TransferReport:
+    """
+    Run transfer(file_name, path) -> (stored file_name, size) for every
+    (file_name, path) of items on a bounded thread pool
+    A failing file is reported in its TransferResult and does not stop
+    the others
+    """
+    def run(item) -> TransferResult:
+        file_name, path = item
+        start = time.perf_counter()
+        try:
+            file_name, size = transfer(file_name, path)
+        except Exception as e:
+            return TransferResult(file_name, path, 0,
+                                  time.perf_counter() - start, e)
+        return TransferResult(file_name, path, size,
+                              time.perf_counter() - start)
+
+    items = list(items)
+    start = time.perf_counter()
+    if not items:
+        return TransferReport([], 0.0)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run, items))
+    return TransferReport(results, time.perf_counter() - start)
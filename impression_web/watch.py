@@ -0,0 +1,115 @@
+"""
+Push based job status watching
+A single snapshot listener per watched target (a job document or a
+user's jobs) is shared by all of its subscribers, which are called with
+(job, previous_status) on every status transition
+"""
+import threading
+from typing import Callable, Hashable
+
+
+class Subscription:
+    """Handle for a subscriber, unsubscribe() to stop receiving updates"""
+    def __init__(self, hub: 'WatchHub', key: Hashable, callback: Callable):
+        self._hub = hub
+        self.key = key
+        self.callback = callback
+
+    def unsubscribe(self):
+        self._hub._unsubscribe(self)
+
+
+class _Target:
+    """One listener and the latest known job for each of its documents"""
+    def __init__(self, decode: Callable):
+        self.decode = decode
+        self.subscribers = []
+        self.jobs = {}
+        self.listener = None
+        self.lock = threading.Lock()
+
+    def on_snapshot(self, docs, changes, read_time):
+        """Listener callback: notify subscribers of status transitions"""
+        transitions = []
+        with self.lock:
+            for change in changes:
+                job_id = change.document.id
+                if change.type.name == 'REMOVED':
+                    self.jobs.pop(job_id, None)
+                    continue
+
+                job = self.decode(change.document)
+                previous = self.jobs.get(job_id)
+                self.jobs[job_id] = job
+                if previous is None or previous.status != job.status:
+                    transitions.append(
+                        (job, None if previous is None else previous.status))
+            subscribers = list(self.subscribers)
+
+        for job, previous_status in transitions:
+            for subscription in subscribers:
+                subscription.callback(job, previous_status)
+
+
+class WatchHub:
+    """
+    Multiplex snapshot listeners over many subscribers
+    subscribe(): start (or share) the listener for key
+    The listener is stopped once its last subscriber unsubscribes
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._targets = {}
+
+    def subscribe(self, key: Hashable, listen: Callable, decode: Callable,
+                  callback: Callable) -> Subscription:
+        """
+        key: identifies the watched target, subscribers with equal keys
+            share a listener
+        listen: on_snapshot of the target, returns a listener with
+            unsubscribe()
+        decode: job from a document snapshot
+        callback: called with (job, previous_status), previous_status is
+            None for the current state delivered on subscription
+        """
+        subscription = Subscription(self, key, callback)
+        with self._lock:
+            target = self._targets.get(key)
+            if target is None:
+                target = _Target(decode)
+                target.subscribers.append(subscription)
+                self._targets[key] = target
+                target.listener = listen(target.on_snapshot)
+                return subscription
+
+            with target.lock:
+                target.subscribers.append(subscription)
+                current = list(target.jobs.values())
+
+        for job in current:
+            callback(job, None)
+        return subscription
+
+    def _unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            target = self._targets.get(subscription.key)
+            if target is None:
+                return
+            with target.lock:
+                try:
+                    target.subscribers.remove(subscription)
+                except ValueError:
+                    return
+                if target.subscribers:
+                    return
+            del self._targets[subscription.key]
+        if target.listener is not None:
+            target.listener.unsubscribe()
+
+    def listeners(self) -> int:
+        """Number of active listeners"""
+        with self._lock:
+            return len(self._targets)
+
+
+hub = WatchHub()
@@ -0,0 +1,13 @@
+"""
+Shared helpers of the tests
+"""
+import asyncio
+
+
+def run(coroutine):
+    """Run coroutine to completion on a new event loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
@@ -0,0 +1,63 @@
+"""
+Testing for the shared client registry
+"""
+import os
+import threading
+import unittest
+
+from impression_web import clients
+from impression_web.database.database_factory import ImpressionDatabaseFactory
+from impression_web.database.fake_firestore import FakeFirestoreClient
+from impression_web.job.job_factory import ImpressionJobFactory
+
+
+class TestClientRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = clients.ClientRegistry()
+        self.constructed = 0
+
+    def factory(self, **kwargs):
+        self.constructed += 1
+        return object()
+
+    def test_shared_per_key(self):
+        client = self.registry.get('kind', self.factory)
+
+        self.assertIs(self.registry.get('kind', self.factory), client)
+        self.assertIsNot(
+            self.registry.get('kind', self.factory, project='other'), client)
+        self.assertEqual(self.constructed, 2)
+
+    def test_concurrent_get(self):
+        results = []
+        threads = [threading.Thread(
+            target=lambda: results.append(
+                self.registry.get('kind', self.factory)))
+            for _ in range(16)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+
+        self.assertEqual(self.constructed, 1)
+        self.assertEqual(len(set(map(id, results))), 1)
+
+    def test_fork_discards_clients(self):
+        client = self.registry.get('kind', self.factory)
+        self.registry._pid = os.getpid() + 1  # as seen by a forked child
+
+        self.assertIsNot(self.registry.get('kind', self.factory), client)
+
+    def test_injected_client(self):
+        fake = FakeFirestoreClient()
+        clients.registry.register(clients.FIRESTORE, fake)
+        try:
+            job = ImpressionJobFactory(platform='gcp').job(
+                'test-user', model='fchl', job_id='test-job')
+            database = ImpressionDatabaseFactory(platform='gcp').database()
+
+            self.assertIs(job.db, fake)
+            self.assertIs(database.db, fake)
+            job.update_in_db()
+            self.assertEqual(list(database.user_job_ids('test-user')),
+                             ['test-job'])
+        finally:
+            clients.registry.clear()
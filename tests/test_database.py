@@ -1,9 +1,31 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import pathlib
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 import warnings
 
+from impression_web import sharding, watch
+from impression_web.cache import JobCache
 from impression_web.database.database_factory import ImpressionDatabaseFactory
+from impression_web.database.exceptions import LeaseError
+from impression_web.database.fake_firestore import FakeFirestoreClient, \
+    FakeQuery
+from impression_web.job.async_job import AsyncJob
+from impression_web.job.exceptions import JobConflictError, \
+    JobCreationError
 from impression_web.job.job_factory import ImpressionJobFactory
-from impression_web.job.job import Job
+from impression_web.job.job import Job, JobStatus
+from impression_web.storage.exceptions import FileTransferError
+from impression_web.storage.file_storage import INPUT, OUTPUT
+from impression_web.storage.file_storage_factory import \
+    ImpressionFileStorageFactory
+
+from tests.helpers import run
 
 
 class TestImpressionDatabase(unittest.TestCase):
@@ -52,3 +74,591 @@ class TestImpressionDatabase(unittest.TestCase):
     @classmethod
     def tearDownClass(cls) -> None:
         [job.delete_in_db() for job in cls.jobs]
+
+
+class TestGCPDatabaseOffline(unittest.TestCase):
+    """GCPDatabase against the in-process firestore stand-in"""
+    def setUp(self) -> None:
+        self.db = FakeFirestoreClient()
+        self.database = ImpressionDatabaseFactory(
+            platform='gcp').database(db=self.db)
+        self.job_factory = ImpressionJobFactory(platform='gcp')
+        self.user = 'not-a-user'
+
+    def _jobs(self, n):
+        return [self.job_factory.job(user=self.user, model='no-model')
+                for _ in range(n)]
+
+    def test_save_jobs_batched(self):
+        jobs = self._jobs(1201)
+        job_ids = self.database.save_jobs(jobs)
+
+        self.assertEqual(job_ids, [job.job_id for job in jobs],
+                         'assigned ids returned in order')
+        self.assertEqual(len(set(job_ids)), len(jobs), 'unique ids')
+        self.assertEqual(self.db.round_trips, 3,
+                         'one commit per 500 jobs')
+        self.assertCountEqual(self.database.user_job_ids(self.user), job_ids)
+
+    def test_legacy_job_ids(self):
+        self.db.document(u'jobs/legacy-job').set(
+            {u'user': self.user, u'model': 'no-model'})
+        self.assertEqual(list(self.database.user_job_ids(self.user)),
+                         ['legacy-job'], 'entries without a job_id field')
+
+    def test_injected_latency(self):
+        self.db.latency = 0.05
+        self.database.save_jobs(self._jobs(10))
+        self.db.round_trips = 0
+        # each request waits for the other three: breaks if they do not
+        # overlap
+        barrier = threading.Barrier(4)
+        with mock.patch('time.sleep',
+                        side_effect=lambda _: barrier.wait(5)) as sleep, \
+                ThreadPoolExecutor(4) as executor:
+            list(executor.map(
+                lambda _: list(self.database.user_job_ids(self.user)),
+                range(4)))
+        self.assertEqual(self.db.round_trips, 4)
+        self.assertEqual(sleep.call_args_list, [mock.call(0.05)] * 4)
+
+    def test_save_jobs_existing_ids(self):
+        jobs = [self.job_factory.job(user=self.user, model='no-model',
+                                     job_id=f'test-job-{i + 1}')
+                for i in range(3)]
+
+        self.assertEqual(self.job_factory.update_many(jobs, db=self.db),
+                         ['test-job-1', 'test-job-2', 'test-job-3'])
+
+    def test_save_empty_job(self):
+        with self.assertRaises(JobCreationError):
+            self.database.save_jobs(self._jobs(2) + [self.job_factory.job()])
+        self.assertEqual(self.db.round_trips, 0, 'nothing written')
+
+    def test_user_jobs_pagination(self):
+        jobs = self._jobs(45)
+        for i, job in enumerate(jobs):
+            job.status = JobStatus.FINISHED if i % 3 else JobStatus.QUEUED
+            job.info = f'{i % 7:02d}'
+        self.database.save_jobs(jobs)
+
+        for order_by in (None, 'info'):
+            page = self.database.user_jobs(
+                self.user, limit=20, order_by=order_by)
+            seen = list(page)
+            while page.next_token is not None:
+                page = self.database.user_jobs(
+                    self.user, limit=20, order_by=order_by,
+                    start_after=page.next_token)
+                seen.extend(page)
+
+            self.assertCountEqual([job.job_id for job in seen],
+                                  [job.job_id for job in jobs],
+                                  'every job seen exactly once')
+            if order_by is not None:
+                self.assertEqual([job.info for job in seen],
+                                 sorted(job.info for job in jobs))
+
+    def test_jobs_between(self):
+        jobs = self._jobs(30)
+        for i, job in enumerate(jobs):
+            job.submission_time = datetime(2021, 1, 1, 12, i, 30 - i,
+                                           tzinfo=timezone.utc)
+        self.database.save_jobs(jobs)
+
+        start = datetime(2021, 1, 1, 12, 5, tzinfo=timezone.utc)
+        end = datetime(2021, 1, 1, 12, 25, tzinfo=timezone.utc)
+        page = self.database.jobs_between(start, end, self.user, limit=8)
+        seen = list(page)
+        while page.next_token is not None:
+            page = self.database.jobs_between(
+                start, end, self.user, limit=8, start_after=page.next_token)
+            seen.extend(page)
+
+        self.assertEqual([job.job_id for job in seen],
+                         [job.job_id for job in jobs[5:25]],
+                         'ordered by submission_time on the server')
+
+        page = self.database.user_jobs(self.user, order_by='submission_time',
+                                       descending=True)
+        self.assertEqual([job.job_id for job in page],
+                         [job.job_id for job in reversed(jobs)])
+
+        with self.assertRaises(ValueError):
+            self.database.jobs_between(start, end, field='info')
+
+    def test_migrate_timestamps(self):
+        jobs = self._jobs(3)
+        self.database.save_jobs(jobs)
+        self.db.document(f'jobs/{jobs[0].job_id}').update(
+            {'submission_time': '21-01-01::12:00', 'start_time': None})
+
+        start = datetime(2021, 1, 1, 11, 0).astimezone(timezone.utc)
+        end = datetime(2021, 1, 1, 13, 0).astimezone(timezone.utc)
+        self.assertEqual(list(self.database.jobs_between(start, end)), [],
+                         'legacy strings are not timestamps')
+
+        self.assertEqual(self.database.migrate_timestamps(),
+                         [jobs[0].job_id])
+        self.assertEqual(
+            [job.job_id for job in self.database.jobs_between(start, end)],
+            [jobs[0].job_id])
+        self.assertEqual(self.database.migrate_timestamps(), [],
+                         'nothing left to migrate')
+
+    def test_user_jobs_status(self):
+        jobs = self._jobs(5)
+        jobs[0].status = JobStatus.QUEUED
+        self.database.save_jobs(jobs)
+
+        page = self.database.user_jobs(self.user, limit=3,
+                                       status=JobStatus.QUEUED)
+        self.assertEqual([job.job_id for job in page], [jobs[0].job_id])
+        self.assertIsNone(page.next_token, 'single page')
+
+    def test_user_jobs_invalid_token(self):
+        with self.assertRaises(ValueError):
+            self.database.user_jobs(self.user, limit=2, order_by='info',
+                                    start_after='not-a-token')
+
+    def test_user_job_summaries(self):
+        jobs = self._jobs(3)
+        jobs[1].status = JobStatus.FINISHED
+        self.database.save_jobs(jobs)
+
+        summaries = list(self.database.user_job_summaries(
+            self.user, fields=['job_id', 'status'],
+            status=JobStatus.FINISHED))
+        self.assertEqual(summaries, [{'job_id': jobs[1].job_id,
+                                      'status': JobStatus.FINISHED.value}])
+
+        with self.assertRaises(ValueError):
+            self.database.user_job_summaries(self.user, fields=['not-a-field'])
+
+    def _queue(self, n, model='no-model'):
+        jobs = self._jobs(n)
+        for i, job in enumerate(jobs):
+            job.model = model
+            job.status = JobStatus.QUEUED
+            job.submission_time = datetime(2021, 1, 1, 0, n - i)
+        self.database.save_jobs(jobs)
+        return jobs
+
+    def test_claim_next(self):
+        jobs = self._queue(3)
+        self._queue(2, model='other-model')
+
+        job = self.database.claim_next('worker-1', model='no-model')
+        self.assertEqual(job.job_id, jobs[-1].job_id, 'oldest job claimed')
+        self.assertEqual(job.status, JobStatus.STARTED)
+        self.assertEqual(job.worker_id, 'worker-1')
+        self.assertIsNotNone(job.start_time)
+
+        claimed = [self.database.claim_next('worker-1', model='no-model')
+                   for _ in range(3)]
+        self.assertIsNone(claimed[-1], 'queue exhausted')
+
+    def test_concurrent_claims(self):
+        jobs = self._queue(20)
+        claimed = []
+
+        def work(worker_id):
+            while True:
+                job = self.database.claim_next(worker_id)
+                if job is None:
+                    return
+                claimed.append(job.job_id)
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(work, [f'worker-{i}' for i in range(4)]))
+
+        self.assertCountEqual(claimed, [job.job_id for job in jobs],
+                              'each job claimed exactly once')
+
+    def test_claimed_job_precondition(self):
+        jobs = self._queue(1)
+        job = self.database.claim_next('worker-1')
+        self.database.renew_lease(job)
+        job.info = 'progress'
+        with self.assertRaises(JobConflictError):
+            job.update_in_db(precondition=True)
+
+        job = self.job_factory.from_id(jobs[0].job_id, self.user,
+                                       db=self.db)
+        job.info = 'progress'
+        job.update_in_db(precondition=True)
+        self.assertEqual(
+            self.db.document(f'jobs/{job.job_id}').get().to_dict()['info'],
+            'progress')
+
+    def test_claim_rounds(self):
+        self._queue(2)
+        self.db.round_trips = 0
+        # every candidate taken by other workers
+        with mock.patch('impression_web.database.gcp_database._claim',
+                        return_value=None) as claim:
+            self.assertIsNone(self.database.claim_next('worker-1'))
+        rounds = self.database.CLAIM_ROUNDS
+        self.assertEqual(claim.call_count, 2 * rounds)
+        self.assertEqual(self.db.round_trips, rounds,
+                         'one query per round, no requeue_expired')
+
+    def test_claim_empty_queue(self):
+        self.db.round_trips = 0
+        self.assertIsNone(self.database.claim_next('worker-1'))
+        self.assertEqual(self.db.round_trips, 2,
+                         'the queue, then expired leases')
+
+    def test_expired_lease_requeued(self):
+        self._queue(1)
+        job = self.database.claim_next('worker-1', lease_seconds=-1)
+        reclaimed = self.database.claim_next('worker-2')
+
+        self.assertEqual(reclaimed.job_id, job.job_id)
+        self.assertEqual(reclaimed.worker_id, 'worker-2')
+        job.output_name = 'output.sdf'
+        storage = mock.Mock()
+        storage.output_url.return_value = ('https://signed/1', 100.0)
+        with self.assertRaises(LeaseError):
+            self.database.complete(job, storage)
+        with self.assertRaises(LeaseError):
+            self.database.fail(job, 'bad input')
+        self.assertEqual((job.status, job.completion_time, job.worker_id,
+                          job.output_file_url, job.err),
+                         (JobStatus.STARTED, None, 'worker-1', None, ''),
+                         'unchanged by the failed complete and fail')
+        self.assertEqual(job.dirty_fields, {'output_name'})
+
+    def test_complete_and_fail(self):
+        self._queue(2)
+        job = self.database.renew_lease(self.database.claim_next('worker-1'))
+        job.output_name = 'output.sdf'
+        self.database.complete(job)
+
+        failed = self.database.fail(self.database.claim_next('worker-1'),
+                                    'bad input')
+
+        stored = {j.job_id: j for j in self.database.user_jobs(self.user)}
+        self.assertEqual(stored[job.job_id].status, JobStatus.FINISHED)
+        self.assertEqual(stored[job.job_id].to_dict()['output_name'],
+                         'output.sdf')
+        self.assertIsNone(stored[job.job_id].worker_id)
+        self.assertEqual(stored[failed.job_id].status, JobStatus.ERROR)
+        self.assertEqual(stored[failed.job_id].err, 'bad input')
+        with self.assertRaises(LeaseError):
+            self.database.renew_lease(job)
+
+    def test_complete_signed_url(self):
+        storage = mock.Mock()
+        storage.output_url.side_effect = [('https://signed/1', 100.0),
+                                          ('https://signed/2', 1e12)]
+        self._queue(1)
+        job = self.database.claim_next('worker-1')
+        job.output_name = 'output.sdf'
+        self.database.complete(job, storage, url_lifetime=100)
+        storage.output_url.assert_called_once_with('output.sdf', 100)
+
+        stored, = self.database.user_jobs(self.user)
+        self.assertEqual(stored.output_file_url, 'https://signed/1')
+        self.assertEqual(stored.output_url_expiry, 100.0)
+
+        # expired: signed again and saved
+        self.assertEqual(stored.signed_output_url(storage), 'https://signed/2')
+        self.assertEqual(stored.signed_output_url(storage), 'https://signed/2')
+        self.assertEqual(storage.output_url.call_count, 2)
+        stored, = self.database.user_jobs(self.user)
+        self.assertEqual(stored.output_file_url, 'https://signed/2')
+
+    def test_watch_user_jobs(self):
+        jobs = self._queue(2)
+        first, second = [], []
+        subscription = self.database.watch_user_jobs(
+            self.user, lambda job, previous: first.append(
+                (job.job_id, previous, job.status)))
+        other = self.database.watch_user_jobs(
+            self.user, lambda job, previous: second.append(job.status))
+        self.assertEqual(watch.hub.listeners(), 1, 'listener shared')
+
+        job = self.database.claim_next('worker-1')
+        job.info = 'progress'
+        job.update_in_db()  # no status change, no notification
+        self.database.complete(job)
+
+        self.assertCountEqual(
+            first,
+            [(j.job_id, None, JobStatus.QUEUED) for j in jobs] +
+            [(job.job_id, JobStatus.QUEUED, JobStatus.STARTED),
+             (job.job_id, JobStatus.STARTED, JobStatus.FINISHED)])
+        self.assertEqual(len(second), 4)
+
+        subscription.unsubscribe()
+        other.unsubscribe()
+        self.assertEqual(watch.hub.listeners(), 0, 'listener stopped')
+
+    def test_cached_user_jobs(self):
+        database = ImpressionDatabaseFactory(platform='gcp').database(
+            db=self.db, cache=JobCache())
+        jobs = self._jobs(3)
+        database.save_jobs(jobs)
+        self.db.round_trips = 0
+
+        first = list(database.user_jobs(self.user))
+        second = list(database.user_jobs(self.user))
+        self.assertEqual([j.job_id for j in first],
+                         [j.job_id for j in second])
+        self.assertEqual(self.db.round_trips, 1, 'listing cached')
+
+        jobs[0].delete_in_db()
+        self.assertEqual(len(list(database.user_jobs(self.user))), 2,
+                         'invalidated by delete_in_db')
+
+    def test_cached_user_jobs_expiry(self):
+        clock = [0.0]
+        database = ImpressionDatabaseFactory(platform='gcp').database(
+            db=self.db, cache=JobCache(default_ttl=5, clock=lambda: clock[0]))
+        jobs = self._jobs(2)
+        for job in jobs:
+            job.status = JobStatus.FINISHED
+        database.save_jobs(jobs)
+        self.assertEqual(len(list(database.user_jobs(self.user))), 2)
+
+        # submitted elsewhere, not invalidating this process' cache
+        self.db.collection(u'jobs').document().set(self._jobs(1)[0].to_dict())
+        clock[0] = 10
+        self.assertEqual(len(list(database.user_jobs(self.user))), 3,
+                         'listings of finished jobs expire too')
+
+    def test_cached_user_jobs_partial_update(self):
+        database = ImpressionDatabaseFactory(platform='gcp').database(
+            db=self.db, cache=JobCache())
+        database.save_jobs(self._jobs(2))
+        list(database.user_jobs(self.user, order_by=u'job_id'))
+        self.db.round_trips = 0
+        job = list(database.user_jobs(self.user, order_by=u'job_id'))[0]
+        self.assertEqual(self.db.round_trips, 0, 'listed from cache')
+
+        # written elsewhere, not invalidating this process' cache
+        self.db.document(f'jobs/{job.job_id}').update({u'err': 'frontend'})
+        job.info = 'progress'
+        job.update_in_db()
+        stored = self.db.document(f'jobs/{job.job_id}').get().to_dict()
+        self.assertEqual((stored[u'info'], stored[u'err']),
+                         ('progress', 'frontend'))
+
+    def test_delete_jobs(self):
+        jobs = self._jobs(3)
+        jobs[0].upload_name = 'upload-0.sdf'
+        jobs[0].output_name = 'output-0.sdf'
+        self.database.save_jobs(jobs)
+        storage = mock.Mock()
+        storage.delete_output_file.side_effect = FileTransferError
+
+        deleted = self.database.delete_jobs(
+            [jobs[0].job_id, jobs[1].job_id], storage=storage)
+
+        self.assertEqual(deleted, [jobs[0].job_id, jobs[1].job_id])
+        self.assertEqual(list(self.database.user_job_ids(self.user)),
+                         [jobs[2].job_id])
+        storage.delete_input_file.assert_called_once_with('upload-0.sdf')
+        storage.delete_output_file.assert_called_once_with('output-0.sdf')
+
+    def test_delete_user_jobs(self):
+        self.database.save_jobs(self._jobs(501))
+        self.database.save_jobs([self.job_factory.job(user='other-user')])
+
+        with mock.patch.object(FakeQuery, 'select', autospec=True,
+                               side_effect=FakeQuery.select) as select:
+            self.assertEqual(len(self.database.delete_user_jobs(self.user)),
+                             501)
+        select.assert_called_once_with(mock.ANY, [u'__name__'])
+        self.assertEqual(list(self.database.user_job_ids(self.user)), [])
+        self.assertEqual(len(list(self.database.user_jobs('other-user'))), 1)
+
+    def test_delete_in_db(self):
+        job = self._jobs(1)[0]
+        self.database.save_jobs([job])
+        self.db.round_trips = 0
+
+        self.assertTrue(job.delete_in_db())
+        self.assertEqual(self.db.round_trips, 1, 'no read back')
+
+    def test_shard_plan(self):
+        self.assertEqual(sharding.plan(7, shards=3), [(0, 3), (3, 5), (5, 7)])
+        self.assertEqual(sharding.plan(7, max_records=2),
+                         [(0, 2), (2, 4), (4, 6), (6, 7)])
+        self.assertEqual(sharding.plan(2, shards=5), [(0, 1), (1, 2)])
+        self.assertEqual(sharding.plan(0, shards=5), [])
+        with self.assertRaises(ValueError):
+            sharding.plan(7, shards=2, max_records=2)
+
+    def test_shard_job(self):
+        with tempfile.TemporaryDirectory() as root:
+            storage = ImpressionFileStorageFactory(
+                platform='local').file_storage(
+                input_bucket_name='impression-uploads',
+                output_bucket_name='impression-output', root=root)
+            records = [f'molecule-{i}\nM  END\n$$$$\n'.encode()
+                       for i in range(7)]
+            path = pathlib.Path(root) / 'large.sdf'
+            path.write_bytes(b''.join(records))
+            parent = self.job_factory.job(
+                self.user, {'input_name': 'large.sdf', 'upload_name': None},
+                'no-model')
+
+            children = self.database.shard_job(parent, path, storage,
+                                               shards=3)
+
+            self.assertEqual([c.shard_index for c in children], [0, 1, 2])
+            self.assertEqual(
+                b''.join(storage.download_bytes(c.upload_name, INPUT)
+                         for c in children), path.read_bytes())
+            self.assertEqual(
+                storage.download_bytes(children[1].upload_name, INPUT),
+                b''.join(records[3:5]))
+
+        stored = self.job_factory.from_id(parent.job_id, self.user,
+                                          db=self.db)
+        self.assertEqual((stored.status, stored.shards),
+                         (JobStatus.STARTED, 3))
+        self.assertEqual(stored.shard_progress, 0)
+
+        claimed = [self.database.claim_next(f'worker-{i}') for i in range(4)]
+        self.assertIsNone(claimed[3], 'only the children are queued')
+        self.assertEqual({job.parent_id for job in claimed[:3]},
+                         {parent.job_id})
+        self.database.complete(claimed[0])
+        self.database.fail(claimed[1], 'bad molecule')
+        stored = self.job_factory.from_id(parent.job_id, self.user,
+                                          db=self.db)
+        self.assertAlmostEqual(stored.shard_progress, 2 / 3)
+        self.assertEqual(stored.status, JobStatus.STARTED)
+
+        self.database.complete(claimed[2])
+        stored = self.job_factory.from_id(parent.job_id, self.user,
+                                          db=self.db)
+        self.assertEqual((stored.status, stored.err, stored.shards_finished),
+                         (JobStatus.ERROR, '1 of 3 shards failed', 2))
+        self.assertIsNotNone(stored.completion_time)
+
+    def test_shard_claimed_job(self):
+        self._queue(1)
+        parent = self.database.claim_next('worker-1', lease_seconds=60)
+        with tempfile.TemporaryDirectory() as root:
+            storage = ImpressionFileStorageFactory(
+                platform='local').file_storage(
+                input_bucket_name='impression-uploads',
+                output_bucket_name='impression-output', root=root)
+            path = pathlib.Path(root) / 'large.sdf'
+            path.write_bytes(b'molecule\n$$$$\n' * 4)
+            self.database.shard_job(parent, path, storage, shards=2)
+
+        stored = self.job_factory.from_id(parent.job_id, self.user,
+                                          db=self.db)
+        self.assertEqual((stored.worker_id, stored.lease_expiry),
+                         (None, None), 'lease released')
+
+        # a lease left on the parent (e.g. by an older version) expires
+        self.db.document(f'jobs/{parent.job_id}').update(
+            {u'worker_id': 'worker-1', u'lease_expiry': time.time() - 1})
+        self.assertEqual(self.database.requeue_expired(), [])
+        claimed = [self.database.claim_next(f'worker-{i}')
+                   for i in range(2, 5)]
+        self.assertEqual([job.parent_id for job in claimed[:2]],
+                         [parent.job_id] * 2, 'only the children')
+        self.assertIsNone(claimed[2])
+        stored = self.job_factory.from_id(parent.job_id, self.user,
+                                          db=self.db)
+        self.assertEqual((stored.status, stored.shards),
+                         (JobStatus.STARTED, 2))
+
+    def test_merge_shards(self):
+        with tempfile.TemporaryDirectory() as root:
+            storage = ImpressionFileStorageFactory(
+                platform='local').file_storage(
+                input_bucket_name='impression-uploads',
+                output_bucket_name='impression-output', root=root)
+            path = pathlib.Path(root) / 'large.sdf'
+            path.write_bytes(b''.join(f'molecule-{i}\n$$$$\n'.encode()
+                                      for i in range(4)))
+            parent = self.job_factory.job(
+                self.user, {'input_name': 'large.sdf', 'upload_name': None},
+                'no-model')
+            self.database.shard_job(parent, path, storage, shards=2)
+
+            claimed = [self.database.claim_next(f'worker-{i}')
+                       for i in range(2)]
+            # completed out of order, merged in shard order
+            for job in sorted(claimed, key=lambda j: -j.shard_index):
+                job.output_name = f'out-{job.shard_index}.sdf'
+                storage.upload_bytes(f'result {job.shard_index}\n'.encode(),
+                                     job.output_name, bucket=OUTPUT)
+                self.database.complete(job, storage)
+
+            stored = self.job_factory.from_id(parent.job_id, self.user,
+                                              db=self.db)
+            self.assertEqual(stored.status, JobStatus.FINISHED)
+            self.assertEqual(stored.output_name,
+                             sharding.merged_name(parent.job_id, '.sdf'))
+            self.assertEqual(storage.download_bytes(stored.output_name),
+                             b'result 0\nresult 1\n')
+            with storage.open_url(stored.output_file_url) as stream:
+                self.assertEqual(stream.read(), b'result 0\nresult 1\n')
+
+    def test_merge_shards_failed(self):
+        with tempfile.TemporaryDirectory() as root:
+            storage = ImpressionFileStorageFactory(
+                platform='local').file_storage(
+                input_bucket_name='impression-uploads',
+                output_bucket_name='impression-output', root=root)
+            path = pathlib.Path(root) / 'large.sdf'
+            path.write_bytes(b'molecule-0\n$$$$\nmolecule-1\n$$$$\n')
+            parent = self.job_factory.job(
+                self.user, {'input_name': 'large.sdf', 'upload_name': None},
+                'no-model')
+            self.database.shard_job(parent, path, storage, shards=2)
+            claimed = [self.database.claim_next(f'worker-{i}')
+                       for i in range(2)]
+            for job in claimed:
+                job.output_name = f'out-{job.shard_index}.sdf'
+                storage.upload_bytes(b'result\n', job.output_name,
+                                     bucket=OUTPUT)
+
+            self.database.complete(claimed[0], storage)
+            with mock.patch.object(storage, 'merge_outputs',
+                                   side_effect=FileTransferError('down')), \
+                    self.assertLogs('impression_web.database.gcp_database'):
+                last = self.database.complete(claimed[1], storage)
+
+        self.assertEqual(last.status, JobStatus.FINISHED)
+        stored = self.db.document(f'jobs/{last.job_id}').get().to_dict()
+        self.assertEqual(stored['status'], JobStatus.FINISHED)
+        stored = self.db.document(f'jobs/{parent.job_id}').get().to_dict()
+        self.assertEqual((stored['status'], stored['err']),
+                         (JobStatus.ERROR, 'merging shard outputs failed: '
+                                           'down'))
+
+    def test_async_database(self):
+        database = ImpressionDatabaseFactory(
+            platform='gcp', mode='async').database(db=self.db)
+        self._queue(3)
+
+        async def work():
+            claimed = await asyncio.gather(
+                *(database.claim_next(f'worker-{i}') for i in range(4)))
+            job = next(j for j in claimed if j is not None)
+            job.output_name = 'output.sdf'
+            await database.complete(job)
+            page = await database.user_jobs(self.user, limit=2,
+                                            order_by='submission_time')
+            jobs = [j async for j in page]
+            return claimed, jobs, page.next_token
+
+        claimed, jobs, next_token = run(work())
+        claimed = [job for job in claimed if job is not None]
+        self.assertEqual(len({job.job_id for job in claimed}), 3,
+                         'each job claimed once')
+        self.assertIsInstance(jobs[0], AsyncJob)
+        self.assertEqual(len(jobs), 2)
+        self.assertIsNotNone(next_token)
+        stored = self.db.document(f'jobs/{claimed[0].job_id}').get()
+        self.assertEqual(stored.to_dict()['status'], JobStatus.FINISHED)
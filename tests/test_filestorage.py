@@ -1,10 +1,26 @@
+import asyncio
+import gzip
+import importlib.util
+import io
+import os
 import pathlib
+import tempfile
+import time
 import unittest
+from unittest import mock
 import warnings
 
+from impression_web.storage import compression
+from impression_web.storage.disk_cache import DiskCache
+from impression_web.storage.file_storage import CONTENT_PREFIX, INPUT, \
+    OUTPUT
 from impression_web.storage.file_storage_factory import ImpressionFileStorageFactory
 from impression_web.storage.gcp_storage import GCPStorage
+from impression_web.storage.streams import ConcatenatingReader
 from impression_web.storage.exceptions import FileTransferError
+from impression_web.storage.fake_storage import FakeStorageClient
+
+from tests.helpers import run
 
 
 class TestImpressionFileStorage(unittest.TestCase):
@@ -117,7 +133,516 @@ class TestImpressionFileStorage(unittest.TestCase):
         except FileNotFoundError:
             pass
 
+    def test_output_stream(self):
+        self.storage.upload_output_stream(io.BytesIO(b'streamed'),
+                                          'test-output-stream.sdf')
+        with self.storage.open_output('test-output-stream.sdf') as stream:
+            self.assertEqual(stream.read(), b'streamed')
+        self.storage.delete_output_file('test-output-stream.sdf')
+
+    def test_upload_many(self):
+        report = self.storage.upload_many(
+            [self.test_input_path,
+             (self.test_output_path, 'test-upload-many.sdf')])
+
+        self.assertEqual(len(report.succeeded), 2)
+        self.assertTrue(self.storage._exists(self.storage._input_bucket,
+                                             'test-upload-many.sdf'))
+        self.storage.delete_many(
+            [self.test_input_path.name, 'test-upload-many.sdf'],
+            bucket=INPUT).raise_for_errors()
+
     @classmethod
     def tearDownClass(cls) -> None:
         cls.storage.delete_input_file(cls.persistent_input.name)
         cls.storage.delete_output_file(cls.persistent_output.name)
+
+
+class TestLocalStorage(unittest.TestCase):
+    """Multi-file transfers against the local filesystem stand-in"""
+    def setUp(self) -> None:
+        self.root = tempfile.TemporaryDirectory()
+        self.storage = ImpressionFileStorageFactory(
+            platform='local').file_storage(
+            input_bucket_name='impression-uploads',
+            output_bucket_name='impression-output',
+            root=self.root.name)
+        self.files = [pathlib.Path(self.root.name) / f'file-{i}.sdf'
+                      for i in range(20)]
+        for i, path in enumerate(self.files):
+            path.write_bytes(b'x' * (i + 1))
+
+    def test_upload_many(self):
+        report = self.storage.upload_many(
+            self.files + [pathlib.Path('data/input/not-a-file.sdf')],
+            max_workers=4)
+
+        self.assertEqual([r.file_name for r in report],
+                         [path.name for path in self.files] +
+                         ['not-a-file.sdf'], 'results in request order')
+        self.assertEqual(len(report.succeeded), 20)
+        self.assertIsInstance(report.failed[0].error, FileTransferError)
+        self.assertEqual(report.bytes, sum(range(1, 21)))
+        self.assertEqual(report.stats()['failed'], 1)
+        with self.assertRaises(FileTransferError):
+            report.raise_for_errors()
+
+    def test_download_many(self):
+        self.storage.upload_many([(path, f'out-{path.name}')
+                                  for path in self.files], bucket=OUTPUT)
+        destination = pathlib.Path(self.root.name) / 'downloads'
+        destination.mkdir()
+
+        report = self.storage.download_many(
+            [(destination / path.name, f'out-{path.name}')
+             for path in self.files])
+        report.raise_for_errors()
+        self.assertEqual([(destination / p.name).read_bytes()
+                          for p in self.files],
+                         [p.read_bytes() for p in self.files])
+        self.assertGreater(report.bytes_per_second, 0)
+
+    def test_delete_many(self):
+        self.storage.upload_many(self.files[:3])
+
+        report = self.storage.delete_many(
+            [self.files[0].name, 'not-a-file', self.files[2].name])
+        self.assertEqual([r.ok for r in report], [True, False, True])
+        self.assertFalse(self.storage._exists(self.storage._input_bucket,
+                                              self.files[0].name))
+        self.assertTrue(self.storage._exists(self.storage._input_bucket,
+                                             self.files[1].name))
+
+    def test_streams(self):
+        with open(self.files[4], 'rb') as fileobj:
+            self.storage.upload_input_stream(fileobj, 'streamed.sdf')
+        self.storage.upload_output_stream(io.BytesIO(b'output'), 'out.sdf')
+
+        with self.storage.open_input('streamed.sdf') as stream:
+            self.assertEqual(stream.read(), b'x' * 5)
+        with self.storage.open_output('out.sdf') as stream:
+            self.assertEqual(stream.read(3), b'out')
+        with self.assertRaises(FileTransferError):
+            self.storage.open_output('not-a-file')
+
+    def test_bytes(self):
+        self.storage.upload_bytes(b'content', 'in.sdf')
+        self.storage.upload_bytes(b'result', 'in.sdf', bucket=OUTPUT)
+
+        self.assertEqual(self.storage.download_bytes('in.sdf', bucket=INPUT),
+                         b'content')
+        self.assertEqual(self.storage.download_bytes('in.sdf'), b'result')
+
+    def test_invalid_file_name(self):
+        with self.assertRaises(FileTransferError):
+            self.storage.upload_input_file(self.files[0], '../escaped.sdf')
+
+    def test_output_url(self):
+        self.storage.upload_bytes(b'result', 'results/out.sdf', bucket=OUTPUT)
+        signed = self.storage.output_url('results/out.sdf', lifetime=60)
+
+        self.assertAlmostEqual(signed.expiry, time.time() + 60, delta=5)
+        with self.storage.open_url(signed.url) as stream:
+            self.assertEqual(stream.read(), b'result')
+        with self.assertRaises(FileTransferError):
+            self.storage.open_url(signed.url.replace('out.sdf', 'in.sdf'))
+        with self.assertRaises(FileTransferError):
+            self.storage.url_signer.verify(signed.url, now=signed.expiry)
+        with self.assertRaises(ValueError):
+            self.storage.output_url('results/out.sdf', lifetime=0)
+
+    def test_merge_outputs(self):
+        names = [f'part-{i}.sdf' for i in range(3)]
+        for i, name in enumerate(names):
+            self.storage.upload_bytes(f'record {i}\n$$$$\n'.encode(), name,
+                                      bucket=OUTPUT)
+
+        merged = self.storage.merge_outputs(reversed(names), 'merged.sdf')
+
+        self.assertEqual(merged, 'merged.sdf')
+        self.assertEqual(self.storage.download_bytes(merged),
+                         b'record 2\n$$$$\nrecord 1\n$$$$\nrecord 0\n$$$$\n')
+        with self.assertRaises(FileTransferError):
+            self.storage.merge_outputs(names + ['missing.sdf'], 'merged.sdf')
+
+    def test_concatenating_reader(self):
+        opened = []
+
+        def opener(data):
+            def open_stream():
+                opened.append(data)
+                return io.BytesIO(data)
+            return open_stream
+
+        reader = ConcatenatingReader([opener(b'abc'), opener(b''),
+                                      opener(b'defg')], chunk_size=2,
+                                     rewind=2)
+        self.assertEqual(reader.read(2), b'ab')
+        self.assertEqual(opened, [b'abc'], 'streams opened lazily')
+        self.assertEqual(reader.read(3), b'cde')
+        reader.seek(-2, io.SEEK_CUR)
+        self.assertEqual(reader.read(), b'defg')
+        with self.assertRaises(io.UnsupportedOperation):
+            reader.seek(0)
+
+    def test_async(self):
+        storage = ImpressionFileStorageFactory(
+            platform='local', mode='async').file_storage(
+            input_bucket_name='impression-uploads',
+            output_bucket_name='impression-output',
+            root=self.root.name, chunk_size=4)
+
+        async def work():
+            await asyncio.gather(
+                *(storage.upload_output_file(path) for path in self.files))
+            await storage.upload_bytes(b'result', 'out.sdf', bucket=OUTPUT)
+            async with await storage.open_output('out.sdf') as stream:
+                chunks = [chunk async for chunk in stream]
+            report = await storage.delete_many(
+                [path.name for path in self.files], bucket=OUTPUT)
+            return chunks, report
+
+        chunks, report = run(work())
+        self.assertEqual(chunks, [b'resu', b'lt'])
+        self.assertEqual(len(report.succeeded), 20)
+        with self.assertRaises(FileTransferError):
+            run(storage.download_bytes('not-a-file'))
+
+    def tearDown(self) -> None:
+        self.root.cleanup()
+
+
+class TestGCPStorageOffline(unittest.TestCase):
+    """GCPStorage against the in-process storage stand-in"""
+    def setUp(self) -> None:
+        self.root = tempfile.TemporaryDirectory()
+        self.client = FakeStorageClient()
+        self.path = pathlib.Path(self.root.name) / 'input.sdf'
+        self.path.write_bytes(b'molecule\n$$$$\n' * 50000)
+
+    def _storage(self, **kwargs) -> GCPStorage:
+        return GCPStorage('impression-uploads', 'impression-output',
+                          client=self.client, **kwargs)
+
+    def test_round_trip(self):
+        storage = self._storage(chunk_size=GCPStorage.CHUNK_MULTIPLE,
+                                compression=compression.GZIP,
+                                deduplicate=True)
+        name = storage.upload_input_file(self.path)
+        self.assertEqual(storage.upload_input_file(self.path), name)
+        self.assertEqual(storage.references(name), 2)
+
+        destination = pathlib.Path(self.root.name) / 'download.sdf'
+        self._storage().download_input_file(destination, name)
+        self.assertEqual(destination.read_bytes(), self.path.read_bytes())
+        storage.delete_input_file(name)
+        storage.delete_input_file(name)
+        with self.assertRaises(FileTransferError):
+            storage.delete_input_file(name)
+
+    def test_merge_outputs_compose(self):
+        storage = self._storage()
+        names = [f'part-{i}.sdf' for i in range(GCPStorage.MAX_COMPOSE + 5)]
+        for i, name in enumerate(names):
+            storage.upload_bytes(f'{i}\n'.encode(), name, bucket=OUTPUT)
+
+        storage.merge_outputs(names, 'merged.sdf')
+
+        self.assertEqual(storage.download_bytes('merged.sdf'),
+                         ''.join(f'{i}\n' for i in range(len(names)))
+                         .encode())
+        self.assertEqual(len(self.client.bucket('impression-output')
+                             .list_blobs()), len(names) + 1,
+                         'intermediate objects deleted')
+        with self.assertRaises(FileTransferError):
+            storage.merge_outputs(['missing.sdf'], 'merged.sdf')
+
+    def test_compressed_output_url(self):
+        storage = self._storage(compression=compression.GZIP)
+        for name in ('part-0.sdf', 'part-1.sdf'):
+            storage.upload_bytes(b'molecule\n$$$$\n', name, bucket=OUTPUT)
+        storage.merge_outputs(['part-0.sdf', 'part-1.sdf'], 'merged.sdf')
+
+        bucket = self.client.bucket('impression-output')
+        for name in ('part-0.sdf', 'merged.sdf'):
+            blob = bucket.get_blob(name)
+            self.assertEqual(blob.content_encoding, 'gzip',
+                             'served as gzip through signed urls')
+            self.assertTrue(
+                blob.download_as_bytes().startswith(b'molecule\n'),
+                'decoded by http clients')
+        self.assertIn('/impression-output/merged.sdf?',
+                      storage.output_url('merged.sdf').url)
+        self.assertEqual(self._storage().download_bytes('merged.sdf'),
+                         b'molecule\n$$$$\n' * 2,
+                         'downloaded raw, decompressed once')
+
+        self._storage().upload_bytes(b'raw', 'raw.sdf', bucket=OUTPUT)
+        self.assertIsNone(bucket.get_blob('raw.sdf').content_encoding)
+
+    def test_ranged_download(self):
+        storage = self._storage(chunk_size=GCPStorage.CHUNK_MULTIPLE)
+        storage.upload_output_file(self.path)
+        self.client.round_trips = 0
+        with storage.open_output(self.path.name) as stream:
+            self.assertEqual(stream.read(), self.path.read_bytes())
+        # the blob, then 700 KB in 256 KiB ranges
+        self.assertEqual(self.client.round_trips, 4)
+
+    def test_cached_download_round_trips(self):
+        cache = DiskCache(pathlib.Path(self.root.name) / 'cache', 10 ** 7)
+        destination = pathlib.Path(self.root.name) / 'downloaded.sdf'
+        for method in (compression.GZIP, None):
+            storage = self._storage(compression=method, disk_cache=cache)
+            storage.upload_output_file(self.path, f'{method}.sdf')
+
+            self.client.round_trips = 0
+            storage.download_output_file(destination, f'{method}.sdf')
+            self.assertEqual(destination.read_bytes(),
+                             self.path.read_bytes())
+            self.assertEqual(self.client.round_trips, 2,
+                             'the blob once, then its content')
+
+            self.client.round_trips = 0
+            storage.download_output_file(destination, f'{method}.sdf')
+            self.assertEqual(self.client.round_trips, 1, 'cache hit')
+
+    @mock.patch('time.sleep')
+    def test_latency(self, sleep):
+        self.client.latency = 0.01
+        storage = self._storage(chunk_size=GCPStorage.CHUNK_MULTIPLE)
+        storage.upload_input_file(self.path)
+        # the bucket, 700 KB in 256 KiB chunks and the final request
+        self.assertEqual(self.client.round_trips, 5)
+        self.assertEqual(sleep.call_args_list, [mock.call(0.01)] * 5)
+
+        sleep.reset_mock()
+        self.client.latency = 0.0
+        self.client.bandwidth = 7e6
+        storage.download_bytes(self.path.name, INPUT)
+        self.assertAlmostEqual(sum(call[0][0] for call in
+                                   sleep.call_args_list),
+                               self.path.stat().st_size / 7e6)
+
+
+class TestCompression(unittest.TestCase):
+    """Compressed storage against the local filesystem stand-in"""
+    sdf = pathlib.Path('data/input/test-input-file-1.sdf')
+
+    def setUp(self) -> None:
+        self.root = tempfile.TemporaryDirectory()
+        self.factory = ImpressionFileStorageFactory(platform='local')
+
+    def _storage(self, method=None):
+        return self.factory.file_storage(
+            input_bucket_name='impression-uploads',
+            output_bucket_name='impression-output',
+            root=self.root.name, compression=method)
+
+    def _round_trip(self, method):
+        storage = self._storage(method)
+        storage.upload_input_file(self.sdf)
+        stored = (pathlib.Path(self.root.name) / 'impression-uploads' /
+                  self.sdf.name).read_bytes()
+        self.assertLess(len(stored), self.sdf.stat().st_size / 2,
+                        'stored compressed')
+
+        destination = pathlib.Path(self.root.name) / 'download.sdf'
+        self._storage().download_input_file(destination, self.sdf.name)
+        self.assertEqual(destination.read_bytes(), self.sdf.read_bytes(),
+                         'decompressed by any storage')
+        with storage.open_input(self.sdf.name) as stream:
+            self.assertEqual(stream.readline(),
+                             self.sdf.read_bytes().split(b'\n')[0] + b'\n')
+
+    def test_gzip(self):
+        self._round_trip(compression.GZIP)
+
+    @unittest.skipUnless(importlib.util.find_spec('zstandard'),
+                         'zstandard not installed')
+    def test_zstd(self):
+        self._round_trip(compression.ZSTD)
+
+    def test_raw_files_readable(self):
+        self._storage().upload_bytes(b'raw', 'raw.sdf')
+        self.assertEqual(
+            self._storage(compression.GZIP).download_bytes('raw.sdf', INPUT),
+            b'raw')
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            self._storage('lzma')
+
+    def test_merge_outputs(self):
+        gzipped, raw = self._storage(compression.GZIP), self._storage()
+        gzipped.upload_bytes(b'first\n', 'a.sdf', bucket=OUTPUT)
+        gzipped.upload_bytes(b'second\n', 'b.sdf', bucket=OUTPUT)
+        raw.upload_bytes(b'third\n', 'c.sdf', bucket=OUTPUT)
+
+        gzipped.merge_outputs(['a.sdf', 'b.sdf'], 'ab.sdf')
+        self.assertEqual(raw.download_bytes('ab.sdf'), b'first\nsecond\n')
+        stored = (pathlib.Path(self.root.name) / 'impression-output' /
+                  'ab.sdf').read_bytes()
+        self.assertEqual(gzip.decompress(stored), b'first\nsecond\n',
+                         'members joined as stored')
+
+        raw.merge_outputs(['ab.sdf', 'c.sdf'], 'abc.sdf')
+        self.assertEqual(gzipped.download_bytes('abc.sdf'),
+                         b'first\nsecond\nthird\n')
+
+    def test_compressing_reader_rewind(self):
+        data = bytes(range(256)) * 4096
+        reader = compression.CompressingReader(
+            io.BytesIO(data), compression.GZIP, chunk_size=4096, rewind=1024)
+        first = reader.read(1024)
+        second = reader.read(1024)
+        reader.seek(1024)
+        self.assertEqual(reader.read(1024), second, 'last chunk retried')
+        with self.assertRaises(io.UnsupportedOperation):
+            reader.seek(0)
+
+        compressed = first + second + reader.read()
+        self.assertEqual(reader.tell(), len(compressed))
+        self.assertEqual(gzip.decompress(compressed), data)
+
+    def tearDown(self) -> None:
+        self.root.cleanup()
+
+
+class TestDeduplication(unittest.TestCase):
+    """Content addressed inputs against the local filesystem stand-in"""
+    def setUp(self) -> None:
+        self.root = tempfile.TemporaryDirectory()
+        self.storage = ImpressionFileStorageFactory(
+            platform='local').file_storage(
+            input_bucket_name='impression-uploads',
+            output_bucket_name='impression-output',
+            root=self.root.name, deduplicate=True)
+        self.sdf = pathlib.Path('data/input/test-input-file-1.sdf')
+
+    def test_upload_once(self):
+        first = self.storage.upload_input_file(self.sdf)
+        copy = pathlib.Path(self.root.name) / 'resubmitted.sdf'
+        copy.write_bytes(self.sdf.read_bytes())
+        second = self.storage.upload_input_file(copy)
+
+        self.assertEqual(first, second, 'same content, same upload_name')
+        self.assertTrue(first.startswith(CONTENT_PREFIX))
+        self.assertTrue(first.endswith('.sdf'))
+        self.assertEqual(self.storage.references(first), 2)
+        other = self.storage.upload_input_file(
+            pathlib.Path('data/input/test-input-file-2.sdf'))
+        self.assertNotEqual(other, first)
+
+        self.storage.delete_input_file(first)
+        self.assertTrue(self.storage._exists(self.storage._input_bucket,
+                                             first), 'still referenced')
+        self.storage.delete_input_file(first)
+        self.assertFalse(self.storage._exists(self.storage._input_bucket,
+                                              first), 'last reference')
+        with self.assertRaises(FileTransferError):
+            self.storage.delete_input_file(first)
+
+    def test_concurrent_uploads(self):
+        report = self.storage.upload_many([self.sdf] * 16, max_workers=8)
+        names = {result.file_name for result in report}
+
+        self.assertEqual(len(names), 1)
+        self.assertEqual(self.storage.references(names.pop()), 16)
+
+    def test_streams(self):
+        name = self.storage.upload_input_stream(io.BytesIO(b'molecule'),
+                                                'upload.sdf')
+        self.assertEqual(self.storage.download_bytes(name, INPUT),
+                         b'molecule')
+        with self.assertRaises(ValueError):
+            self.storage.upload_input_stream(NonSeekable(b'molecule'),
+                                             'upload.sdf')
+
+    def tearDown(self) -> None:
+        self.root.cleanup()
+
+
+class TestDiskCache(unittest.TestCase):
+    """Cached downloads against the local filesystem stand-in"""
+    def setUp(self) -> None:
+        self.root = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.root.name)
+        self.cache = DiskCache(self.path / 'cache', max_bytes=100)
+        self.storage = ImpressionFileStorageFactory(
+            platform='local').file_storage(
+            input_bucket_name='impression-uploads',
+            output_bucket_name='impression-output',
+            root=self.path / 'buckets', disk_cache=self.cache)
+
+    def _download(self, file_name):
+        destination = self.path / f'downloaded-{file_name}'
+        with mock.patch.object(self.storage, '_download_file',
+                               wraps=self.storage._download_file) as fetch:
+            self.storage.download_output_file(destination, file_name)
+        return destination.read_bytes(), fetch.call_count
+
+    def test_repeat_download(self):
+        self.storage.upload_bytes(b'result', 'out.sdf', bucket=OUTPUT)
+
+        self.assertEqual(self._download('out.sdf'), (b'result', 1))
+        self.assertEqual(self._download('out.sdf'), (b'result', 0),
+                         'served from the cache')
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+        self.storage.upload_bytes(b'new result', 'out.sdf', bucket=OUTPUT)
+        self.assertEqual(self._download('out.sdf'), (b'new result', 1),
+                         'changed file fetched again')
+
+        with self.assertRaises(FileTransferError):
+            self._download('not-a-file')
+
+    def test_removed_file(self):
+        self.storage.upload_bytes(b'result', 'out.sdf', bucket=OUTPUT)
+        self._download('out.sdf')
+        for path in (self.path / 'cache').iterdir():
+            if path.read_bytes() == b'result':
+                path.unlink()
+
+        self.assertEqual(self._download('out.sdf'), (b'result', 1),
+                         'fetched again')
+        self.assertEqual(self._download('out.sdf'), (b'result', 0))
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+    def test_eviction(self):
+        for name in ('a', 'b', 'c'):
+            self.storage.upload_bytes(name.encode() * 40, name, OUTPUT)
+        self._download('a')
+        self._download('b')
+        self._download('a')
+        self._download('c')
+
+        self.assertEqual(self.cache.stats()['bytes'], 80)
+        self.assertEqual(self._download('a')[1], 0, 'recently used kept')
+        self.assertEqual(self._download('b')[1], 1, 'least recent evicted')
+
+    def test_reload(self):
+        self.storage.upload_bytes(b'result', 'out.sdf', bucket=OUTPUT)
+        self._download('out.sdf')
+
+        self.storage.disk_cache = DiskCache(self.path / 'cache', 100)
+        self.assertEqual(self._download('out.sdf'), (b'result', 0))
+
+    def test_link(self):
+        self.storage.disk_cache = DiskCache(self.path / 'links', 100,
+                                            link=True)
+        self.storage.upload_bytes(b'result', 'out.sdf', bucket=OUTPUT)
+        self._download('out.sdf')
+        os.unlink(self.path / 'downloaded-out.sdf')
+        self._download('out.sdf')
+
+        self.assertGreater(
+            (self.path / 'downloaded-out.sdf').stat().st_nlink, 1)
+
+    def tearDown(self) -> None:
+        self.root.cleanup()
+
+
+class NonSeekable(io.BytesIO):
+    def seekable(self) -> bool:
+        return False
@@ -0,0 +1,269 @@
+"""
+Testing for the instrumentation hooks
+"""
+import asyncio
+import pathlib
+import tempfile
+import threading
+import unittest
+
+from impression_web import instrumentation
+from impression_web.database.database_factory import ImpressionDatabaseFactory
+from impression_web.database.fake_firestore import FakeFirestoreClient
+from impression_web.instrumentation import Collector, \
+    OpenTelemetryInstrument
+from impression_web.job.job_factory import ImpressionJobFactory
+from impression_web.storage.exceptions import FileTransferError
+from impression_web.storage.file_storage import OUTPUT
+from impression_web.storage.file_storage_factory import \
+    ImpressionFileStorageFactory
+
+
+class FakeTracer:
+    """
+    OpenTelemetry style tracer recording its spans, current spans are per
+    thread and must be exited in order, on the thread that entered them
+    """
+    def __init__(self):
+        self.spans = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        if not hasattr(self._local, 'current'):
+            self._local.current = []
+        return self._local.current
+
+    def start_span(self, name):
+        span = FakeSpan(name, self.current[-1] if self.current else None)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def start_as_current_span(self, name):
+        tracer = self
+
+        class Context:
+            def __enter__(self):
+                self.span = tracer.start_span(name)
+                tracer.current.append(self.span)
+                return self.span
+
+            def __exit__(self, *exc_info):
+                if not tracer.current or tracer.current[-1] is not self.span:
+                    raise RuntimeError(f'{name} detached out of order')
+                tracer.current.pop().end()
+        return Context()
+
+
+class FakeSpan:
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.attributes = {}
+        self.exceptions = []
+        self.ended = False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def record_exception(self, exception):
+        self.exceptions.append(exception)
+
+    def set_status(self, status):
+        self.status = status
+
+    def end(self):
+        assert not self.ended, f'{self.name} ended twice'
+        self.ended = True
+
+
+class FakeMeter:
+    """OpenTelemetry style meter recording (name, value, attributes)"""
+    def __init__(self):
+        self.points = []
+
+    def _instrument(self, name, method):
+        meter = self
+
+        class Instrument:
+            pass
+        setattr(Instrument, method, lambda self, value, attributes: (
+            meter.points.append((name, value, attributes))))
+        return Instrument()
+
+    def create_counter(self, name, unit='', description=''):
+        return self._instrument(name, 'add')
+
+    def create_histogram(self, name, unit='', description=''):
+        return self._instrument(name, 'record')
+
+
+@instrumentation.instrumented
+def add(a, b):
+    instrumentation.record(items=2)
+    return a + b
+
+
+@instrumentation.instrumented(operation='nested')
+def nested(fail=False):
+    add(1, 2)
+    if fail:
+        raise ValueError('failed')
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self) -> None:
+        self.collector = Collector(keep_spans=True)
+        instrumenting = instrumentation.instrumenting(self.collector)
+        instrumenting.__enter__()
+        self.addCleanup(instrumenting.__exit__, None, None, None)
+
+    def test_no_instrument(self):
+        with instrumentation.instrumenting(None):
+            self.assertEqual(add(1, 2), 3)
+            self.assertFalse(instrumentation.recording())
+            instrumentation.record(items=1)
+        self.assertEqual(self.collector.stats, {})
+        self.assertIs(instrumentation.get_instrument(), self.collector,
+                      'previous instrument restored')
+
+    def test_collector(self):
+        for _ in range(3):
+            add(1, 2)
+        with self.assertRaises(ValueError):
+            nested(fail=True)
+
+        stats = self.collector[add.__qualname__]
+        self.assertEqual((stats.calls, stats.errors, stats.counts),
+                         (4, 0, {'items': 8}))
+        self.assertEqual(sum(stats.histogram), 4)
+        self.assertLessEqual(stats.quantile(0.5), 0.001)
+        self.assertEqual(self.collector['nested'].errors, 1)
+        self.assertEqual(self.collector['nested'].counts, {},
+                         'counts go to the innermost call')
+        self.assertIsInstance(self.collector.spans[-1].error, ValueError)
+        self.assertEqual(self.collector.to_dict()['nested']['calls'], 1)
+
+    def test_iterate(self):
+        stream = instrumentation.iterate(iter(range(5)), 'stream')
+        self.assertEqual(self.collector['stream'].calls, 0, 'lazy')
+        self.assertEqual(list(stream), list(range(5)))
+        partial = instrumentation.iterate(iter(range(5)), 'stream')
+        next(partial)
+        partial.close()
+
+        stats = self.collector['stream']
+        self.assertEqual((stats.calls, stats.errors), (2, 0))
+        self.assertEqual(stats.counts, {instrumentation.DOCUMENTS_READ: 6})
+
+    def test_database_calls(self):
+        db = FakeFirestoreClient()
+        database = ImpressionDatabaseFactory(platform='gcp').database(db=db)
+        job_factory = ImpressionJobFactory(platform='gcp')
+        jobs = [job_factory.job(user='user', model='no-model')
+                for _ in range(3)]
+        database.save_jobs(jobs)
+        jobs[0].info = 'updated'
+        jobs[0].update_in_db()
+        job_factory.from_id(jobs[1].job_id, 'user', db=db)
+        self.assertEqual(len(list(database.user_job_ids('user'))), 3)
+
+        self.assertEqual(self.collector['GCPJob.update_many'].counts,
+                         {instrumentation.DOCUMENTS_WRITTEN: 3})
+        self.assertEqual(self.collector['GCPJob.update_in_db'].calls, 1)
+        self.assertEqual(self.collector['GCPJob.from_id'].counts,
+                         {instrumentation.DOCUMENTS_READ: 1})
+        self.assertEqual(self.collector['GCPDatabase._user_jobs'].counts,
+                         {instrumentation.DOCUMENTS_READ: 3})
+        self.assertEqual(self.collector['GCPDatabase.save_jobs'].calls, 1)
+
+    def test_storage_calls(self):
+        with tempfile.TemporaryDirectory() as root:
+            storage = ImpressionFileStorageFactory(
+                platform='local').file_storage(
+                input_bucket_name='impression-uploads',
+                output_bucket_name='impression-output', root=root)
+            path = pathlib.Path(root) / 'input.sdf'
+            path.write_bytes(b'x' * 1000)
+            storage.upload_input_file(path)
+            storage.download_input_file(pathlib.Path(root) / 'copy.sdf',
+                                        'input.sdf')
+            with self.assertRaises(FileTransferError):
+                storage.download_bytes('missing.sdf', OUTPUT)
+
+        upload = self.collector['LocalStorage._upload_file']
+        self.assertEqual((upload.calls, upload.counts['bytes']), (1, 1000))
+        self.assertEqual(
+            self.collector['LocalStorage._download_file'].counts['bytes'],
+            1000)
+        self.assertEqual(self.collector['LocalStorage._get_stream'].errors,
+                         1)
+
+
+class TestOpenTelemetryInstrument(unittest.TestCase):
+    def test_spans_and_metrics(self):
+        tracer, meter = FakeTracer(), FakeMeter()
+        with instrumentation.instrumenting(
+                OpenTelemetryInstrument(tracer, meter)):
+            with self.assertRaises(ValueError):
+                nested(fail=True)
+
+        outer, inner = tracer.spans
+        self.assertEqual(outer.name, 'impression.nested')
+        self.assertIs(inner.parent, outer, 'calls nest')
+        self.assertEqual(inner.attributes, {'impression.items': 2})
+        self.assertIsInstance(outer.exceptions[0], ValueError)
+        self.assertTrue(outer.ended and inner.ended)
+
+        points = {(name, attributes['operation']): value
+                  for name, value, attributes in meter.points
+                  if name != 'impression.duration'}
+        self.assertEqual(points, {
+            ('impression.calls', add.__qualname__): 1,
+            ('impression.items', add.__qualname__): 2,
+            ('impression.calls', 'nested'): 1,
+            ('impression.errors', 'nested'): 1})
+        self.assertEqual(len([p for p in meter.points
+                              if p[0] == 'impression.duration']), 2)
+
+    def test_async_listing(self):
+        db = FakeFirestoreClient()
+        database = ImpressionDatabaseFactory(
+            platform='gcp', mode='async').database(db=db)
+        job_factory = ImpressionJobFactory(platform='gcp')
+        database.sync.save_jobs([job_factory.job(user='user', model='m')
+                                 for _ in range(5)])
+        tracer = FakeTracer()
+
+        async def work():
+            page = await database.user_jobs('user')
+            page.batch_size = 2
+            jobs = []
+            # each batch is read on a pool thread, updates in between
+            async for job in page:
+                job.info = 'listed'
+                await job.update_in_db()
+                jobs.append(job)
+            return jobs
+
+        with instrumentation.instrumenting(OpenTelemetryInstrument(tracer)):
+            loop = asyncio.new_event_loop()
+            try:
+                jobs = loop.run_until_complete(work())
+            finally:
+                loop.close()
+
+        self.assertEqual(len(jobs), 5)
+        listing, = [s for s in tracer.spans
+                    if s.name == 'impression.GCPDatabase.user_jobs']
+        self.assertTrue(listing.ended)
+        self.assertEqual(listing.attributes,
+                         {'impression.documents_read': 5})
+        updates = [s for s in tracer.spans
+                   if s.name == 'impression.GCPJob.update_in_db']
+        self.assertEqual(len(updates), 5)
+        self.assertTrue(all(s.ended for s in tracer.spans))
+        self.assertFalse(any(s.parent is listing for s in tracer.spans),
+                         'the listing is never the current span')
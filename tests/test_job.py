@@ -1,15 +1,27 @@
 """
 Testing for Job object and method
 """
+import asyncio
+from datetime import datetime, timezone
 import unittest
+from unittest import mock
 import warnings
 
+from impression_web.cache import JobCache
+from impression_web.database.database_factory import ImpressionDatabaseFactory
+from impression_web.database.fake_firestore import FakeFirestoreClient, \
+    FakeWriteBatch
+from impression_web.job.async_job import AsyncJob
 from impression_web.job.job_factory import ImpressionJobFactory
+from impression_web.job.job import JobStatus
 from impression_web.job.exceptions import JobCreationError, JobNotFoundError, \
-    JobAccessError
+    JobAccessError, JobConflictError, JobWriteError
 
+import google.api_core.exceptions
 from google.cloud import firestore
 
+from tests.helpers import run
+
 
 class TestGCPJob(unittest.TestCase):
     test_dict = None
@@ -35,7 +47,12 @@ class TestGCPJob(unittest.TestCase):
                          'submission_time': None,
                          'start_time': None, 'completion_time': None,
                          'info': '',
-                         'err': '', 'output_file_url': None}
+                         'err': '', 'output_file_url': None,
+                         'output_url_expiry': None,
+                         'worker_id': None, 'lease_expiry': None,
+                         'parent_id': None, 'shard_index': None,
+                         'shards': None, 'shards_finished': None,
+                         'shards_failed': None}
 
         # Upload to database
         cls.test_job.update_in_db('test-impression_web')
@@ -57,7 +74,10 @@ class TestGCPJob(unittest.TestCase):
              'upload_name': None, 'output_name': None, 'model': None,
              'submission_time': None, 'start_time': None,
              'completion_time': None, 'info': '', 'err': '',
-             'output_file_url': None}
+             'output_file_url': None, 'output_url_expiry': None,
+             'worker_id': None,
+             'lease_expiry': None, 'parent_id': None, 'shard_index': None,
+             'shards': None, 'shards_finished': None, 'shards_failed': None}
         )
 
     def test_invalid_file_dict(self):
@@ -105,3 +125,259 @@ class TestGCPJob(unittest.TestCase):
     @classmethod
     def tearDownClass(cls) -> None:
         cls.test_job.db.document('jobs/test-impression_web').delete()
+
+
+class TestGCPJobOffline(unittest.TestCase):
+    """GCPJob against the in-process firestore stand-in"""
+    def setUp(self) -> None:
+        self.db = FakeFirestoreClient()
+        self.job_factory = ImpressionJobFactory(platform='gcp')
+        self.job_factory.update_many(
+            [self.job_factory.job('test-user', model='fchl',
+                                  job_id=f'test-job-{i}')
+             for i in range(3)] +
+            [self.job_factory.job('other-user', model='fchl',
+                                  job_id='other-job')],
+            db=self.db)
+        self.db.round_trips = 0
+
+    def test_from_ids(self):
+        lookup = self.job_factory.from_ids(
+            ['test-job-2', 'invalid-id', 'other-job', 'test-job-0'],
+            'test-user', db=self.db)
+
+        self.assertEqual(list(lookup.jobs), ['test-job-2', 'test-job-0'],
+                         'found jobs in requested order')
+        self.assertEqual(lookup.missing, ['invalid-id'])
+        self.assertEqual(lookup.forbidden, ['other-job'])
+        self.assertEqual(self.db.round_trips, 1, 'single multi-get')
+
+    def test_update_many_failed_batch(self):
+        jobs = [self.job_factory.job('batch-user', model='fchl')
+                for _ in range(1000)]
+        commit = FakeWriteBatch.commit
+        calls = []
+
+        def fail_once(batch):
+            calls.append(batch)
+            if len(calls) == 1:
+                raise google.api_core.exceptions.ServiceUnavailable('down')
+            return commit(batch)
+
+        with mock.patch.object(FakeWriteBatch, 'commit', fail_once):
+            with self.assertRaises(JobWriteError) as raised:
+                self.job_factory.update_many(jobs, db=self.db,
+                                             max_workers=1)
+        self.assertEqual((len(raised.exception.written),
+                          len(raised.exception.failed)), (500, 500))
+        self.assertTrue(all(job.job_id for job in jobs), 'ids assigned')
+
+        ids = self.job_factory.update_many(jobs, db=self.db)
+        self.assertEqual(ids, [job.job_id for job in jobs])
+        stored = self.db.collection(u'jobs').where(
+            u'user', u'==', 'batch-user').get()
+        self.assertEqual(len(stored), 1000, 'retry rewrote the same jobs')
+
+    def test_update_many_failed_order(self):
+        jobs = [self.job_factory.job('batch-user', model='fchl')
+                for _ in range(6)]
+        down = google.api_core.exceptions.ServiceUnavailable('down')
+        with mock.patch.object(FakeWriteBatch, 'commit', side_effect=down):
+            with self.assertRaises(JobWriteError) as raised:
+                self.job_factory.update_many(jobs, db=self.db, batch_size=2)
+        self.assertEqual(raised.exception.failed,
+                         [job.job_id for job in jobs], 'in job order')
+
+    def test_update_many_invalid_batch_size(self):
+        jobs = [self.job_factory.job('batch-user', model='fchl')]
+        with self.assertRaises(ValueError):
+            self.job_factory.update_many(jobs, db=self.db, batch_size=0)
+        self.assertIsNone(jobs[0].job_id, 'no id assigned')
+
+    def test_from_ids_admin(self):
+        lookup = self.job_factory.from_ids(
+            ['other-job', 'test-job-1'], 'test-user', admin_access=True,
+            db=self.db)
+
+        self.assertEqual(list(lookup.jobs), ['other-job', 'test-job-1'])
+        self.assertEqual(lookup.forbidden, [])
+
+    def test_watch(self):
+        job = self.job_factory.from_id('test-job-0', 'test-user', db=self.db)
+        statuses = []
+        subscription = job.watch(
+            lambda j, previous: statuses.append((previous, j.status)))
+
+        job.status = JobStatus.QUEUED
+        job.update_in_db()
+        subscription.unsubscribe()
+        job.status = JobStatus.STARTED
+        job.update_in_db()
+
+        self.assertEqual(statuses, [(None, JobStatus.NONE),
+                                    (JobStatus.NONE, JobStatus.QUEUED)])
+
+    def test_cached_from_id(self):
+        clock = [0.0]
+        job_cache = JobCache(default_ttl=5, clock=lambda: clock[0])
+        factory = ImpressionJobFactory(platform='gcp', cache=job_cache)
+
+        job = factory.from_id('test-job-0', 'test-user', db=self.db)
+        factory.from_id('test-job-0', 'test-user', db=self.db)
+        self.assertEqual(self.db.round_trips, 1, 'second lookup cached')
+        with self.assertRaises(JobAccessError):
+            factory.from_id('test-job-0', 'other-user', db=self.db)
+
+        job.status = JobStatus.FINISHED
+        job.update_in_db()
+        self.assertEqual(
+            factory.from_id('test-job-0', 'test-user', db=self.db).status,
+            JobStatus.FINISHED, 'invalidated by update_in_db')
+
+        clock[0] = 60
+        factory.from_id('test-job-0', 'test-user', db=self.db)
+        self.assertEqual(self.db.round_trips, 3,
+                         'finished job outlives active ttl')
+
+        lookup = factory.from_ids(['test-job-0', 'test-job-1', 'other-job'],
+                                  'test-user', db=self.db)
+        self.assertEqual(list(lookup.jobs), ['test-job-0', 'test-job-1'])
+        self.assertEqual(lookup.forbidden, ['other-job'])
+        self.assertEqual(job_cache.stats()['hits'], 4)
+
+    def test_cached_job_partial_update(self):
+        factory = ImpressionJobFactory(platform='gcp', cache=JobCache())
+        factory.from_id('test-job-0', 'test-user', db=self.db)
+        job = factory.from_id('test-job-0', 'test-user', db=self.db)
+        cached, = factory.from_ids(['test-job-1'], 'test-user',
+                                   db=self.db).jobs.values()
+        cached, = factory.from_ids(['test-job-1'], 'test-user',
+                                   db=self.db).jobs.values()
+        self.assertEqual(factory.cache.stats()['hits'], 2)
+
+        # written elsewhere, not invalidating this process' cache
+        self.db.document('jobs/test-job-0').update({'err': 'frontend'})
+        job.info = 'progress'
+        job.update_in_db()
+        stored = self.db.document('jobs/test-job-0').get().to_dict()
+        self.assertEqual((stored['info'], stored['err']),
+                         ('progress', 'frontend'))
+
+        self.db.document('jobs/test-job-1').update({'err': 'frontend'})
+        cached.info = 'progress'
+        with self.assertRaises(JobConflictError):
+            cached.update_in_db(precondition=True)
+
+    def test_partial_update(self):
+        job = self.job_factory.from_id('test-job-0', 'test-user', db=self.db)
+        self.assertEqual(job.dirty_fields, frozenset(), 'clean when loaded')
+
+        job.info = 'progress'
+        job.status = JobStatus.STARTED
+        self.assertEqual(job.dirty_fields, {'info', 'status'})
+
+        # Concurrent change to another field is not clobbered
+        self.db.document('jobs/test-job-0').update({'err': 'frontend'})
+        job.update_in_db()
+        stored = self.db.document('jobs/test-job-0').get().to_dict()
+        self.assertEqual((stored['info'], stored['status'], stored['err']),
+                         ('progress', JobStatus.STARTED.value, 'frontend'))
+        self.assertEqual(job.dirty_fields, frozenset(), 'clean when saved')
+
+        self.db.round_trips = 0
+        job.update_in_db()
+        self.assertEqual(self.db.round_trips, 0, 'nothing to send')
+
+    def test_update_generated_id(self):
+        job = self.job_factory.from_dict(
+            self.job_factory.job('new-user', model='fchl').to_dict(),
+            db=self.db)
+        job_id = job.update_in_db()
+        job.info = 'progress'
+        job.update_in_db()
+
+        stored = self.db.document(f'jobs/{job_id}').get().to_dict()
+        self.assertEqual((stored['job_id'], stored['info']),
+                         (job_id, 'progress'))
+        database = ImpressionDatabaseFactory(platform='gcp').database(
+            db=self.db)
+        self.assertEqual(list(database.user_job_ids('new-user')), [job_id])
+
+    def test_update_precondition(self):
+        job = self.job_factory.from_id('test-job-1', 'test-user', db=self.db)
+        other = self.job_factory.from_id('test-job-1', 'test-user', db=self.db)
+
+        other.info = 'first'
+        other.update_in_db(precondition=True)
+        job.info = 'second'
+        with self.assertRaises(JobConflictError):
+            job.update_in_db(precondition=True)
+        self.assertEqual(
+            self.db.document('jobs/test-job-1').get().to_dict()['info'],
+            'first')
+
+    def test_from_dicts(self):
+        srcs = [self.db.document(f'jobs/test-job-{i}').get().to_dict()
+                for i in range(3)]
+        srcs[0]['submission_time'] = datetime(2021, 3, 4, 5, 6, 7,
+                                              tzinfo=timezone.utc)
+        srcs[1]['status'] = JobStatus.FINISHED.value
+        jobs = self.job_factory.from_dicts(srcs)
+
+        self.assertEqual([job.to_dict() for job in jobs], srcs, 'round trip')
+        self.assertIs(jobs[1].status, JobStatus.FINISHED)
+        self.assertEqual(jobs[2].dirty_fields, frozenset())
+        self.assertFalse(hasattr(jobs[2], '__dict__'), 'slots only')
+
+    def test_legacy_time_strings(self):
+        job = self.job_factory.from_dict(
+            {'job_id': 'legacy', 'submission_time': '99-12-31::23:59',
+             'start_time': 1000000000, 'completion_time': None})
+
+        self.assertEqual(job.to_dict()['submission_time'],
+                         datetime(1999, 12, 31, 23, 59).astimezone(
+                             timezone.utc), 'legacy string is local time')
+        self.assertEqual(job.submission_time, '99-12-31::23:59')
+        self.assertEqual(job.to_dict()['start_time'],
+                         datetime(2001, 9, 9, 1, 46, 40, tzinfo=timezone.utc))
+        self.assertIsNone(job.completion_time)
+
+    def test_time_precision(self):
+        job = self.job_factory.job('test-user', job_id='precise')
+        job.submission_time = datetime(2021, 3, 4, 5, 6, 7, 890,
+                                       tzinfo=timezone.utc)
+        self.assertEqual(job.to_dict()['submission_time'],
+                         datetime(2021, 3, 4, 5, 6, 7, tzinfo=timezone.utc),
+                         'stored to the second')
+
+    def test_async_jobs(self):
+        factory = ImpressionJobFactory(platform='gcp', mode='async')
+        statuses = []
+
+        async def work():
+            jobs = await asyncio.gather(
+                *(factory.from_id(f'test-job-{i}', 'test-user', db=self.db)
+                  for i in range(3)))
+            subscription = await jobs[0].watch(
+                lambda j, previous: statuses.append((previous, j.status)))
+            jobs[0].status = JobStatus.QUEUED
+            await jobs[0].update_in_db()
+            lookup = await factory.from_ids(['test-job-0', 'other-job'],
+                                            'test-user', db=self.db)
+            # listener callbacks are handed to the loop
+            await asyncio.sleep(0)
+            subscription.unsubscribe()
+            return jobs, lookup
+
+        jobs, lookup = run(work())
+        self.assertIsInstance(jobs[0], AsyncJob)
+        self.assertEqual([job.job_id for job in jobs],
+                         [f'test-job-{i}' for i in range(3)])
+        self.assertIs(lookup.jobs['test-job-0'].status, JobStatus.QUEUED)
+        self.assertEqual(lookup.forbidden, ['other-job'])
+        self.assertEqual(statuses, [(None, JobStatus.NONE),
+                                    (JobStatus.NONE, JobStatus.QUEUED)])
+        with self.assertRaises(JobNotFoundError):
+            run(factory.from_id('invalid-id', 'test-user', db=self.db))
+        with self.assertRaises(NotImplementedError):
+            ImpressionJobFactory(platform='gcp', mode='threads')
@@ -0,0 +1,69 @@
+"""
+Testing for the NMREDATA results parser
+"""
+import pathlib
+import tempfile
+import unittest
+
+import numpy as np
+
+from impression_web import results
+from impression_web.storage.disk_cache import DiskCache
+from impression_web.storage.file_storage import OUTPUT
+from impression_web.storage.file_storage_factory import \
+    ImpressionFileStorageFactory
+
+
+class TestResults(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.TemporaryDirectory()
+        self.content = b''.join(
+            pathlib.Path(f'data/output/test-output-file-{i}.sdf').read_bytes()
+            + b'$$$$\n' for i in (1, 2))
+        self.path = pathlib.Path(self.root.name) / 'output.sdf'
+        self.path.write_bytes(self.content)
+
+    def test_parse(self):
+        parsed = results.parse_file(self.path)
+
+        self.assertEqual(list(parsed.names), ['nmrmol1_IMP', 'nmrmol2_IMP'])
+        self.assertEqual(len(parsed.shifts), 9)
+        self.assertEqual(len(parsed.couplings), 16)
+
+        shifts, couplings = parsed.molecule(1)
+        np.testing.assert_array_equal(shifts['atom'], [0, 1, 2, 3])
+        np.testing.assert_array_equal(shifts['element'], [7, 1, 1, 1])
+        self.assertAlmostEqual(shifts['shift'][0], 236.19488525)
+        self.assertEqual(len(couplings), 6)
+        self.assertEqual((couplings['atom1'][3], couplings['atom2'][3],
+                          couplings['type'][3]), (1, 2, b'2JHH'))
+        self.assertAlmostEqual(couplings['value'][3], -11.17971611)
+
+    def test_malformed(self):
+        self.path.write_bytes(self.content.replace(b'1JCH      ,', b'', 1))
+        with self.assertRaises(ValueError):
+            results.parse_file(self.path)
+
+    def test_bytes(self):
+        parsed = results.parse(self.content)
+        restored = results.Results.from_bytes(parsed.to_bytes())
+        for array, restored_array in zip(parsed, restored):
+            np.testing.assert_array_equal(array, restored_array)
+        self.assertEqual(len(results.parse(b'')), 0)
+
+    def test_cached_output(self):
+        storage = ImpressionFileStorageFactory(
+            platform='local').file_storage(
+            input_bucket_name='impression-uploads',
+            output_bucket_name='impression-output', root=self.root.name,
+            compression='gzip')
+        storage.upload_bytes(self.content, 'output.sdf', bucket=OUTPUT)
+        cache = DiskCache(pathlib.Path(self.root.name) / 'cache', 1 << 20)
+
+        parsed = results.load_output(storage, 'output.sdf', cache)
+        cached = results.load_output(storage, 'output.sdf', cache)
+        np.testing.assert_array_equal(parsed.couplings, cached.couplings)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def tearDown(self) -> None:
+        self.root.cleanup()
@@ -0,0 +1,80 @@
+"""
+Testing for the lazy SDF reader
+"""
+import pathlib
+import tempfile
+import unittest
+
+from impression_web import sdf
+from impression_web.storage.exceptions import FileTransferError
+from impression_web.storage.file_storage_factory import \
+    ImpressionFileStorageFactory
+
+
+class TestSDF(unittest.TestCase):
+    def setUp(self) -> None:
+        self.root = tempfile.TemporaryDirectory()
+        self.records = [
+            pathlib.Path(f'data/input/test-input-file-{i}.sdf').read_bytes()
+            + b'$$$$\n' for i in (1, 2)]
+        # the last record without '$$$$', \r\n line endings are kept
+        self.records += [b'third\r\n$$$$\r\n', b'last\nM  END\n']
+        self.path = pathlib.Path(self.root.name) / 'records.sdf'
+        self.path.write_bytes(b''.join(self.records))
+
+    def test_iterate(self):
+        with sdf.SDFFile(self.path) as records:
+            self.assertEqual(list(records), self.records)
+            self.assertEqual(len(records), 4)
+            self.assertEqual(records[2], self.records[2])
+            self.assertEqual(records[-1], self.records[-1])
+            self.assertEqual(list(records.records(1, 3)), self.records[1:3])
+            with self.assertRaises(IndexError):
+                records[4]
+
+    def test_index(self):
+        index = sdf.SDFIndex.from_file(self.path)
+        self.assertEqual(len(index), 4)
+        self.assertEqual(index.span(1),
+                         (len(self.records[0]),
+                          len(self.records[0]) + len(self.records[1])))
+        self.assertEqual(sdf.SDFIndex.from_bytes(index.to_bytes()), index)
+        with self.assertRaises(ValueError):
+            sdf.SDFIndex.from_bytes(index.to_bytes()[:-1])
+
+        with sdf.SDFFile(self.path, index) as records:
+            self.assertEqual(list(records), self.records)
+
+        self.path.write_bytes(b''.join(self.records[:2]))
+        with self.assertRaises(ValueError):
+            sdf.SDFFile(self.path, index)
+
+    def test_open_records(self):
+        with sdf.SDFFile(self.path) as records:
+            with records.open_records(1, 3) as stream:
+                self.assertEqual(stream.read(5), self.records[1][:5])
+                stream.seek(0)
+                self.assertEqual(stream.read(), b''.join(self.records[1:3]))
+            with records.open_records(3, 3) as stream:
+                self.assertEqual(stream.read(), b'')
+
+    def test_no_records(self):
+        for content in (b'', b'\n \n'):
+            self.path.write_bytes(content)
+            with sdf.SDFFile(self.path) as records:
+                self.assertEqual((list(records), len(records)), ([], 0))
+
+    def test_stored_index(self):
+        storage = ImpressionFileStorageFactory(
+            platform='local').file_storage(
+            input_bucket_name='impression-uploads',
+            output_bucket_name='impression-output', root=self.root.name)
+        index = sdf.SDFIndex.from_file(self.path)
+
+        sdf.upload_index(storage, 'records.sdf', index)
+        self.assertEqual(sdf.download_index(storage, 'records.sdf'), index)
+        with self.assertRaises(FileTransferError):
+            sdf.download_index(storage, 'not-a-file.sdf')
+
+    def tearDown(self) -> None:
+        self.root.cleanup()